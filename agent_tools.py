@@ -0,0 +1,77 @@
+"""phidata toolkits given to the agents.
+
+Kept apart from lab_pipeline so that phidata is only imported once an agent is built.
+"""
+
+import json
+from typing import Optional
+
+from phi.tools import Toolkit
+from phi.tools.tavily import TavilyTools
+
+from reference_ranges import get_reference_ranges
+from search_cache import get_search_cache
+from tracing import span
+
+
+class ReferenceRangeTools(Toolkit):
+    """Agent tool that answers reference range questions from the bundled knowledge base."""
+
+    def __init__(self):
+        super().__init__(name="reference_range_tools")
+        self.register(self.lookup_reference_range)
+
+    def lookup_reference_range(self, parameter: str, age: Optional[int] = None, sex: Optional[str] = None,
+                               unit: Optional[str] = None) -> str:
+        """Look up the standard reference range of a lab test.
+
+        Args:
+            parameter (str): Name of the lab test, e.g. "HbA1c" or "SGPT".
+            age (int): Age of the patient in years, if known.
+            sex (str): "male" or "female", if known.
+            unit (str): Unit the result is reported in, if known.
+
+        Returns:
+            str: JSON with the range limits, or a note that the test is not in the knowledge base.
+        """
+        sex = sex.lower() if sex and sex.lower() in ("male", "female") else None
+        with span("reference_lookup"):
+            reference = get_reference_ranges().lookup(parameter, age=age, sex=sex, unit=unit)
+        if reference is None:
+            return json.dumps({"parameter": parameter, "found": False})
+        return json.dumps({**reference, "found": True})
+
+
+class CachedTavilyTools(TavilyTools):
+    """TavilyTools whose web search goes through a shared SearchCache.
+
+    Live searches wait for a slot from limiter (a FairRateLimiter) when one is given.
+    """
+
+    def __init__(self, cache=None, limiter=None, **kwargs):
+        self.cache = cache if cache is not None else get_search_cache()
+        self.limiter = limiter
+        super().__init__(**kwargs)
+
+    def web_search_using_tavily(self, query: str, max_results: int = 5) -> str:
+        """Use this function to search the web for a given query.
+        This function uses the Tavily API to provide realtime online information about the query.
+
+        Args:
+            query (str): Query to search for.
+            max_results (int): Maximum number of results to return. Defaults to 5.
+
+        Returns:
+            str: JSON string of results related to the query.
+        """
+        key = self.cache.make_key(
+            query, max_results, self.search_depth, self.include_answer, self.max_tokens, self.format
+        )
+        with span("web_search"):
+            return self.cache.get_or_search(key, lambda: self._search(query, max_results))
+
+    def _search(self, query, max_results):
+        if self.limiter is not None:
+            self.limiter.acquire()
+        with span("tavily_request"):
+            return super().web_search_using_tavily(query, max_results)
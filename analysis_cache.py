@@ -0,0 +1,144 @@
+"""Disk-backed cache for lab report analyses, keyed on the uploaded content."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+def hash_text(text):
+    """Return the SHA-256 hex digest of a string."""
+    return hashlib.sha256((text or "").encode("utf-8")).hexdigest()
+
+
+def make_cache_key(file_bytes, model_id, prompt_hash, user_profile):
+    """Build a content-addressed key from the upload and everything that shapes the answer."""
+    digest = hashlib.sha256()
+    digest.update(hashlib.sha256(file_bytes).digest())
+    for part in (model_id, prompt_hash, " ".join((user_profile or "").split())):
+        digest.update(b"\x00")
+        digest.update(part.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class AnalysisCache:
+    """SQLite cache of analysis and recommendation text with TTL and LRU eviction."""
+
+    def __init__(self, path, ttl_seconds=7 * 24 * 3600, max_entries=500, max_bytes=50 * 1024 * 1024):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS analyses (
+                key TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_analyses_accessed ON analyses (accessed_at)")
+        self._conn.commit()
+
+    def get(self, key):
+        """Return the cached entry for a key, or None on a miss or expired entry."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload, created_at FROM analyses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.ttl_seconds and now - row[1] > self.ttl_seconds):
+                if row is not None:
+                    self._conn.execute("DELETE FROM analyses WHERE key = ?", (key,))
+                    self._conn.commit()
+                    self.evictions += 1
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE analyses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def peek(self, key):
+        """Return the cached entry for a key like get, without counting a hit or miss or refreshing it."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload, created_at FROM analyses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or (self.ttl_seconds and time.time() - row[1] > self.ttl_seconds):
+            return None
+        return json.loads(row[0])
+
+    def put(self, key, analysis, recommendations=None):
+        """Store an analysis (and optional recommendations) and evict if over budget."""
+        self.put_payload(key, {"analysis": analysis, "recommendations": recommendations})
+
+    def put_payload(self, key, entry):
+        """Store any JSON-serializable dict under a key and evict if over budget."""
+        payload = json.dumps(entry)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO analyses (key, payload, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, payload, len(payload), now, now),
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        """Drop expired entries, then least recently used ones until within limits."""
+        if self.ttl_seconds:
+            cursor = self._conn.execute("DELETE FROM analyses WHERE created_at < ?", (now - self.ttl_seconds,))
+            self.evictions += cursor.rowcount
+
+        count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM analyses").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+
+        rows = self._conn.execute("SELECT key, size FROM analyses ORDER BY accessed_at ASC").fetchall()
+        stale = []
+        for key, size in rows:
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            stale.append((key,))
+            count -= 1
+            total -= size
+        self._conn.executemany("DELETE FROM analyses WHERE key = ?", stale)
+        self.evictions += len(stale)
+
+    def clear(self):
+        """Remove every cached entry."""
+        with self._lock:
+            self._conn.execute("DELETE FROM analyses")
+            self._conn.commit()
+
+    def stats(self):
+        """Return hit/miss counters and current size of the cache."""
+        with self._lock:
+            count, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM analyses"
+            ).fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": count,
+            "bytes": total,
+        }
@@ -1,22 +1,41 @@
 import streamlit as st
+from streamlit import runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import os
-import pandas as pd
 from PIL import Image
 from io import BytesIO
-from phi.agent import Agent
-from phi.model.google import Gemini
-from phi.tools.tavily import TavilyTools
-from tempfile import NamedTemporaryFile
-import base64
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
-from reportlab.lib import colors
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image as ReportLabImage
-from reportlab.lib.units import inch
 from datetime import datetime
-import re
-import time
+from html import escape
+import hashlib
+import hmac
+import logging
+from functools import lru_cache, partial
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from analysis_cache import AnalysisCache, hash_text
+from search_cache import SearchCache
+from rate_limiter import FairRateLimiter, RateLimitedAgent, report_queue_position
+from resilience import ResilientAgent, UpstreamHealth
+from jobs import DONE, FAILED, QUEUED, JobManager
+from bounded_cache import BoundedCache
+from blob_store import BlobStore, BlobTooLargeError
+from image_preprocessing import create_thumbnail
+from near_duplicates import NearDuplicateIndex, perceptual_hash
+from pdf_reports import render_page
+from lab_results import strip_structured_results
+from token_usage import summarize_usage
+from tracing import get_tracer, span, start_metrics_server, start_trace
+from range_classifier import (
+    PARSE_BAD_REFERENCE,
+    PARSE_BAD_VALUE,
+    PARSE_NO_REFERENCE,
+    classify,
+    classify_results,
+)
+import lab_pipeline
+from lab_pipeline import PARALLEL_RECOMMENDATIONS, RECOMMENDATION_SECTIONS
+
+logger = logging.getLogger(__name__)
 
 # Set page configuration
 st.set_page_config(
@@ -26,469 +45,35 @@ st.set_page_config(
     page_icon="🧪"
 )
 
-# Custom CSS for enhanced UI with animations and better contrast
-st.markdown("""
-<style>
-    /* Import modern fonts */
-    @import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700&display=swap');
-    
-    /* Root variables for consistent theming */
-    :root {
-        --primary-color: #2563eb;
-        --primary-hover: #1d4ed8;
-        --secondary-color: #f8fafc;
-        --accent-color: #10b981;
-        --warning-color: #f59e0b;
-        --error-color: #ef4444;
-        --success-color: #10b981;
-        --text-primary: #1f2937;
-        --text-secondary: #6b7280;
-        --border-color: #e5e7eb;
-        --shadow-sm: 0 1px 2px 0 rgba(0, 0, 0, 0.05);
-        --shadow-md: 0 4px 6px -1px rgba(0, 0, 0, 0.1);
-        --shadow-lg: 0 10px 15px -3px rgba(0, 0, 0, 0.1);
-        --border-radius: 12px;
-    }
-    
-    /* Global styles */
-    .stApp {
-        font-family: 'Inter', sans-serif;
-        background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-        min-height: 100vh;
-    }
-    
-    /* Main container */
-    .main-container {
-        background: rgba(255, 255, 255, 0.95);
-        backdrop-filter: blur(10px);
-        border-radius: var(--border-radius);
-        padding: 2rem;
-        margin: 1rem;
-        box-shadow: var(--shadow-lg);
-        border: 1px solid rgba(255, 255, 255, 0.2);
-        animation: slideUp 0.6s ease-out;
-    }
-    
-    /* Animations */
-    @keyframes slideUp {
-        from {
-            opacity: 0;
-            transform: translateY(30px);
-        }
-        to {
-            opacity: 1;
-            transform: translateY(0);
-        }
-    }
-    
-    @keyframes fadeIn {
-        from { opacity: 0; }
-        to { opacity: 1; }
-    }
-    
-    @keyframes pulse {
-        0%, 100% { transform: scale(1); }
-        50% { transform: scale(1.05); }
-    }
-    
-    @keyframes shimmer {
-        0% { background-position: -1000px 0; }
-        100% { background-position: 1000px 0; }
-    }
-    
-    /* Header styling */
-    .main-header {
-        text-align: center;
-        margin-bottom: 2rem;
-        animation: fadeIn 0.8s ease-out;
-    }
-    
-    .main-header h1 {
-        color: var(--text-primary);
-        font-size: 2.5rem;
-        font-weight: 700;
-        margin-bottom: 0.5rem;
-        text-shadow: 0 2px 4px rgba(0, 0, 0, 0.1);
-    }
-    
-    .main-header p {
-        color: var(--text-secondary);
-        font-size: 1.1rem;
-        font-weight: 400;
-    }
-    
-    /* Card components */
-    .custom-card {
-        background: white;
-        border-radius: var(--border-radius);
-        padding: 1.5rem;
-        margin: 1rem 0;
-        box-shadow: var(--shadow-md);
-        border: 1px solid var(--border-color);
-        transition: all 0.3s ease;
-        animation: fadeIn 0.6s ease-out;
-    }
-    
-    .custom-card:hover {
-        transform: translateY(-4px);
-        box-shadow: var(--shadow-lg);
-    }
-    
-    /* Banner styles (non-clickable) */
-    .banner-info {
-        background: linear-gradient(135deg, #3b82f6 0%, #1e40af 100%);
-        color: white;
-        border: none;
-        box-shadow: 0 8px 25px rgba(59, 130, 246, 0.3);
-    }
-    
-    .banner-warning {
-        background: linear-gradient(135deg, #f59e0b 0%, #d97706 100%);
-        color: white;
-        border: none;
-        box-shadow: 0 8px 25px rgba(245, 158, 11, 0.3);
-    }
-    
-    .banner-success {
-        background: linear-gradient(135deg, #10b981 0%, #059669 100%);
-        color: white;
-        border: none;
-        box-shadow: 0 8px 25px rgba(16, 185, 129, 0.3);
-    }
-    
-    .banner-error {
-        background: linear-gradient(135deg, #ef4444 0%, #dc2626 100%);
-        color: white;
-        border: none;
-        box-shadow: 0 8px 25px rgba(239, 68, 68, 0.3);
-    }
-    
-    /* Clickable elements */
-    .clickable-card {
-        cursor: pointer;
-        background: white;
-        border: 2px solid var(--border-color);
-        transition: all 0.3s ease;
-        position: relative;
-        overflow: hidden;
-    }
-    
-    .clickable-card::before {
-        content: '';
-        position: absolute;
-        top: 0;
-        left: -100%;
-        width: 100%;
-        height: 100%;
-        background: linear-gradient(90deg, transparent, rgba(59, 130, 246, 0.1), transparent);
-        transition: left 0.6s ease;
-    }
-    
-    .clickable-card:hover {
-        border-color: var(--primary-color);
-        transform: translateY(-2px);
-        box-shadow: 0 8px 25px rgba(59, 130, 246, 0.15);
-    }
-    
-    .clickable-card:hover::before {
-        left: 100%;
-    }
-    
-    /* Button styles */
-    .stButton > button {
-        background: linear-gradient(135deg, var(--primary-color) 0%, var(--primary-hover) 100%);
-        color: white;
-        border: none;
-        border-radius: var(--border-radius);
-        padding: 0.75rem 2rem;
-        font-weight: 600;
-        font-size: 1rem;
-        transition: all 0.3s ease;
-        box-shadow: 0 4px 15px rgba(37, 99, 235, 0.3);
-        cursor: pointer;
-        position: relative;
-        overflow: hidden;
-    }
-    
-    .stButton > button::before {
-        content: '';
-        position: absolute;
-        top: 0;
-        left: -100%;
-        width: 100%;
-        height: 100%;
-        background: linear-gradient(90deg, transparent, rgba(255, 255, 255, 0.2), transparent);
-        transition: left 0.6s ease;
-    }
-    
-    .stButton > button:hover {
-        transform: translateY(-2px);
-        box-shadow: 0 6px 20px rgba(37, 99, 235, 0.4);
-    }
-    
-    .stButton > button:hover::before {
-        left: 100%;
-    }
-    
-    .stButton > button:active {
-        transform: translateY(0);
-    }
-    
-    /* Upload area styling */
-    .upload-area {
-        border: 3px dashed var(--border-color);
-        border-radius: var(--border-radius);
-        padding: 2rem;
-        text-align: center;
-        background: rgba(248, 250, 252, 0.5);
-        transition: all 0.3s ease;
-        cursor: pointer;
-    }
-    
-    .upload-area:hover {
-        border-color: var(--primary-color);
-        background: rgba(37, 99, 235, 0.05);
-        transform: scale(1.02);
-    }
-    
-    /* Progress indicators */
-    .progress-container {
-        background: white;
-        border-radius: var(--border-radius);
-        padding: 1rem;
-        margin: 1rem 0;
-        box-shadow: var(--shadow-sm);
-        border: 1px solid var(--border-color);
-    }
-    
-    .progress-bar {
-        width: 100%;
-        height: 8px;
-        background: var(--secondary-color);
-        border-radius: 4px;
-        overflow: hidden;
-        margin-top: 0.5rem;
-    }
-    
-    .progress-fill {
-        height: 100%;
-        background: linear-gradient(90deg, var(--primary-color), var(--accent-color));
-        border-radius: 4px;
-        animation: shimmer 2s infinite;
-        background-size: 1000px 100%;
-    }
-    
-    /* Status indicators */
-    .status-indicator {
-        display: inline-flex;
-        align-items: center;
-        gap: 0.5rem;
-        padding: 0.5rem 1rem;
-        border-radius: 20px;
-        font-weight: 500;
-        font-size: 0.9rem;
-        animation: fadeIn 0.5s ease-out;
-    }
-    
-    .status-success {
-        background: rgba(16, 185, 129, 0.1);
-        color: var(--success-color);
-        border: 1px solid rgba(16, 185, 129, 0.2);
-    }
-    
-    .status-warning {
-        background: rgba(245, 158, 11, 0.1);
-        color: var(--warning-color);
-        border: 1px solid rgba(245, 158, 11, 0.2);
-    }
-    
-    .status-error {
-        background: rgba(239, 68, 68, 0.1);
-        color: var(--error-color);
-        border: 1px solid rgba(239, 68, 68, 0.2);
-    }
-    
-    /* Loading spinner */
-    .loading-spinner {
-        display: inline-block;
-        width: 20px;
-        height: 20px;
-        border: 2px solid var(--border-color);
-        border-top: 2px solid var(--primary-color);
-        border-radius: 50%;
-        animation: spin 1s linear infinite;
-        margin-right: 0.5rem;
-    }
-    
-    @keyframes spin {
-        0% { transform: rotate(0deg); }
-        100% { transform: rotate(360deg); }
-    }
-    
-    /* Expandable sections */
-    .expandable-section {
-        background: white;
-        border: 1px solid var(--border-color);
-        border-radius: var(--border-radius);
-        overflow: hidden;
-        transition: all 0.3s ease;
-        box-shadow: var(--shadow-sm);
-    }
-    
-    .expandable-section:hover {
-        box-shadow: var(--shadow-md);
-    }
-    
-    /* File info display */
-    .file-info {
-        background: rgba(16, 185, 129, 0.05);
-        border: 1px solid rgba(16, 185, 129, 0.2);
-        border-radius: var(--border-radius);
-        padding: 1rem;
-        margin: 0.5rem 0;
-        display: flex;
-        align-items: center;
-        gap: 0.75rem;
-        animation: slideUp 0.4s ease-out;
-    }
-    
-    .file-icon {
-        width: 40px;
-        height: 40px;
-        background: var(--success-color);
-        border-radius: 8px;
-        display: flex;
-        align-items: center;
-        justify-content: center;
-        color: white;
-        font-size: 1.2rem;
-        animation: pulse 2s infinite;
-    }
-    
-    /* Typography improvements */
-    .section-title {
-        color: var(--text-primary);
-        font-size: 1.5rem;
-        font-weight: 600;
-        margin-bottom: 1rem;
-        display: flex;
-        align-items: center;
-        gap: 0.5rem;
-    }
-    
-    .section-subtitle {
-        color: var(--text-secondary);
-        font-size: 1rem;
-        font-weight: 400;
-        margin-bottom: 1.5rem;
-    }
-    
-    /* Health status indicators */
-    .health-status {
-        padding: 0.75rem;
-        border-radius: var(--border-radius);
-        margin: 0.5rem 0;
-        border-left: 4px solid;
-        animation: slideUp 0.5s ease-out;
-    }
-    
-    .health-status.normal {
-        background: rgba(16, 185, 129, 0.1);
-        border-left-color: var(--success-color);
-        color: var(--success-color);
-    }
-    
-    .health-status.high {
-        background: rgba(239, 68, 68, 0.1);
-        border-left-color: var(--error-color);
-        color: var(--error-color);
-    }
-    
-    .health-status.low {
-        background: rgba(245, 158, 11, 0.1);
-        border-left-color: var(--warning-color);
-        color: var(--warning-color);
-    }
-    
-    /* Responsive design */
-    @media (max-width: 768px) {
-        .main-container {
-            margin: 0.5rem;
-            padding: 1rem;
-        }
-        
-        .main-header h1 {
-            font-size: 2rem;
-        }
-        
-        .custom-card {
-            padding: 1rem;
-        }
-    }
-    
-    /* Accessibility improvements */
-    .sr-only {
-        position: absolute;
-        width: 1px;
-        height: 1px;
-        padding: 0;
-        margin: -1px;
-        overflow: hidden;
-        clip: rect(0, 0, 0, 0);
-        white-space: nowrap;
-        border: 0;
-    }
-    
-    /* Focus states for keyboard navigation */
-    .stButton > button:focus,
-    .clickable-card:focus {
-        outline: 2px solid var(--primary-color);
-        outline-offset: 2px;
-    }
-    
-    /* High contrast mode support */
-    @media (prefers-contrast: high) {
-        :root {
-            --primary-color: #0000ff;
-            --text-primary: #000000;
-            --text-secondary: #333333;
-            --border-color: #000000;
-        }
-        
-        .custom-card {
-            border: 2px solid var(--border-color);
-        }
-    }
-    
-    /* Reduced motion support */
-    @media (prefers-reduced-motion: reduce) {
-        * {
-            animation-duration: 0.01ms !important;
-            animation-iteration-count: 1 !important;
-            transition-duration: 0.01ms !important;
-        }
-    }
-    
-    /* Dark mode support */
-    @media (prefers-color-scheme: dark) {
-        :root {
-            --text-primary: #f9fafb;
-            --text-secondary: #d1d5db;
-            --border-color: #374151;
-            --secondary-color: #1f2937;
-        }
-        
-        .custom-card {
-            background: #111827;
-            border-color: var(--border-color);
-        }
-        
-        .main-container {
-            background: rgba(17, 24, 39, 0.95);
-        }
-    }
-</style>
-""", unsafe_allow_html=True)
+# Stylesheet and fonts; served as cacheable static files when static serving is on
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+STYLESHEET_PATH = os.path.join(STATIC_DIR, "styles.css")
+STYLESHEET_URL = "app/static/styles.css"
+FONTS_URL = "https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700&display=swap"
+
+
+@st.cache_resource
+def get_stylesheet_html(static_serving, modified):
+    """Return the HTML that loads the stylesheet: a link versioned by content hash, or the CSS inline."""
+    with open(STYLESHEET_PATH, "rb") as f:
+        css = f.read()
+    fonts = (
+        '<link rel="preconnect" href="https://fonts.gstatic.com" crossorigin>'
+        f'<link rel="stylesheet" href="{FONTS_URL}">'
+    )
+    if static_serving:
+        version = hashlib.sha256(css).hexdigest()[:12]
+        return f'{fonts}<link rel="stylesheet" href="{STYLESHEET_URL}?v={version}">'
+    return f"{fonts}<style>{css.decode('utf-8')}</style>"
+
+
+def inject_styles():
+    """Load the custom CSS; only a link tag goes over the websocket when static serving is enabled."""
+    static_serving = st.get_option("server.enableStaticServing")
+    st.markdown(get_stylesheet_html(static_serving, os.path.getmtime(STYLESHEET_PATH)), unsafe_allow_html=True)
+
+
+inject_styles()
 
 # API Keys
 TAVILY_API_KEY = st.secrets.get("TAVILY_API_KEY")
@@ -501,237 +86,565 @@ if not TAVILY_API_KEY or not GOOGLE_API_KEY:
 
 MAX_IMAGE_WIDTH = 300
 
-SYSTEM_PROMPT = """
-You are an expert medical lab report analyzer with specialized knowledge in interpreting laboratory test results and providing health insights in simple, easy-to-understand language.
+# Databases and session artifacts on local disk; benchmarks point CACHE_DIR at a temporary directory
+CACHE_DIR = st.secrets.get("CACHE_DIR") or os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+
+# Analysis cache settings
+CACHE_DB_PATH = os.path.join(CACHE_DIR, "analyses.sqlite3")
+CACHE_TTL_SECONDS = 7 * 24 * 3600
+CACHE_MAX_ENTRIES = 500
+CACHE_MAX_BYTES = 50 * 1024 * 1024
 
-Your role is to analyze medical lab reports from images, identify all test parameters with their values and reference ranges, and provide comprehensive health insights in layman's terms.
+# Web search results shared by every session (in memory, persisted next to the analysis cache)
+SEARCH_CACHE_DB_PATH = os.path.join(CACHE_DIR, "searches.sqlite3")
+SEARCH_CACHE_TTL_SECONDS = 24 * 3600
 
-Focus on:
-1. Extracting all test parameters, values, and reference ranges
-2. Identifying which parameters are within normal limits and which are abnormal
-3. Explaining what each abnormal parameter means in simple terms
-4. Providing specific lifestyle and dietary recommendations for abnormal values
-5. Suggesting when to consult a healthcare provider
-"""
+# Near-duplicate uploads: re-photographed, cropped or re-encoded copies of an analyzed report.
+# They are analyzed like any upload; an earlier upload's recommendations are reused only when
+# the new analysis reads the same results, since different reports on one lab's form look alike
+NEAR_DUPLICATE_REUSE = st.secrets.get("NEAR_DUPLICATE_REUSE", True)
+NEAR_DUPLICATE_DB_PATH = os.path.join(CACHE_DIR, "image_hashes.sqlite3")
+NEAR_DUPLICATE_MAX_DISTANCE = int(st.secrets.get("NEAR_DUPLICATE_MAX_DISTANCE", 8))
+# "session" only compares with the user's own earlier uploads in this browser session, kept in
+# memory; "all" also with other sessions' uploads, kept on disk at NEAR_DUPLICATE_DB_PATH
+NEAR_DUPLICATE_SCOPE = st.secrets.get("NEAR_DUPLICATE_SCOPE", "session")
 
-INSTRUCTIONS = """
-Analyze the lab report image and provide information in this structured format:
+# Large session artifacts (the upload and the analysis text) live on disk; session state keeps handles
+BLOB_STORE_PATH = os.path.join(CACHE_DIR, "blobs")
+BLOB_STORE_MAX_BYTES = 2 * 1024 ** 3
+SESSION_BLOB_MAX_BYTES = 64 * 1024 ** 2
 
-**Test Summary:**
-- List all tests performed with their values and reference ranges
-- Clearly mark which values are HIGH, LOW, or NORMAL
+# Multi-page PDF reports
+PDF_PREVIEW_DPI = 100
+PDF_RASTER_WORKERS = 4
+PDF_PAGE_CONCURRENCY = 4
 
-**What Your Results Mean (In Simple Terms):**
-- Explain each abnormal result in easy-to-understand language
-- Avoid medical jargon and use everyday terms
-- Explain potential health implications
+# Explanations shown when a result could not be classified
+PARSE_STATUS_NOTES = {
+    PARSE_NO_REFERENCE: " • no reference range on the report",
+    PARSE_BAD_REFERENCE: " • reference range could not be read",
+    PARSE_BAD_VALUE: " • value could not be compared with the range",
+}
 
-**Lifestyle Changes Needed:**
-- Provide specific, actionable lifestyle modifications for abnormal values
-- Include exercise recommendations, sleep habits, stress management
-- Be specific about duration and frequency
+# Display thumbnail cache
+THUMBNAIL_CACHE_MAX_ENTRIES = 128
+THUMBNAIL_CACHE_MAX_BYTES = 16 * 1024 * 1024
 
-**Diet Recommendations:**
-- Suggest specific foods to eat more of
-- List foods to avoid or limit
-- Provide meal planning tips if relevant
-- Include hydration recommendations
+# Generated PDF memoization
+PDF_CACHE_MAX_ENTRIES = 32
+PDF_CACHE_MAX_BYTES = 128 * 1024 * 1024
 
-**When to See a Doctor:**
-- Indicate urgency level (immediate, within days, routine follow-up)
-- Explain red flags that require immediate attention
-- Suggest which specialist to consult if needed
+# Static page content
+HOW_IT_WORKS_STEPS = [
+    ("📤", "Upload", "Upload your lab report image in any common format"),
+    ("👤", "Profile", "Add your personal health details for customized insights"),
+    ("🤖", "AI Analysis", "Our advanced AI analyzes your results with medical precision"),
+    ("📊", "Insights", "Get simple explanations of your health status"),
+    ("🎯", "Recommendations", "Receive personalized lifestyle and dietary guidance"),
+    ("📄", "Report", "Download your complete health analysis as a PDF"),
+]
+HEALTH_TIPS = [
+    ("🥗", "Nutrition Excellence", [
+        "Consume 5-9 servings of colorful fruits and vegetables daily",
+        "Stay hydrated with 8-10 glasses of water throughout the day",
+        "Choose whole grains over refined carbohydrates",
+        "Limit processed foods and added sugars",
+        "Include healthy fats from nuts, seeds, and fish",
+    ]),
+    ("🏃", "Active Lifestyle", [
+        "Aim for 150 minutes of moderate exercise weekly",
+        "Include both cardiovascular and strength training",
+        "Take movement breaks every 30 minutes when sitting",
+        "Find physical activities you genuinely enjoy",
+        "Start slowly and gradually increase intensity",
+    ]),
+    ("😴", "Wellness Habits", [
+        "Get 7-9 hours of quality sleep nightly",
+        "Practice stress management techniques daily",
+        "Avoid smoking and limit alcohol consumption",
+        "Schedule regular preventive health checkups",
+        "Maintain strong social connections",
+    ]),
+]
 
-**Follow-up Testing:**
-- Recommend when to retest
-- Suggest additional tests if needed
+# Streaming settings
+STREAM_RESPONSES = True
 
-Always emphasize that this analysis is for educational purposes and should not replace professional medical advice.
-"""
+# Background analysis jobs
+ANALYSIS_JOB_WORKERS = 8
+JOB_POLL_INTERVAL = 0.5
 
-FOLLOW_UP_PROMPT = """
-You are a health and wellness expert specializing in personalized lifestyle and dietary recommendations based on lab report findings.
+# Request budgets shared by every session of this process (override in secrets)
+GEMINI_RPM = int(st.secrets.get("GEMINI_RPM", 10))
+GEMINI_TPM = int(st.secrets.get("GEMINI_TPM", 4_000_000))
+TAVILY_RPM = int(st.secrets.get("TAVILY_RPM", 100))
 
-Based on the specific abnormal lab values identified, provide detailed, actionable recommendations including:
+# Operators see live stage latencies by opening the app with ?operator=<OPERATOR_TOKEN>
+OPERATOR_TOKEN = st.secrets.get("OPERATOR_TOKEN")
+OPERATOR_PANEL_REFRESH = 5
+# Prometheus metrics are served on this local port when set
+METRICS_PORT = st.secrets.get("METRICS_PORT")
 
-1. **Detailed Meal Plans:** Specific breakfast, lunch, dinner, and snack suggestions
-2. **Exercise Routines:** Specific types, duration, and frequency of physical activities
-3. **Lifestyle Modifications:** Sleep schedule, stress management, habits to change
-4. **Natural Remedies:** Safe, evidence-based supplements or natural approaches
-5. **Monitoring Tips:** How to track progress and improvements
-6. **Timeline:** Expected timeframe for improvements with lifestyle changes
+# Model call deadlines and retries
+MODEL_CALL_DEADLINE = 120
+MODEL_ATTEMPT_TIMEOUT = 60
+MODEL_MAX_ATTEMPTS = 3
 
-Make all recommendations practical, specific, and easy to follow for the average person.
-"""
+# Recommendation fan-out settings
+RECOMMENDATION_SECTION_TIMEOUT = 45
+RECOMMENDATION_WORKERS = 12
 
 @st.cache_resource
-def get_lab_analyzer_agent():
-    """Initialize and cache the lab report analyzer agent."""
+def get_model_limiter():
+    """Initialize and cache the Gemini rate limiter shared by all sessions."""
+    return FairRateLimiter(rpm=GEMINI_RPM, tpm=GEMINI_TPM, name="gemini")
+
+@st.cache_resource
+def get_search_limiter():
+    """Initialize and cache the Tavily rate limiter shared by all sessions."""
+    return FairRateLimiter(rpm=TAVILY_RPM, name="tavily")
+
+@st.cache_resource
+def get_model_health():
+    """Initialize and cache the Gemini circuit breaker and latency stats shared by all sessions."""
+    return UpstreamHealth("Gemini")
+
+@st.cache_resource
+def get_metrics_server():
+    """Start the Prometheus metrics endpoint once per process, if a port is configured."""
+    if not METRICS_PORT:
+        return None
     try:
-        return Agent(
-            model=Gemini(id="gemini-2.0-flash-exp", api_key=GOOGLE_API_KEY),
-            system_prompt=SYSTEM_PROMPT,
-            instructions=INSTRUCTIONS,
-            tools=[TavilyTools(api_key=TAVILY_API_KEY)],
-            markdown=True,
-        )
-    except Exception as e:
-        st.error(f"❌ Error initializing lab analyzer agent: {e}")
+        return start_metrics_server(int(METRICS_PORT))
+    except OSError as e:
+        st.warning(f"📈 Could not start the metrics endpoint on port {METRICS_PORT}: {e}")
         return None
 
+def make_resilient(build_agent):
+    """Wrap a freshly built agent with deadlines, retries, hedging and the shared circuit breaker."""
+    return ResilientAgent(
+        build_agent(),
+        create_agent=build_agent,
+        health=get_model_health(),
+        deadline=MODEL_CALL_DEADLINE,
+        attempt_timeout=MODEL_ATTEMPT_TIMEOUT,
+        max_attempts=MODEL_MAX_ATTEMPTS,
+    )
+
+def build_lab_analyzer_agent():
+    """Build a rate-limited lab report analyzer agent."""
+    agent = lab_pipeline.create_lab_analyzer_agent(
+        GOOGLE_API_KEY, TAVILY_API_KEY, get_search_cache(), get_search_limiter()
+    )
+    return RateLimitedAgent(agent, get_model_limiter())
+
+def create_lab_analyzer_agent():
+    """Build a new lab report analyzer agent."""
+    return make_resilient(build_lab_analyzer_agent)
+
+def build_lifestyle_agent():
+    """Build a rate-limited lifestyle recommendations agent."""
+    agent = lab_pipeline.create_lifestyle_agent(
+        GOOGLE_API_KEY, TAVILY_API_KEY, get_search_cache(), get_search_limiter()
+    )
+    return RateLimitedAgent(agent, get_model_limiter())
+
+def create_lifestyle_agent():
+    """Build a new lifestyle recommendations agent."""
+    return make_resilient(build_lifestyle_agent)
+
+@st.cache_resource
+def get_recommendation_executor():
+    """Initialize and cache the thread pool used for per-section recommendations."""
+    return ThreadPoolExecutor(max_workers=RECOMMENDATION_WORKERS, thread_name_prefix="recommendations")
+
+@st.cache_resource
+def get_job_manager():
+    """Initialize and cache the background job runner shared by all sessions."""
+    executor = ThreadPoolExecutor(max_workers=ANALYSIS_JOB_WORKERS, thread_name_prefix="analysis-jobs")
+    return JobManager(executor)
+
+@st.cache_resource
+def get_pdf_process_pool():
+    """Initialize and cache the process pool that rasterizes PDF pages."""
+    return ProcessPoolExecutor(max_workers=PDF_RASTER_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
 @st.cache_resource
-def get_lifestyle_agent():
-    """Initialize and cache the lifestyle recommendations agent."""
+def get_pdf_page_executor():
+    """Initialize and cache the thread pool that bounds concurrent page analyses."""
+    return ThreadPoolExecutor(max_workers=PDF_PAGE_CONCURRENCY, thread_name_prefix="pdf-pages")
+
+@st.cache_resource
+def get_thumbnail_cache():
+    """Initialize and cache the bounded store of display thumbnails."""
+    return BoundedCache(max_entries=THUMBNAIL_CACHE_MAX_ENTRIES, max_bytes=THUMBNAIL_CACHE_MAX_BYTES)
+
+@st.cache_resource
+def get_pdf_cache():
+    """Initialize and cache the bounded store of generated PDF reports."""
+    return BoundedCache(max_entries=PDF_CACHE_MAX_ENTRIES, max_bytes=PDF_CACHE_MAX_BYTES)
+
+@st.cache_resource
+def get_analysis_cache():
+    """Initialize and cache the persistent analysis cache."""
     try:
-        return Agent(
-            model=Gemini(id="gemini-2.0-flash-exp", api_key=GOOGLE_API_KEY),
-            system_prompt=FOLLOW_UP_PROMPT,
-            tools=[TavilyTools(api_key=TAVILY_API_KEY)],
-            markdown=True,
+        return AnalysisCache(
+            CACHE_DB_PATH,
+            ttl_seconds=CACHE_TTL_SECONDS,
+            max_entries=CACHE_MAX_ENTRIES,
+            max_bytes=CACHE_MAX_BYTES,
         )
     except Exception as e:
-        st.error(f"❌ Error initializing lifestyle agent: {e}")
+        st.warning(f"🗄️ Analysis cache unavailable: {e}")
         return None
 
-def resize_image_for_display(image_file):
-    """Resize image for display only, returns bytes."""
+@st.cache_resource
+def get_search_cache():
+    """Initialize and cache the web search cache shared by all agents."""
     try:
-        image_file.seek(0)
-        img = Image.open(image_file)
-        image_file.seek(0)
-        
-        aspect_ratio = img.height / img.width
-        new_height = int(MAX_IMAGE_WIDTH * aspect_ratio)
-        img = img.resize((MAX_IMAGE_WIDTH, new_height), Image.Resampling.LANCZOS)
-        buf = BytesIO()
-        img.save(buf, format="PNG")
-        return buf.getvalue()
+        disk_cache = AnalysisCache(SEARCH_CACHE_DB_PATH, ttl_seconds=SEARCH_CACHE_TTL_SECONDS)
     except Exception as e:
-        st.error(f"🖼️ Error resizing image: {e}")
+        st.warning(f"🔎 Search results will only be cached in memory: {e}")
+        disk_cache = None
+    return SearchCache(disk_cache, ttl_seconds=SEARCH_CACHE_TTL_SECONDS)
+
+@st.cache_resource
+def get_near_duplicate_index():
+    """Initialize and cache the perceptual-hash index of analyzed uploads."""
+    if NEAR_DUPLICATE_SCOPE == "session":
+        # Session ids change when a browser reconnects, so session entries are not worth keeping
+        return NearDuplicateIndex()
+    try:
+        return NearDuplicateIndex(NEAR_DUPLICATE_DB_PATH)
+    except Exception as e:
+        st.warning(f"♻️ Similar uploads will only be recognized until the app restarts: {e}")
+        return NearDuplicateIndex()
+
+@st.cache_resource
+def get_blob_store():
+    """Initialize and cache the on-disk store of large session artifacts."""
+    return BlobStore(BLOB_STORE_PATH, max_bytes=BLOB_STORE_MAX_BYTES, session_max_bytes=SESSION_BLOB_MAX_BYTES)
+
+def get_session_id():
+    """Return the id of the current browser session."""
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else "local"
+
+def is_active_session(session_id):
+    """Return whether a browser is still connected to a session."""
+    return not runtime.exists() or runtime.get_instance().is_active_session(session_id)
+
+def save_artifact(name, data):
+    """Move a large session artifact to the blob store and keep only its handle in session state."""
+    if data is None:
+        st.session_state.artifacts.pop(name, None)
+        return
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    try:
+        st.session_state.artifacts[name] = get_blob_store().put(get_session_id(), name, data)
+    except BlobTooLargeError as e:
+        st.session_state.artifacts.pop(name, None)
+        st.warning(f"📦 {e}")
+
+def load_artifact(name, text=False):
+    """Return a session artifact from the blob store, or None if it was never stored or was evicted."""
+    data = get_blob_store().get(st.session_state.artifacts.get(name))
+    if data is not None and text:
+        return data.decode("utf-8")
+    return data
+
+def get_analysis_cache_key(file_bytes, user_profile):
+    """Build the cache key for an upload under the current model and prompts."""
+    return lab_pipeline.analysis_cache_key(file_bytes, user_profile)
+
+def get_profile_digest(user_profile):
+    """Hash a user profile, ignoring whitespace."""
+    return hash_text(" ".join((user_profile or "").split()))
+
+def get_image_hash(file_bytes):
+    """Return the perceptual hash of an image upload, or None if it cannot be hashed."""
+    try:
+        with span("perceptual_hash"):
+            return perceptual_hash(file_bytes)
+    except Exception:
         return None
 
-def analyze_lab_report(image_path):
-    """Analyze lab report from image and provide comprehensive insights."""
-    agent = get_lab_analyzer_agent()
-    if agent is None:
+def get_near_duplicate_scope():
+    """Return the scope near-duplicates are looked up in: this session, or None for every session."""
+    return get_session_id() if NEAR_DUPLICATE_SCOPE == "session" else None
+
+def find_near_duplicates(image_hash, user_profile):
+    """Return the cache keys of earlier uploads for this profile that look like this one, nearest first."""
+    matches = get_near_duplicate_index().find(
+        image_hash,
+        NEAR_DUPLICATE_MAX_DISTANCE,
+        scope=get_near_duplicate_scope(),
+        version=lab_pipeline.analysis_version(),
+    )
+    profile = get_profile_digest(user_profile)
+    # Across sessions, one upload can match once per session that analyzed it
+    return list(dict.fromkeys(match["cache_key"] for match in matches if match["profile"] == profile))
+
+def find_reusable_recommendations(raw_analysis, near_duplicates, user_profile):
+    """Return the recommendations of an earlier upload whose analysis read the same results, or None."""
+    analysis_cache = get_analysis_cache()
+    if analysis_cache is None:
         return None
+    with span("near_duplicate_check", candidates=len(near_duplicates)):
+        return lab_pipeline.find_reusable_recommendations(analysis_cache, raw_analysis, near_duplicates, user_profile)
 
+def resize_image_for_display(image_data):
+    """Resize image for display only, returns bytes cached by content hash."""
     try:
-        # Create animated progress indicator
-        progress_container = st.empty()
-        progress_container.markdown("""
-        <div class="progress-container">
-            <div class="loading-spinner"></div>
-            <strong>Analyzing your lab report...</strong>
-            <div class="progress-bar">
-                <div class="progress-fill"></div>
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
-        
-        response = agent.run(
-            "Analyze this lab report image and provide comprehensive health insights in simple, easy-to-understand language. Include all test values, explain abnormal results, and provide specific lifestyle and dietary recommendations.",
-            images=[image_path],
-        )
-        
-        progress_container.empty()
-        return response.content.strip()
+        cache_key = f"{hashlib.sha256(image_data).hexdigest()}:{MAX_IMAGE_WIDTH}"
+        with span("resize_image"):
+            return get_thumbnail_cache().get_or_create(
+                cache_key, lambda: create_thumbnail(image_data, MAX_IMAGE_WIDTH)
+            )
     except Exception as e:
-        st.error(f"🚨 Error analyzing lab report: {e}")
+        st.error(f"🖼️ Error resizing image: {e}")
         return None
 
-def get_detailed_recommendations(lab_analysis, user_profile):
-    """Get detailed lifestyle and dietary recommendations based on lab results."""
-    lifestyle_agent = get_lifestyle_agent()
-    if lifestyle_agent is None:
-        return None
+def store_analysis_results(raw_analysis):
+    """Keep the narrative and the structured results of an analysis in session state."""
+    narrative, lab_results, errors = lab_pipeline.extract_results(raw_analysis, st.session_state.user_profile)
+    save_artifact("analysis_results", narrative)
+    st.session_state.lab_results = lab_results
+    st.session_state.lab_result_errors = errors
 
+def run_analysis_job(job, file_bytes, is_pdf, user_profile, cache_key, report_image_handle, raw_analysis=None,
+                     near_duplicates=()):
+    """Analyze an upload and generate recommendations in a background job.
+    
+    Runs outside the script thread, so it must not call Streamlit; progress and partial
+    output are written to the job and rendered by show_job_progress. Sessions uploading the
+    same report share the job, so it holds nothing of the starting session's own: each
+    session records its near-duplicate entry and keeps its image when it applies the result.
+    """
+    def queue_reporter(stage):
+        return lambda position, waited: job.update(queue_position=position, queue_stage=stage)
+    
+    # The job id is the correlation id of every span the analysis records
+    with start_trace(job.id), span("analysis_job"):
+        usage = []
+        if raw_analysis is None:
+            job.update(stage="Analyzing your lab report...")
+            with report_queue_position(queue_reporter("the analysis")):
+                raw_analysis = lab_pipeline.analyze_report(
+                    create_lab_analyzer_agent,
+                    file_bytes,
+                    is_pdf=is_pdf,
+                    process_pool=get_pdf_process_pool(),
+                    page_executor=get_pdf_page_executor(),
+                    on_chunk=job.stream("analysis").append,
+                    usage=usage,
+                )
+            job.update(queue_position=None)
+    
+        recommendations = None
+        if near_duplicates:
+            recommendations = find_reusable_recommendations(raw_analysis, near_duplicates, user_profile)
+        complete = recommendations is not None
+        if recommendations is None:
+            job.update(stage="Creating personalized recommendations...")
+            executor = get_recommendation_executor() if PARALLEL_RECOMMENDATIONS else None
+            with report_queue_position(queue_reporter("your recommendations")):
+                recommendations, complete = lab_pipeline.generate_recommendations(
+                    create_lifestyle_agent,
+                    lab_pipeline.recommendation_findings(raw_analysis, user_profile),
+                    user_profile,
+                    executor,
+                    RECOMMENDATION_SECTION_TIMEOUT,
+                    buffers=[job.stream(title) for title, _ in RECOMMENDATION_SECTIONS],
+                    usage=usage,
+                )
+            job.update(queue_position=None)
+    
+        analysis_cache = get_analysis_cache()
+        if analysis_cache is not None:
+            # Partial recommendations ask the user to run the analysis again, which must not hit them
+            # in the cache; the analysis is kept so that run only generates recommendations
+            analysis_cache.put(cache_key, raw_analysis, recommendations if complete else None)
+        return {
+            "analysis": raw_analysis,
+            "recommendations": recommendations,
+            "complete": complete,
+            "report_image_handle": report_image_handle,
+            "usage": usage,
+        }
+
+def show_cached_results(cached, report_image):
+    """Show stored results for an upload instead of analyzing it again."""
+    store_analysis_results(cached["analysis"])
+    save_artifact("original_image", report_image)
+    st.session_state.results_prepared_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    st.session_state.analysis_complete = True
+    save_artifact("detailed_recommendations", cached["recommendations"])
+    st.session_state.token_usage = []
+    st.rerun()
+
+def start_analysis_job(file_bytes, is_pdf, cache_key, report_image, raw_analysis=None, image_hash=None,
+                       near_duplicates=()):
+    """Analyze an upload in the background (or only add recommendations to a cached analysis)."""
+    # Finished jobs are kept for a while; they hold a blob handle, not the image itself. The job's
+    # handle is only used by a session that reattaches to it after reconnecting
     try:
-        # Create animated progress indicator
-        progress_container = st.empty()
-        progress_container.markdown("""
-        <div class="progress-container">
-            <div class="loading-spinner"></div>
-            <strong>Creating personalized recommendations...</strong>
-            <div class="progress-bar">
-                <div class="progress-fill"></div>
-            </div>
+        report_image_handle = get_blob_store().put(get_session_id(), "pending_image", report_image)
+    except BlobTooLargeError as e:
+        report_image_handle = None
+        st.warning(f"📦 {e}")
+    st.session_state.pending_image_handle = report_image_handle
+    st.session_state.pending_image_hash = image_hash
+    job = get_job_manager().submit(
+        run_analysis_job,
+        file_bytes,
+        is_pdf,
+        st.session_state.user_profile,
+        cache_key,
+        report_image_handle,
+        raw_analysis=raw_analysis,
+        near_duplicates=near_duplicates,
+        key=cache_key,
+    )
+    st.session_state.job_id = job.id
+    st.session_state.job_error = None
+    st.query_params["job"] = job.id
+    st.success("✅ File uploaded successfully! Starting analysis...")
+
+def apply_job_result(job):
+    """Copy a finished job's results into this session, which may not be the one that started it."""
+    store_analysis_results(job.result["analysis"])
+    save_artifact("detailed_recommendations", job.result["recommendations"])
+    blob_store = get_blob_store()
+    report_image_handle = st.session_state.pending_image_handle or job.result["report_image_handle"]
+    save_artifact("original_image", blob_store.get(report_image_handle))
+    blob_store.remove(get_session_id(), "pending_image")
+    st.session_state.pending_image_handle = None
+    image_hash, st.session_state.pending_image_hash = st.session_state.pending_image_hash, None
+    if image_hash is not None and job.result["complete"] and get_analysis_cache() is not None:
+        # Recorded under this session's scope, for every session the job's result is applied in
+        get_near_duplicate_index().add(
+            image_hash,
+            job.key,
+            scope=get_near_duplicate_scope(),
+            profile=get_profile_digest(st.session_state.user_profile),
+            version=lab_pipeline.analysis_version(),
+        )
+    st.session_state.token_usage = job.result["usage"]
+    st.session_state.results_prepared_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    st.session_state.analysis_complete = True
+
+def detach_job():
+    """Stop following the current job in this session."""
+    st.session_state.job_id = None
+    if "job" in st.query_params:
+        del st.query_params["job"]
+
+@st.fragment(run_every=JOB_POLL_INTERVAL)
+def show_job_progress(job_id):
+    """Poll a background job, rendering its progress until it finishes."""
+    job = get_job_manager().get(job_id)
+    if job is None:
+        detach_job()
+        st.warning("⌛ This analysis is no longer available. Please run it again.")
+        return
+    
+    if job.status == DONE:
+        apply_job_result(job)
+        detach_job()
+        st.rerun()
+    if job.status == FAILED:
+        st.session_state.job_error = (job.error_type, job.error)
+        detach_job()
+        st.rerun()
+    
+    if job.status == QUEUED:
+        stage = "Waiting for a free analysis worker..."
+    else:
+        stage = job.stage or "Starting analysis..."
+    st.markdown(f"""
+    <div class="progress-container">
+        <div class="loading-spinner"></div>
+        <strong>{escape(stage)}</strong> <small>({job.elapsed:.0f}s)</small>
+        <div class="progress-bar">
+            <div class="progress-fill"></div>
+        </div>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    if job.queue_position:
+        st.info(
+            f"⏳ Many people are analyzing reports right now. "
+            f"You are #{job.queue_position} in line for {job.queue_stage or 'the analysis'}..."
+        )
+    
+    if not STREAM_RESPONSES:
+        return
+    analysis = job.stream_text("analysis")
+    if analysis:
+        st.markdown("""
+        <div class="custom-card">
+            <div class="section-title">🔬 Lab Report Analysis</div>
         </div>
         """, unsafe_allow_html=True)
-        
-        query = f"""
-        Based on this lab report analysis: {lab_analysis}
-        
-        User Profile: {user_profile}
-        
-        Provide detailed, personalized lifestyle and dietary recommendations including:
-        - Specific meal plans and recipes
-        - Detailed exercise routines
-        - Lifestyle modifications
-        - Natural remedies and supplements
-        - Monitoring and tracking tips
-        - Timeline for expected improvements
-        """
-        response = lifestyle_agent.run(query)
-        
-        progress_container.empty()
-        return response.content.strip()
-    except Exception as e:
-        st.error(f"🚨 Error generating recommendations: {e}")
-        return None
+        st.markdown(strip_structured_results(analysis) + " ▌")
+    sections = [
+        f"### {title}\n\n{job.stream_text(title)}"
+        for title, _ in RECOMMENDATION_SECTIONS
+        if job.stream_text(title)
+    ]
+    if sections:
+        st.markdown("""
+        <div class="custom-card">
+            <div class="section-title">🎯 Personalized Recommendations</div>
+        </div>
+        """, unsafe_allow_html=True)
+        st.markdown("\n\n".join(sections) + " ▌")
 
-def save_uploaded_file(uploaded_file):
-    """Save the uploaded file to disk."""
+def get_pdf_preview(pdf_data):
+    """Render the first page of a PDF as an image for display and the PDF report."""
     try:
-        file_extension = os.path.splitext(uploaded_file.name)[1]
-        
-        with NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-            temp_file.write(uploaded_file.getvalue())
-            temp_path = temp_file.name
-        return temp_path
+        cache_key = f"pdf-preview:{hashlib.sha256(pdf_data).hexdigest()}"
+        with span("pdf_preview"):
+            return get_thumbnail_cache().get_or_create(
+                cache_key, lambda: render_page(pdf_data, 0, dpi=PDF_PREVIEW_DPI)
+            )
     except Exception as e:
-        st.error(f"💾 Error saving uploaded file: {e}")
+        st.warning(f"📄 Could not render a preview of this PDF: {e}")
         return None
 
-def create_lab_report_pdf(image_data, analysis_results, detailed_recommendations=None, user_profile=None):
-    """Create a comprehensive PDF report of the lab analysis."""
-    try:
-        buffer = BytesIO()
-        pdf = SimpleDocTemplate(
-            buffer,
-            pagesize=letter,
-            rightMargin=72,
-            leftMargin=72,
-            topMargin=72,
-            bottomMargin=72
-        )
-        
-        content = []
-        
-        # Styles
-        styles = getSampleStyleSheet()
-        title_style = ParagraphStyle(
+@lru_cache(maxsize=1)
+def get_pdf_styles():
+    """Build the PDF paragraph styles once per process."""
+    # ReportLab is only loaded once someone downloads a report
+    from reportlab.lib import colors
+    from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+    
+    styles = getSampleStyleSheet()
+    return {
+        'title': ParagraphStyle(
             'Title',
             parent=styles['Title'],
             fontSize=18,
             alignment=1,
             spaceAfter=12,
             textColor=colors.navy
-        )
-        heading_style = ParagraphStyle(
+        ),
+        'heading': ParagraphStyle(
             'Heading',
             parent=styles['Heading2'],
             fontSize=14,
             textColor=colors.navy,
             spaceAfter=6
-        )
-        normal_style = ParagraphStyle(
+        ),
+        'body': ParagraphStyle(
             'Body',
             parent=styles['Normal'],
             fontSize=12,
             leading=14
-        )
-        disclaimer_style = ParagraphStyle(
+        ),
+        'disclaimer': ParagraphStyle(
             'Disclaimer',
             parent=styles['Normal'],
             fontSize=10,
@@ -741,7 +654,129 @@ def create_lab_report_pdf(image_data, analysis_results, detailed_recommendations
             borderPadding=5,
             backColor=colors.pink,
             alignment=1
+        ),
+        'footer': ParagraphStyle('Footer', parent=styles['Normal'], fontSize=8, textColor=colors.gray),
+        'table': ParagraphStyle('TableCell', parent=styles['Normal'], fontSize=9, leading=11),
+    }
+
+def get_pdf_cache_key(image_data, analysis_results, detailed_recommendations, user_profile, lab_results=None,
+                      prepared_at=None):
+    """Hash the inputs that determine the PDF report."""
+    digest = hashlib.sha256()
+    results = repr([result.as_tuple() for result in lab_results or []])
+    for part in (image_data or b"", analysis_results, detailed_recommendations, user_profile, results, prepared_at):
+        if isinstance(part, str) or part is None:
+            part = (part or "").encode("utf-8")
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+def get_session_report_pdf(pdf_cache, blob_store, handles, user_profile=None, lab_results=None, prepared_at=None):
+    """Return the PDF report for a session, reading its artifacts from the blob store when it is requested.
+
+    Runs when the download is requested, off the script thread; errors are raised so the
+    download fails visibly instead of delivering an empty file.
+    """
+    analysis_results = blob_store.get(handles.get("analysis_results"))
+    if analysis_results is None:
+        raise RuntimeError("The analysis was cleared to free up space. Please run it again.")
+    detailed_recommendations = blob_store.get(handles.get("detailed_recommendations"))
+    return get_lab_report_pdf(
+        pdf_cache,
+        blob_store.get(handles.get("original_image")),
+        analysis_results.decode("utf-8"),
+        detailed_recommendations.decode("utf-8") if detailed_recommendations else None,
+        user_profile,
+        lab_results,
+        prepared_at,
+    )
+
+def get_lab_report_pdf(pdf_cache, image_data, analysis_results, detailed_recommendations=None, user_profile=None,
+                       lab_results=None, prepared_at=None):
+    """Return the PDF report for these inputs, building it only on a cache miss."""
+    cache_key = get_pdf_cache_key(
+        image_data, analysis_results, detailed_recommendations, user_profile, lab_results, prepared_at
+    )
+    with span("pdf_report"):
+        return pdf_cache.get_or_create(
+            cache_key,
+            lambda: create_lab_report_pdf(
+                image_data, analysis_results, detailed_recommendations, user_profile, lab_results, prepared_at
+            ),
         )
+
+def format_reference_range(result):
+    """Return a readable reference range for a structured result."""
+    if result.reference_range:
+        return result.reference_range
+    if result.reference_low is not None and result.reference_high is not None:
+        return f"{result.reference_low:g}-{result.reference_high:g}"
+    if result.reference_high is not None:
+        return f"< {result.reference_high:g}"
+    if result.reference_low is not None:
+        return f"> {result.reference_low:g}"
+    return ""
+
+def create_results_table(lab_results, styles):
+    """Build a PDF table of the structured lab results."""
+    from reportlab.lib import colors
+    from reportlab.lib.units import inch
+    from reportlab.platypus import Paragraph, Table, TableStyle
+    
+    cell_style = styles['table']
+    rows = [["Test", "Value", "Unit", "Reference", "Status"]]
+    for result in lab_results:
+        rows.append([
+            Paragraph(escape(result.parameter), cell_style),
+            Paragraph(escape(result.value_text), cell_style),
+            Paragraph(escape(result.unit or ""), cell_style),
+            Paragraph(escape(format_reference_range(result)), cell_style),
+            result.flag,
+        ])
+    
+    table = Table(rows, colWidths=[2.0*inch, 0.9*inch, 0.9*inch, 1.3*inch, 0.9*inch], repeatRows=1)
+    table_style = [
+        ('BACKGROUND', (0, 0), (-1, 0), colors.navy),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.white),
+        ('FONTSIZE', (0, 0), (-1, -1), 9),
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.lightgrey),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+    ]
+    for row, result in enumerate(lab_results, start=1):
+        if result.is_abnormal:
+            table_style.append(('TEXTCOLOR', (4, row), (4, row), colors.red))
+    table.setStyle(TableStyle(table_style))
+    return table
+
+def create_lab_report_pdf(image_data, analysis_results, detailed_recommendations=None, user_profile=None,
+                          lab_results=None, prepared_at=None):
+    """Create a comprehensive PDF report of the lab analysis.
+    
+    prepared_at is the time shown on the report (now when not given); it is an input rather
+    than read here so that memoized reports are keyed by it.
+    """
+    from reportlab.lib.pagesizes import letter
+    from reportlab.lib.units import inch
+    from reportlab.platypus import Image as ReportLabImage, Paragraph, SimpleDocTemplate, Spacer
+    
+    try:
+        buffer = BytesIO()
+        pdf = SimpleDocTemplate(
+            buffer,
+            pagesize=letter,
+            rightMargin=72,
+            leftMargin=72,
+            topMargin=72,
+            bottomMargin=72
+        )
+        
+        content = []
+        
+        # Styles
+        styles = get_pdf_styles()
+        title_style = styles['title']
+        heading_style = styles['heading']
+        normal_style = styles['body']
+        disclaimer_style = styles['disclaimer']
         
         # Title
         content.append(Paragraph("🧪 LabAnalyzer - Comprehensive Lab Report Analysis", title_style))
@@ -756,8 +791,8 @@ def create_lab_report_pdf(image_data, analysis_results, detailed_recommendations
         content.append(Spacer(1, 0.25*inch))
         
         # Date and time
-        current_datetime = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        content.append(Paragraph(f"📅 Generated on: {current_datetime}", normal_style))
+        prepared_at = prepared_at or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        content.append(Paragraph(f"📅 Prepared on: {prepared_at}", normal_style))
         content.append(Spacer(1, 0.25*inch))
         
         # User profile
@@ -782,7 +817,13 @@ def create_lab_report_pdf(image_data, analysis_results, detailed_recommendations
                 content.append(img_obj)
                 content.append(Spacer(1, 0.25*inch))
             except Exception as img_error:
-                st.warning(f"Could not add image to PDF: {img_error}")
+                logger.warning("Could not add the report image to the PDF: %s", img_error)
+        
+        # Structured results table
+        if lab_results:
+            content.append(Paragraph("📋 Results at a Glance:", heading_style))
+            content.append(create_results_table(lab_results, styles))
+            content.append(Spacer(1, 0.25*inch))
         
         # Analysis results
         content.append(Paragraph("🔬 Lab Report Analysis:", heading_style))
@@ -801,66 +842,110 @@ def create_lab_report_pdf(image_data, analysis_results, detailed_recommendations
         # Footer
         content.append(Spacer(1, 0.5*inch))
         content.append(Paragraph("© 2025 LabAnalyzer - Medical Lab Report Analyzer | Powered by Gemini AI + Tavily", 
-                                ParagraphStyle('Footer', parent=styles['Normal'], fontSize=8, textColor=colors.gray)))
+                                styles['footer']))
         
         # Build PDF
         pdf.build(content)
         
         buffer.seek(0)
         return buffer.getvalue()
-    except Exception as e:
-        st.error(f"📄 Error creating PDF: {e}")
-        return None
+    except Exception:
+        logger.exception("Could not create the PDF report")
+        raise
 
-def display_health_status(value, reference_range, parameter_name):
-    """Display health status with enhanced styling and animations."""
-    try:
-        # Extract numeric value if possible
-        if isinstance(value, str):
-            numeric_value = float(re.findall(r'\d+\.?\d*', value)[0])
-        else:
-            numeric_value = float(value)
-        
-        # Parse reference range
-        if '-' in reference_range:
-            min_val, max_val = map(float, re.findall(r'\d+\.?\d*', reference_range))
-            
-            if numeric_value < min_val:
-                st.markdown(f"""
-                <div class="health-status low">
-                    <strong>🔻 {parameter_name}:</strong> {value} <span class="status-indicator status-warning">LOW</span>
-                    <br><small>Normal Range: {reference_range}</small>
-                </div>
-                """, unsafe_allow_html=True)
-            elif numeric_value > max_val:
-                st.markdown(f"""
-                <div class="health-status high">
-                    <strong>🔺 {parameter_name}:</strong> {value} <span class="status-indicator status-error">HIGH</span>
-                    <br><small>Normal Range: {reference_range}</small>
-                </div>
-                """, unsafe_allow_html=True)
-            else:
-                st.markdown(f"""
-                <div class="health-status normal">
-                    <strong>✅ {parameter_name}:</strong> {value} <span class="status-indicator status-success">NORMAL</span>
-                    <br><small>Normal Range: {reference_range}</small>
-                </div>
-                """, unsafe_allow_html=True)
-        else:
-            st.markdown(f"""
-            <div class="health-status normal">
-                <strong>ℹ️ {parameter_name}:</strong> {value}
-                <br><small>Reference: {reference_range}</small>
-            </div>
-            """, unsafe_allow_html=True)
-    except:
+def display_health_status(value, reference_range, parameter_name, status=None, parse_status=None):
+    """Display health status with enhanced styling and animations.
+    
+    Pass a precomputed status (from range_classifier.classify) when rendering a whole panel.
+    """
+    if status is None:
+        row = classify([value], [reference_range]).iloc[0]
+        status, parse_status = row["status"], row["parse_status"]
+    # The model's text goes into HTML
+    value, reference_range, parameter_name = (escape(str(text)) for text in (value, reference_range, parameter_name))
+    
+    if status == "LOW":
+        st.markdown(f"""
+        <div class="health-status low">
+            <strong>🔻 {parameter_name}:</strong> {value} <span class="status-indicator status-warning">LOW</span>
+            <br><small>Normal Range: {reference_range}</small>
+        </div>
+        """, unsafe_allow_html=True)
+    elif status in ("HIGH", "ABNORMAL"):
+        st.markdown(f"""
+        <div class="health-status high">
+            <strong>🔺 {parameter_name}:</strong> {value} <span class="status-indicator status-error">{status}</span>
+            <br><small>Normal Range: {reference_range}</small>
+        </div>
+        """, unsafe_allow_html=True)
+    elif status == "NORMAL":
+        st.markdown(f"""
+        <div class="health-status normal">
+            <strong>✅ {parameter_name}:</strong> {value} <span class="status-indicator status-success">NORMAL</span>
+            <br><small>Normal Range: {reference_range}</small>
+        </div>
+        """, unsafe_allow_html=True)
+    else:
+        note = PARSE_STATUS_NOTES.get(parse_status, "")
         st.markdown(f"""
         <div class="health-status normal">
             <strong>ℹ️ {parameter_name}:</strong> {value}
-            <br><small>Reference: {reference_range}</small>
+            <br><small>Reference: {reference_range}{note}</small>
         </div>
         """, unsafe_allow_html=True)
 
+def is_operator():
+    """Return whether this session opened the app with the operator token."""
+    token = st.query_params.get("operator")
+    return bool(OPERATOR_TOKEN and token) and hmac.compare_digest(str(token), str(OPERATOR_TOKEN))
+
+def format_seconds(seconds):
+    """Format a latency for the operator panel."""
+    if seconds is None:
+        return "–"
+    return f"{seconds * 1000:.0f} ms" if seconds < 1 else f"{seconds:.1f} s"
+
+@st.fragment(run_every=OPERATOR_PANEL_REFRESH)
+def show_operator_panel():
+    """Show live per-stage latencies from the tracer, refreshed without rerunning the page."""
+    tracer = get_tracer()
+    stats = tracer.stats()
+    if not stats:
+        st.caption("No spans recorded yet.")
+        return
+    rows = [
+        f"| {escape(stage)} | {stage_stats['count']} | {stage_stats['errors']} | "
+        f"{format_seconds(stage_stats['p50_seconds'])} | {format_seconds(stage_stats['p95_seconds'])} | "
+        f"{format_seconds(stage_stats['p99_seconds'])} |"
+        for stage, stage_stats in stats.items()
+    ]
+    st.markdown("| Stage | Count | Errors | p50 | p95 | p99 |\n|---|---:|---:|---:|---:|---:|\n" + "\n".join(rows))
+    st.download_button(
+        "📈 Download Prometheus metrics",
+        data=tracer.render_prometheus,
+        file_name="labanalyzer_metrics.prom",
+        mime="text/plain",
+    )
+
+def display_token_usage(calls):
+    """Show the tokens and time each model call of an analysis used."""
+    totals = summarize_usage(calls)
+    label = (
+        f"🧮 Model usage: {totals['input_tokens']:,} input + {totals['output_tokens']:,} output tokens "
+        f"in {totals['calls']} calls"
+    )
+    with st.expander(label, expanded=False):
+        lines = []
+        for call in calls:
+            line = (
+                f"- **{escape(call['stage'])}**: {call['input_tokens']:,} in • {call['output_tokens']:,} out • "
+                f"{call['seconds']:.1f}s"
+            )
+            if call.get("time_to_first_token") is not None:
+                line += f" (first token after {call['time_to_first_token']:.1f}s)"
+            lines.append(line)
+        st.markdown("\n".join(lines))
+
 def create_animated_header():
     """Create an animated header with modern styling."""
     st.markdown("""
@@ -873,16 +958,12 @@ def create_animated_header():
 def create_disclaimer_banner():
     """Create an animated disclaimer banner."""
     st.markdown("""
-    <div class="custom-card banner-warning">
-        <div style="display: flex; align-items: center; gap: 1rem;">
-            <div style="font-size: 2rem;">⚠️</div>
-            <div>
-                <h3 style="margin: 0; color: white;">MEDICAL DISCLAIMER</h3>
-                <p style="margin: 0.5rem 0 0 0; color: white; opacity: 0.9;">
-                    This tool provides educational information only and should not replace professional medical advice. 
-                    Always consult with your healthcare provider for proper medical interpretation and treatment decisions.
-                </p>
-            </div>
+    <div class="custom-card banner-warning banner-body">
+        <div class="banner-icon">⚠️</div>
+        <div>
+            <h3>MEDICAL DISCLAIMER</h3>
+            <p>This tool provides educational information only and should not replace professional medical advice.
+            Always consult with your healthcare provider for proper medical interpretation and treatment decisions.</p>
         </div>
     </div>
     """, unsafe_allow_html=True)
@@ -922,7 +1003,7 @@ def create_results_section():
 
 def display_file_info(uploaded_file):
     """Display file information with enhanced styling."""
-    file_size = len(uploaded_file.getvalue()) / 1024  # Convert to KB
+    file_size = uploaded_file.size / 1024  # Convert to KB
     st.markdown(f"""
     <div class="file-info">
         <div class="file-icon">📄</div>
@@ -935,105 +1016,72 @@ def display_file_info(uploaded_file):
 
 def create_health_tips_section():
     """Create animated health tips section."""
-    st.markdown("""
-    <div class="section-title">
-        🏥 Essential Health Guidelines
-    </div>
-    """, unsafe_allow_html=True)
-    
-    col1, col2, col3 = st.columns(3)
-    
-    with col1:
-        st.markdown("""
-        <div class="custom-card">
-            <div style="text-align: center; margin-bottom: 1rem;">
-                <div style="font-size: 3rem; margin-bottom: 0.5rem;">🥗</div>
-                <h3 style="color: var(--text-primary); margin-bottom: 1rem;">Nutrition Excellence</h3>
-            </div>
-            <ul style="color: var(--text-secondary); line-height: 1.6;">
-                <li>Consume 5-9 servings of colorful fruits and vegetables daily</li>
-                <li>Stay hydrated with 8-10 glasses of water throughout the day</li>
-                <li>Choose whole grains over refined carbohydrates</li>
-                <li>Limit processed foods and added sugars</li>
-                <li>Include healthy fats from nuts, seeds, and fish</li>
-            </ul>
-        </div>
-        """, unsafe_allow_html=True)
-    
-    with col2:
-        st.markdown("""
-        <div class="custom-card">
-            <div style="text-align: center; margin-bottom: 1rem;">
-                <div style="font-size: 3rem; margin-bottom: 0.5rem;">🏃</div>
-                <h3 style="color: var(--text-primary); margin-bottom: 1rem;">Active Lifestyle</h3>
-            </div>
-            <ul style="color: var(--text-secondary); line-height: 1.6;">
-                <li>Aim for 150 minutes of moderate exercise weekly</li>
-                <li>Include both cardiovascular and strength training</li>
-                <li>Take movement breaks every 30 minutes when sitting</li>
-                <li>Find physical activities you genuinely enjoy</li>
-                <li>Start slowly and gradually increase intensity</li>
-            </ul>
-        </div>
-        """, unsafe_allow_html=True)
-    
-    with col3:
-        st.markdown("""
-        <div class="custom-card">
-            <div style="text-align: center; margin-bottom: 1rem;">
-                <div style="font-size: 3rem; margin-bottom: 0.5rem;">😴</div>
-                <h3 style="color: var(--text-primary); margin-bottom: 1rem;">Wellness Habits</h3>
-            </div>
-            <ul style="color: var(--text-secondary); line-height: 1.6;">
-                <li>Get 7-9 hours of quality sleep nightly</li>
-                <li>Practice stress management techniques daily</li>
-                <li>Avoid smoking and limit alcohol consumption</li>
-                <li>Schedule regular preventive health checkups</li>
-                <li>Maintain strong social connections</li>
-            </ul>
-        </div>
-        """, unsafe_allow_html=True)
+    cards = "".join(
+        f'<div class="custom-card tip-card"><div class="tip-header"><div class="card-icon">{icon}</div>'
+        f'<h3 class="card-title">{title}</h3></div>'
+        f'<ul class="card-text">{"".join(f"<li>{tip}</li>" for tip in tips)}</ul></div>'
+        for icon, title, tips in HEALTH_TIPS
+    )
+    st.markdown(
+        f'<div class="section-title">🏥 Essential Health Guidelines</div><div class="card-grid">{cards}</div>',
+        unsafe_allow_html=True,
+    )
 
 def create_how_it_works_section():
     """Create an animated how it works section."""
+    cards = "".join(
+        f'<div class="custom-card clickable-card step-card"><div class="card-icon">{icon}</div>'
+        f'<h4 class="card-title">{title}</h4><p class="card-text">{description}</p></div>'
+        for icon, title, description in HOW_IT_WORKS_STEPS
+    )
+    st.markdown(
+        f'<div class="section-title">🔬 How LabAnalyzer Works</div><div class="card-grid">{cards}</div>',
+        unsafe_allow_html=True,
+    )
+
+def create_footer():
+    """Create the page footer."""
     st.markdown("""
-    <div class="section-title">
-        🔬 How LabAnalyzer Works
+    <div class="app-footer">
+        <hr>
+        <p>© 2025 LabAnalyzer - Medical Lab Report Analyzer</p>
+        <p class="footer-note">Powered by Gemini AI + Tavily | Built with ❤️ for Better Health</p>
     </div>
     """, unsafe_allow_html=True)
-    
-    steps = [
-        ("📤", "Upload", "Upload your lab report image in any common format"),
-        ("👤", "Profile", "Add your personal health details for customized insights"),
-        ("🤖", "AI Analysis", "Our advanced AI analyzes your results with medical precision"),
-        ("📊", "Insights", "Get simple explanations of your health status"),
-        ("🎯", "Recommendations", "Receive personalized lifestyle and dietary guidance"),
-        ("📄", "Report", "Download your complete health analysis as a PDF")
-    ]
-    
-    cols = st.columns(3)
-    for i, (icon, title, description) in enumerate(steps):
-        with cols[i % 3]:
-            st.markdown(f"""
-            <div class="custom-card clickable-card" style="text-align: center; margin-bottom: 1rem;">
-                <div style="font-size: 2.5rem; margin-bottom: 0.5rem;">{icon}</div>
-                <h4 style="color: var(--text-primary); margin-bottom: 0.5rem;">{title}</h4>
-                <p style="color: var(--text-secondary); font-size: 0.9rem; line-height: 1.4;">{description}</p>
-            </div>
-            """, unsafe_allow_html=True)
 
 def main():
     # Initialize session state
-    if 'analysis_results' not in st.session_state:
-        st.session_state.analysis_results = None
-    if 'detailed_recommendations' not in st.session_state:
-        st.session_state.detailed_recommendations = None
-    if 'original_image' not in st.session_state:
-        st.session_state.original_image = None
+    if 'artifacts' not in st.session_state:
+        # Handles into the blob store for the upload, analysis and recommendations
+        st.session_state.artifacts = {}
+    if 'lab_results' not in st.session_state:
+        st.session_state.lab_results = []
+    if 'lab_result_errors' not in st.session_state:
+        st.session_state.lab_result_errors = []
     if 'user_profile' not in st.session_state:
         st.session_state.user_profile = ""
     if 'analysis_complete' not in st.session_state:
         st.session_state.analysis_complete = False
+    if 'job_id' not in st.session_state:
+        # Reattach to a job started before the browser reconnected or in another tab
+        st.session_state.job_id = st.query_params.get("job")
+    if 'job_error' not in st.session_state:
+        st.session_state.job_error = None
+    if 'pending_image_handle' not in st.session_state:
+        # This session's upload and its perceptual hash while its job runs
+        st.session_state.pending_image_handle = None
+        st.session_state.pending_image_hash = None
+    if 'results_prepared_at' not in st.session_state:
+        # When the shown results were prepared; printed on the PDF report
+        st.session_state.results_prepared_at = None
+    if 'token_usage' not in st.session_state:
+        # What each model call of the last analysis cost
+        st.session_state.token_usage = []
+    
+    # Keep this session's artifacts alive and release those of sessions that have ended
+    blob_store = get_blob_store()
+    blob_store.touch(get_session_id())
+    blob_store.sweep(is_active_session)
 
     # Main container
     st.markdown('<div class="main-container">', unsafe_allow_html=True)
@@ -1041,12 +1089,23 @@ def main():
     # Header
     create_animated_header()
     
+    if is_operator():
+        with st.expander("🛠️ Operator: live stage latencies", expanded=True):
+            show_operator_panel()
+    
     # Disclaimer banner
     create_disclaimer_banner()
     
     # Main content
     col1, col2 = st.columns([1, 1], gap="large")
     
+    with col2:
+        # Results section
+        create_results_section()
+        
+        # Live output while an analysis is streaming in
+        live_results = st.container()
+    
     with col1:
         # Upload section
         create_upload_section()
@@ -1059,13 +1118,19 @@ def main():
         )
         
         if uploaded_file:
-            # Display uploaded image with enhanced styling
-            if uploaded_file.type.startswith('image/'):
-                resized_image = resize_image_for_display(uploaded_file)
+            # Single copy of the upload shared by analysis, session state and the PDF
+            with span("upload"):
+                file_bytes = uploaded_file.getvalue()
+                is_pdf = uploaded_file.type == "application/pdf"
+                report_image = get_pdf_preview(file_bytes) if is_pdf else file_bytes
+            
+            # Display uploaded image (or the first PDF page) with enhanced styling
+            if report_image:
+                resized_image = resize_image_for_display(report_image)
                 if resized_image:
                     st.markdown("""
-                    <div class="custom-card" style="text-align: center;">
-                        <h4 style="color: var(--text-primary); margin-bottom: 1rem;">📋 Your Lab Report</h4>
+                    <div class="custom-card report-preview">
+                        <h4 class="card-title">📋 Your Lab Report</h4>
                     """, unsafe_allow_html=True)
                     st.image(resized_image, width=MAX_IMAGE_WIDTH)
                     st.markdown("</div>", unsafe_allow_html=True)
@@ -1129,85 +1194,113 @@ def main():
         # Analyze button with enhanced styling
         if uploaded_file:
             st.markdown("<br>", unsafe_allow_html=True)
-            if st.button("🔬 Analyze Lab Report", type="primary", use_container_width=True):
-                # Save uploaded file and analyze
-                temp_path = save_uploaded_file(uploaded_file)
-                if temp_path:
-                    try:
-                        # Show success message
-                        st.success("✅ File uploaded successfully! Starting analysis...")
-                        
-                        # Analyze lab report
-                        analysis_result = analyze_lab_report(temp_path)
-                        
-                        if analysis_result:
-                            st.session_state.analysis_results = analysis_result
-                            st.session_state.original_image = uploaded_file.getvalue()
-                            st.session_state.analysis_complete = True
-                            
-                            # Get detailed recommendations
-                            detailed_recs = get_detailed_recommendations(analysis_result, st.session_state.user_profile)
-                            if detailed_recs:
-                                st.session_state.detailed_recommendations = detailed_recs
-                            
-                            # Show completion message
-                            st.markdown("""
-                            <div class="custom-card banner-success">
-                                <div style="display: flex; align-items: center; gap: 1rem;">
-                                    <div style="font-size: 2rem;">✅</div>
-                                    <div>
-                                        <h3 style="margin: 0; color: white;">Analysis Complete!</h3>
-                                        <p style="margin: 0.5rem 0 0 0; color: white; opacity: 0.9;">
-                                            Your lab report has been successfully analyzed. Check the results panel for detailed insights.
-                                        </p>
-                                    </div>
-                                </div>
-                            </div>
-                            """, unsafe_allow_html=True)
-                            
-                            # Auto-scroll to results (simulate)
-                            time.sleep(0.5)
-                            st.rerun()
-                        else:
-                            st.markdown("""
-                            <div class="custom-card banner-error">
-                                <div style="display: flex; align-items: center; gap: 1rem;">
-                                    <div style="font-size: 2rem;">❌</div>
-                                    <div>
-                                        <h3 style="margin: 0; color: white;">Analysis Failed</h3>
-                                        <p style="margin: 0.5rem 0 0 0; color: white; opacity: 0.9;">
-                                            Unable to analyze the lab report. Please try with a clearer image or different format.
-                                        </p>
-                                    </div>
-                                </div>
-                            </div>
-                            """, unsafe_allow_html=True)
-                        
-                    except Exception as e:
-                        st.markdown(f"""
-                        <div class="custom-card banner-error">
-                            <div style="display: flex; align-items: center; gap: 1rem;">
-                                <div style="font-size: 2rem;">🚨</div>
-                                <div>
-                                    <h3 style="margin: 0; color: white;">Analysis Error</h3>
-                                    <p style="margin: 0.5rem 0 0 0; color: white; opacity: 0.9;">
-                                        Analysis failed: {str(e)}
-                                    </p>
-                                </div>
-                            </div>
-                        </div>
-                        """, unsafe_allow_html=True)
-                    finally:
-                        # Clean up temp file
-                        if os.path.exists(temp_path):
-                            os.unlink(temp_path)
+            bypass_cache = st.checkbox(
+                "Run a fresh analysis (ignore cached results)",
+                value=False,
+                help="Skip previously stored results for this file and profile"
+            )
+            analysis_cache = get_analysis_cache()
+            analyze_clicked = st.button(
+                "🔬 Analyze Lab Report",
+                type="primary",
+                use_container_width=True,
+                disabled=bool(st.session_state.job_id),
+            )
+            if analyze_clicked:
+                cache_key = get_analysis_cache_key(file_bytes, st.session_state.user_profile)
+                cached = None
+                # While the model is failing, serve a stored result even if a fresh one was requested
+                model_unavailable = get_model_health().breaker.is_open
+                if analysis_cache is not None and (not bypass_cache or model_unavailable):
+                    cached = analysis_cache.get(cache_key)
+                    if cached and bypass_cache:
+                        st.info("⚡ The analysis service is having trouble, so your previous result is shown.")
+                
+                if cached and cached["recommendations"]:
+                    show_cached_results(cached, report_image)
+                
+                # A re-photographed or re-encoded copy of an analyzed report misses the cache; it is
+                # analyzed again, and the job compares its results with similar looking earlier uploads
+                image_hash = get_image_hash(file_bytes) if NEAR_DUPLICATE_REUSE and not is_pdf else None
+                near_duplicates = []
+                if cached is None and not bypass_cache and image_hash is not None:
+                    near_duplicates = find_near_duplicates(image_hash, st.session_state.user_profile)
+                start_analysis_job(
+                    file_bytes, is_pdf, cache_key, report_image,
+                    raw_analysis=cached["analysis"] if cached else None,
+                    image_hash=image_hash,
+                    near_duplicates=near_duplicates,
+                )
+            
+            if analysis_cache is not None:
+                cache_stats = analysis_cache.stats()
+                st.caption(
+                    f"🗄️ Cache: {cache_stats['hits']} hits • {cache_stats['misses']} misses • "
+                    f"{cache_stats['entries']} stored reports"
+                )
+            search_stats = get_search_cache().stats()
+            if search_stats["hits"] or search_stats["searches"]:
+                st.caption(
+                    f"🔎 Web searches: {search_stats['hit_rate']:.0%} served from cache • "
+                    f"{search_stats['searches']} live searches averaging {search_stats['average_search_seconds']:.1f}s"
+                )
+            session_stats = blob_store.session_stats(get_session_id())
+            if session_stats["artifacts"]:
+                store_stats = blob_store.stats()
+                st.caption(
+                    f"📦 This session: {session_stats['stored_bytes'] / 1024:.0f} KB on disk for "
+                    f"{session_stats['artifacts']} items • {len(store_stats['sessions'])} sessions using "
+                    f"{store_stats['stored_bytes'] / 1024 ** 2:.1f} MB"
+                )
+    
+    # Follow a running analysis; the fragment polls it without rerunning the whole page
+    if st.session_state.job_id:
+        with live_results:
+            show_job_progress(st.session_state.job_id)
+    elif st.session_state.job_error:
+        error_type, error = st.session_state.job_error
+        with live_results:
+            if error_type == "CircuitOpenError":
+                st.warning("⚡ The analysis service is having trouble right now. Please try again in a minute.")
+            else:
+                st.markdown(f"""
+                <div class="custom-card banner-error banner-body">
+                    <div class="banner-icon">🚨</div>
+                    <div>
+                        <h3>Analysis Failed</h3>
+                        <p>Unable to analyze the lab report ({escape(error)}). Please try with a clearer image or different format.</p>
+                    </div>
+                </div>
+                """, unsafe_allow_html=True)
+    
+    analysis_results = load_artifact("analysis_results", text=True)
+    detailed_recommendations = load_artifact("detailed_recommendations", text=True)
+    if st.session_state.analysis_complete and not analysis_results:
+        # The blob store evicted this session's results to stay within its quota
+        st.session_state.analysis_complete = False
+        st.session_state.lab_results = []
+        with live_results:
+            st.info("📦 Your previous analysis was cleared to free up space. Please run it again.")
     
     with col2:
-        # Results section
-        create_results_section()
-        
         # Display results if available
-        if st.session_state.analysis_results:
+        if analysis_results:
+            # Structured results at a glance
+            if st.session_state.lab_results:
+                st.markdown("""
+                <div class="custom-card">
+                    <div class="section-title">📋 Results at a Glance</div>
+                </div>
+                """, unsafe_allow_html=True)
+                classified = classify_results(st.session_state.lab_results)
+                for result, row in zip(st.session_state.lab_results, classified.itertuples()):
+                    value = f"{result.value_text} {result.unit or ''}".strip()
+                    display_health_status(
+                        value, format_reference_range(result), result.parameter, row.status, row.parse_status
+                    )
+                if st.session_state.lab_result_errors:
+                    st.caption(f"⚠️ {len(st.session_state.lab_result_errors)} results could not be read and are only in the analysis below.")
+            
             # Analysis results
             st.markdown("""
             <div class="custom-card">
@@ -1219,13 +1312,13 @@ def main():
             st.markdown(f"""
             <div class="custom-card">
                 <div style="color: var(--text-primary);">
-                    {st.session_state.analysis_results}
+                    {analysis_results}
                 </div>
             </div>
             """, unsafe_allow_html=True)
             
             # Display detailed recommendations if available
-            if st.session_state.detailed_recommendations:
+            if detailed_recommendations:
                 st.markdown("""
                 <div class="custom-card">
                     <div class="section-title">🎯 Personalized Recommendations</div>
@@ -1235,13 +1328,17 @@ def main():
                 st.markdown(f"""
                 <div class="custom-card">
                     <div style="color: var(--text-primary);">
-                        {st.session_state.detailed_recommendations}
+                        {detailed_recommendations}
                     </div>
                 </div>
                 """, unsafe_allow_html=True)
             
+            # What the analysis cost in model tokens
+            if st.session_state.token_usage:
+                display_token_usage(st.session_state.token_usage)
+            
             # PDF download section
-            if st.session_state.original_image:
+            if "original_image" in st.session_state.artifacts:
                 st.markdown("""
                 <div class="custom-card">
                     <div class="section-title">📄 Download Complete Report</div>
@@ -1251,33 +1348,36 @@ def main():
                 </div>
                 """, unsafe_allow_html=True)
                 
-                pdf_bytes = create_lab_report_pdf(
-                    st.session_state.original_image,
-                    st.session_state.analysis_results,
-                    st.session_state.detailed_recommendations,
-                    st.session_state.user_profile
+                # The PDF is only built when the download is requested, then memoized
+                pdf_bytes = partial(
+                    get_session_report_pdf,
+                    get_pdf_cache(),
+                    blob_store,
+                    dict(st.session_state.artifacts),
+                    st.session_state.user_profile,
+                    st.session_state.lab_results,
+                    st.session_state.results_prepared_at,
+                )
+                download_filename = f"lab_analysis_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
+                st.download_button(
+                    label="📥 Download Complete Health Report",
+                    data=pdf_bytes,
+                    file_name=download_filename,
+                    mime="application/pdf",
+                    help="Download a comprehensive PDF report with analysis and recommendations",
+                    type="primary",
+                    use_container_width=True
                 )
-                if pdf_bytes:
-                    download_filename = f"lab_analysis_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-                    st.download_button(
-                        label="📥 Download Complete Health Report",
-                        data=pdf_bytes,
-                        file_name=download_filename,
-                        mime="application/pdf",
-                        help="Download a comprehensive PDF report with analysis and recommendations",
-                        type="primary",
-                        use_container_width=True
-                    )
         else:
             # Placeholder with instructions
             st.markdown("""
-            <div class="custom-card" style="text-align: center; padding: 3rem 1rem;">
-                <div style="font-size: 4rem; margin-bottom: 1rem; opacity: 0.5;">📊</div>
-                <h3 style="color: var(--text-primary); margin-bottom: 1rem;">Ready for Analysis</h3>
-                <p style="color: var(--text-secondary); line-height: 1.6;">
+            <div class="custom-card placeholder-card">
+                <div class="card-icon">📊</div>
+                <h3 class="card-title">Ready for Analysis</h3>
+                <p class="card-text">
                     Upload your lab report image and click "Analyze Lab Report" to get:
                 </p>
-                <ul style="color: var(--text-secondary); text-align: left; margin: 1rem 0; line-height: 1.8;">
+                <ul class="card-text">
                     <li>✅ Easy-to-understand explanations of your results</li>
                     <li>🎯 Personalized health recommendations</li>
                     <li>🥗 Specific dietary and lifestyle advice</li>
@@ -1296,16 +1396,13 @@ def main():
     create_how_it_works_section()
     
     # Footer
-    st.markdown("""
-    <div style="text-align: center; margin-top: 3rem; padding: 2rem; color: var(--text-secondary);">
-        <hr style="border: none; height: 1px; background: var(--border-color); margin: 2rem 0;">
-        <p style="margin: 0;">© 2025 LabAnalyzer - Medical Lab Report Analyzer</p>
-        <p style="margin: 0.5rem 0 0 0; font-size: 0.9rem;">Powered by Gemini AI + Tavily | Built with ❤️ for Better Health</p>
-    </div>
-    """, unsafe_allow_html=True)
+    create_footer()
     
     # Close main container
     st.markdown('</div>', unsafe_allow_html=True)
 
 if __name__ == "__main__":
-    main()
+    get_metrics_server()
+    # Every script run gets its own correlation id; analysis jobs are traced under their job id
+    with start_trace(), span("script_run"):
+        main()
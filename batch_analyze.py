@@ -0,0 +1,343 @@
+"""Headless batch analysis of lab report files.
+
+Runs the same analysis and recommendations pipeline as the web app over a
+directory or manifest of reports, writing one JSON line per report. The output
+lines themselves record which files are finished (failures go to an append-only
+journal), so an interrupted run can be restarted with the same arguments and
+picks up where it stopped.
+
+Usage:
+    python batch_analyze.py reports/ --output results.jsonl --concurrency 4 --rpm 60
+
+API keys are read from the GOOGLE_API_KEY and TAVILY_API_KEY environment variables.
+With AGENT_CASSETTE_MODE=record the model calls are also saved to a cassette, and with
+AGENT_CASSETTE_MODE=replay they are answered from it without any API key (see cassette.py):
+    AGENT_CASSETTE_MODE=replay AGENT_REPLAY_SPEED=10 python batch_analyze.py reports/ --output replay.jsonl
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import lab_pipeline
+from analysis_cache import AnalysisCache
+from rate_limiter import FairRateLimiter, RateLimitedAgent
+from resilience import ResilientAgent, UpstreamHealth
+from prompt_builder import summarize_findings
+from search_cache import SearchCache
+from range_classifier import classify_results
+from cassette import get_cassette
+from token_usage import get_token_ledger, summarize_usage
+from tracing import get_tracer, span, start_trace
+
+REPORT_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".pdf"}
+MANIFEST_EXTENSIONS = {".txt", ".jsonl"}
+
+
+class JobJournal:
+    """Resume state of a batch run: the JSONL output of finished reports plus a journal of failures.
+
+    A report counts as done once its output line is written, so the line is the only record
+    of success and a crash cannot leave a report both written and due to be redone.
+    """
+
+    def __init__(self, path, output_path):
+        self.path = path
+        self.output_path = output_path
+        self.done = set()
+        self._lock = threading.Lock()
+        # Earlier runs also journaled finished reports
+        for entry in self._read(path):
+            if entry.get("status") == "done":
+                self.done.add((entry["file"], entry["sha256"]))
+        self._drop_partial_line(output_path)
+        for record in self._read(output_path):
+            if "sha256" in record:
+                self.done.add((record["file"], record["sha256"]))
+        self._file = open(path, "a", encoding="utf-8")
+        self._output = open(output_path, "a", encoding="utf-8")
+
+    @staticmethod
+    def _read(path):
+        if not os.path.exists(path):
+            return
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash can leave a partial last line behind
+                    continue
+
+    @staticmethod
+    def _drop_partial_line(path):
+        """Truncate a last line a crash left unfinished, so the next record starts on its own line."""
+        if not os.path.exists(path):
+            return
+        with open(path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def is_done(self, file, sha256):
+        return (file, sha256) in self.done
+
+    def write_result(self, record):
+        """Durably append a finished report's output line, which also marks it done."""
+        with self._lock:
+            self._output.write(json.dumps(record) + "\n")
+            self._output.flush()
+            os.fsync(self._output.fileno())
+            self.done.add((record["file"], record["sha256"]))
+
+    def record(self, file, sha256, status, error=None):
+        """Durably append the outcome for one report."""
+        entry = {"file": file, "sha256": sha256, "status": status, "time": time.time()}
+        if error:
+            entry["error"] = error
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+        self._output.close()
+
+
+class IncompleteRecommendationsError(RuntimeError):
+    """Some recommendation sections failed or timed out, so the report must be run again."""
+
+
+def discover_reports(inputs, default_profile):
+    """Expand directories and manifests into a list of (path, profile) pairs."""
+    reports = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                for name in sorted(files):
+                    if os.path.splitext(name)[1].lower() in REPORT_EXTENSIONS:
+                        reports.append((os.path.join(root, name), default_profile))
+        elif os.path.splitext(item)[1].lower() in MANIFEST_EXTENSIONS:
+            reports.extend(read_manifest(item, default_profile))
+        else:
+            reports.append((item, default_profile))
+    return [(os.path.abspath(path), profile) for path, profile in reports]
+
+
+def read_manifest(path, default_profile):
+    """Read a manifest of report paths (.txt) or {"path", "profile"} objects (.jsonl)."""
+    base = os.path.dirname(os.path.abspath(path))
+    reports = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if path.endswith(".jsonl"):
+                entry = json.loads(line)
+                report_path, profile = entry["path"], entry.get("profile", default_profile)
+            else:
+                report_path, profile = line, default_profile
+            reports.append((os.path.join(base, report_path), profile))
+    return reports
+
+
+def process_report(path, data, profile, pipeline):
+    """Analyze one report and return its output record.
+
+    Raises IncompleteRecommendationsError when recommendations were wanted but not every section
+    finished; the analysis is still cached, so the retry only redoes the recommendations.
+    """
+    started = time.perf_counter()
+    cache_key = lab_pipeline.analysis_cache_key(data, profile)
+    cached = pipeline["cache"].get(cache_key) if pipeline["cache"] is not None else None
+    usage = []
+
+    raw_analysis = cached["analysis"] if cached else lab_pipeline.analyze_report(
+        pipeline["create_analyzer"],
+        data,
+        is_pdf=path.lower().endswith(".pdf"),
+        process_pool=pipeline["process_pool"],
+        page_executor=pipeline["page_executor"],
+        usage=usage,
+    )
+    analysis, results, result_errors = lab_pipeline.extract_results(raw_analysis, profile)
+
+    recommendations = cached["recommendations"] if cached else None
+    complete = bool(recommendations) or pipeline["skip_recommendations"]
+    if not complete:
+        recommendations, complete = lab_pipeline.generate_recommendations(
+            pipeline["create_lifestyle"],
+            summarize_findings(results, analysis),
+            profile,
+            pipeline["section_executor"],
+            pipeline["section_timeout"],
+            usage=usage,
+        )
+    if pipeline["cache"] is not None and not (cached and cached["recommendations"]):
+        pipeline["cache"].put(cache_key, raw_analysis, recommendations if complete else None)
+    if not complete:
+        raise IncompleteRecommendationsError("some recommendation sections failed or timed out")
+
+    return {
+        "file": path,
+        "analysis": analysis,
+        "results": classify_results(results).to_dict(orient="records") if results else [],
+        "result_errors": result_errors,
+        "recommendations": recommendations,
+        "cached": bool(cached),
+        "usage": summarize_usage(usage),
+        "elapsed_s": round(time.perf_counter() - started, 3),
+    }
+
+
+def run_batch(args):
+    """Process every pending report and print a throughput summary."""
+    reports = discover_reports(args.inputs, args.profile)
+    journal = JobJournal(args.journal or args.output + ".journal", args.output)
+    limiter = FairRateLimiter(rpm=args.rpm, tpm=args.tpm, name="gemini")
+    google_api_key = os.environ.get("GOOGLE_API_KEY")
+    tavily_api_key = os.environ.get("TAVILY_API_KEY")
+    search_cache = SearchCache(AnalysisCache(args.search_cache) if args.search_cache else None)
+    search_limiter = FairRateLimiter(rpm=args.search_rpm, name="tavily")
+    health = UpstreamHealth("Gemini")
+
+    def resilient(create_agent):
+        def build():
+            return RateLimitedAgent(
+                create_agent(google_api_key, tavily_api_key, search_cache, search_limiter), limiter
+            )
+        return lambda: ResilientAgent(
+            build(), create_agent=build, health=health, attempt_timeout=args.call_timeout, max_attempts=args.attempts
+        )
+
+    pipeline = {
+        "create_analyzer": resilient(lab_pipeline.create_lab_analyzer_agent),
+        "create_lifestyle": resilient(lab_pipeline.create_lifestyle_agent),
+        "process_pool": ProcessPoolExecutor(
+            max_workers=args.pdf_workers, mp_context=multiprocessing.get_context("spawn")
+        ),
+        "page_executor": ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="pdf-pages"),
+        "section_executor": ThreadPoolExecutor(
+            max_workers=args.concurrency * len(lab_pipeline.RECOMMENDATION_SECTIONS),
+            thread_name_prefix="recommendations",
+        ),
+        "section_timeout": args.section_timeout,
+        "skip_recommendations": args.skip_recommendations,
+        "cache": AnalysisCache(args.cache) if args.cache else None,
+    }
+
+    counts = {"done": 0, "failed": 0, "skipped": 0}
+    started = time.monotonic()
+
+    def handle(path, profile):
+        sha256 = None
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            sha256 = hashlib.sha256(data).hexdigest()
+            if journal.is_done(path, sha256):
+                return "skipped", path, None
+            with start_trace(sha256[:32]), span("report", file=path):
+                record = process_report(path, data, profile, pipeline)
+        except Exception as e:
+            journal.record(path, sha256, "failed", error=str(e))
+            return "failed", path, e
+        record["sha256"] = sha256
+        journal.write_result(record)
+        return "done", path, None
+
+    executor = ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="reports")
+    try:
+        futures = [executor.submit(handle, path, profile) for path, profile in reports]
+        for future in as_completed(futures):
+            status, path, error = future.result()
+            counts[status] += 1
+            if status == "failed":
+                print(f"FAILED {path}: {error}", file=sys.stderr)
+            elif status == "done" and not args.quiet:
+                print(f"done   {path}", file=sys.stderr)
+    except KeyboardInterrupt:
+        print("Interrupted; finished reports are in the output and will be skipped on the next run.", file=sys.stderr)
+        executor.shutdown(wait=False, cancel_futures=True)
+    else:
+        executor.shutdown()
+    finally:
+        journal.close()
+        pipeline["process_pool"].shutdown(cancel_futures=True)
+        pipeline["page_executor"].shutdown(wait=False)
+        pipeline["section_executor"].shutdown(wait=False)
+
+    elapsed = time.monotonic() - started
+    throughput = counts["done"] / (elapsed / 60) if elapsed else 0.0
+    print(
+        f"{counts['done']} analyzed, {counts['failed']} failed, {counts['skipped']} already done "
+        f"in {elapsed:.1f}s ({throughput:.1f} reports/minute)"
+    )
+    limiter_stats = limiter.stats()
+    health_stats = health.stats()
+    p95 = health_stats["latency"]["p95_seconds"]
+    print(
+        f"model calls: {limiter_stats['acquired']}, average wait {limiter_stats['average_wait_seconds']:.1f}s, "
+        f"longest wait {limiter_stats['max_wait_seconds']:.1f}s, p95 latency {p95 or 0:.1f}s, "
+        f"{health_stats['retries']} retries, {health_stats['hedges']} hedged, {health_stats['timeouts']} timed out, "
+        f"circuit opened {health_stats['breaker']['times_opened']} times"
+    )
+    token_stats = get_token_ledger().stats()
+    print(f"tokens: {token_stats['input_tokens']:,} input, {token_stats['output_tokens']:,} output")
+    for stage, totals in sorted(token_stats["stages"].items()):
+        print(
+            f"  {stage}: {totals['calls']} calls, {totals['input_tokens'] / totals['calls']:,.0f} input and "
+            f"{totals['output_tokens'] / totals['calls']:,.0f} output tokens per call"
+        )
+    print("stage latency (p50 / p95 / p99):")
+    for stage, stats in get_tracer().stats().items():
+        print(
+            f"  {stage}: {stats['count']} runs, {stats['p50_seconds'] or 0:.2f}s / "
+            f"{stats['p95_seconds'] or 0:.2f}s / {stats['p99_seconds'] or 0:.2f}s, {stats['errors']} errors"
+        )
+    search_stats = search_cache.stats()
+    print(
+        f"web searches: {search_stats['searches']} live, {search_stats['hits']} from cache "
+        f"({search_stats['hit_rate']:.0%} hit rate)"
+    )
+    cassette = get_cassette()
+    if cassette is not None:
+        cassette_stats = cassette.stats()
+        print(
+            f"cassette {cassette_stats['path']}: {cassette_stats['recorded']} calls recorded, "
+            f"{cassette_stats['replayed']} replayed, {cassette_stats['misses']} not found"
+        )
+    return 1 if counts["failed"] else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Analyze lab report files without the web UI.")
+    parser.add_argument("inputs", nargs="+", help="report files, directories, or manifests (.txt or .jsonl)")
+    parser.add_argument("--output", "-o", default="results.jsonl", help="JSONL file results are appended to")
+    parser.add_argument("--journal", help="resume journal (default: <output>.journal)")
+    parser.add_argument("--concurrency", "-c", type=int, default=4, help="reports analyzed at the same time")
+    parser.add_argument("--rpm", type=float, default=60, help="maximum model requests per minute (0 for no limit)")
+    parser.add_argument("--tpm", type=float, default=0, help="maximum model tokens per minute (0 for no limit)")
+    parser.add_argument("--search-rpm", type=float, default=100, help="maximum web searches per minute (0 for no limit)")
+    parser.add_argument("--call-timeout", type=float, default=60, help="seconds a model call may go without output")
+    parser.add_argument("--attempts", type=int, default=3, help="attempts per model call for retryable errors")
+    parser.add_argument("--profile", default="", help="user profile text used for every report")
+    parser.add_argument("--section-timeout", type=float, default=45, help="seconds allowed per recommendations section")
+    parser.add_argument("--pdf-workers", type=int, default=4, help="processes used to read PDF pages")
+    parser.add_argument("--cache", help="path of an analysis cache database to read and fill")
+    parser.add_argument("--search-cache", help="path of a database that keeps web search results between runs")
+    parser.add_argument("--skip-recommendations", action="store_true", help="only run the analyzer")
+    parser.add_argument("--quiet", "-q", action="store_true", help="only report failures and the summary")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(run_batch(parse_args()))
@@ -0,0 +1,343 @@
+"""Local stand-ins for Gemini and Tavily, and synthetic lab reports, for offline benchmarks.
+
+FakeBackend builds agents with the same run() interface as phidata agents: they
+sleep for a configurable latency, stream or return a reply of a configurable size
+(the analyzer's ends with a structured results block, as the real prompt asks for),
+report token metrics and run web searches through the real CachedTavilyTools with a
+fake Tavily client. Nothing leaves the machine and no API key is needed.
+"""
+
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from io import BytesIO
+
+from lab_results import RESULTS_MARKER
+
+# parameter, unit, reference low, reference high
+SAMPLE_TESTS = [
+    ("Hemoglobin", "g/dL", 13.5, 17.5),
+    ("Hematocrit", "%", 41, 53),
+    ("White Blood Cells", "x10^3/uL", 4.5, 11),
+    ("Platelets", "x10^3/uL", 150, 400),
+    ("Glucose", "mg/dL", 70, 99),
+    ("HbA1c", "%", 4, 5.6),
+    ("Total Cholesterol", "mg/dL", 125, 200),
+    ("LDL Cholesterol", "mg/dL", 0, 100),
+    ("HDL Cholesterol", "mg/dL", 40, 60),
+    ("Triglycerides", "mg/dL", 0, 150),
+    ("Creatinine", "mg/dL", 0.7, 1.3),
+    ("Urea", "mg/dL", 7, 20),
+    ("Sodium", "mmol/L", 135, 145),
+    ("Potassium", "mmol/L", 3.5, 5.1),
+    ("ALT", "U/L", 7, 56),
+    ("AST", "U/L", 10, 40),
+    ("TSH", "mIU/L", 0.4, 4),
+    ("Vitamin D", "ng/mL", 30, 100),
+    ("Vitamin B12", "pg/mL", 200, 900),
+    ("Ferritin", "ng/mL", 24, 336),
+]
+
+SAMPLE_PROFILE = """
+Age: 45
+Gender: Female
+Activity Level: Light (1-3 days/week)
+Current Health Conditions: Hypertension
+Current Medications: Lisinopril 10mg
+Dietary Preferences: Vegetarian
+"""
+
+FILLER_SENTENCE = (
+    "This value is explained in plain language together with what it may mean for "
+    "everyday health and which changes could help. "
+)
+
+
+def report_rows(count=20, seed=0):
+    """Return `count` synthetic results, about a third of them outside their reference range."""
+    rng = random.Random(seed)
+    rows = []
+    for index in range(count):
+        parameter, unit, low, high = SAMPLE_TESTS[index % len(SAMPLE_TESTS)]
+        if index >= len(SAMPLE_TESTS):
+            parameter = f"{parameter} ({index // len(SAMPLE_TESTS) + 1})"
+        span = high - low
+        if rng.random() < 0.33:
+            value = rng.choice([low - span * rng.uniform(0.05, 0.3), high + span * rng.uniform(0.05, 0.3)])
+        else:
+            value = rng.uniform(low, high)
+        value = round(max(value, 0), 1)
+        flag = "LOW" if value < low else "HIGH" if value > high else "NORMAL"
+        rows.append({
+            "parameter": parameter,
+            "value": value,
+            "unit": unit,
+            "reference_low": low,
+            "reference_high": high,
+            "reference_range": f"{low}-{high}",
+            "flag": flag,
+        })
+    return rows
+
+
+def _font(size):
+    from PIL import ImageFont
+
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+def draw_report_page(width=1240, rows=20, seed=0, page=1):
+    """Draw one page of a lab report as a PIL image `width` pixels wide (A4 proportions)."""
+    from PIL import Image, ImageDraw
+
+    height = int(width * 1.414)
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    margin = width // 12
+    line = max(height // 48, 12)
+    font = _font(max(line * 2 // 3, 10))
+    draw.text((margin, margin), f"City Diagnostics Laboratory - page {page}", fill="black", font=font)
+    draw.text((margin, margin + line), "Patient: Jane Doe    Sample: 2024-03-01", fill="black", font=font)
+    columns = [margin, int(width * 0.42), int(width * 0.58), int(width * 0.75)]
+    top = margin + line * 3
+    for x, title in zip(columns, ("Test", "Result", "Unit", "Reference")):
+        draw.text((x, top), title, fill="black", font=font)
+    draw.line((margin, top + line, width - margin, top + line), fill="black", width=2)
+    for index, row in enumerate(report_rows(rows, seed)):
+        y = top + line * (index + 2)
+        if y > height - margin:
+            break
+        cells = (row["parameter"], str(row["value"]), row["unit"], row["reference_range"])
+        for x, text in zip(columns, cells):
+            draw.text((x, y), text, fill="red" if row["flag"] != "NORMAL" and x == columns[1] else "black", font=font)
+    return image
+
+
+def make_report_image(width=1240, rows=20, seed=0, image_format="JPEG", quality=90):
+    """Return a synthetic photographed report as encoded image bytes."""
+    output = BytesIO()
+    draw_report_page(width, rows, seed).save(output, format=image_format, quality=quality)
+    return output.getvalue()
+
+
+def make_report_pdf(pages=3, rows=20, seed=0, scanned=False, width=1240):
+    """Return a synthetic multi-page report PDF.
+
+    Text PDFs carry a text layer (like lab portal downloads); scanned PDFs hold one
+    image per page and need rendering and a vision call per page.
+    """
+    output = BytesIO()
+    if scanned:
+        images = [draw_report_page(width, rows, seed + page, page + 1) for page in range(pages)]
+        images[0].save(output, format="PDF", save_all=True, append_images=images[1:], resolution=150)
+        return output.getvalue()
+
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
+    pdf = canvas.Canvas(output, pagesize=A4)
+    _, height = A4
+    for page in range(pages):
+        pdf.setFont("Helvetica-Bold", 12)
+        pdf.drawString(50, height - 50, f"City Diagnostics Laboratory - page {page + 1}")
+        pdf.setFont("Helvetica", 10)
+        for index, row in enumerate(report_rows(rows, seed + page)):
+            y = height - 90 - index * 16
+            if y < 50:
+                break
+            pdf.drawString(50, y, row["parameter"])
+            pdf.drawString(250, y, f"{row['value']} {row['unit']}")
+            pdf.drawString(400, y, f"{row['reference_range']} {row['unit']}")
+        pdf.showPage()
+    pdf.save()
+    return output.getvalue()
+
+
+def analysis_reply(rows=20, chars=3000, seed=0):
+    """Return an analyzer answer of about `chars` characters followed by its structured results block."""
+    results = report_rows(rows, seed)
+    lines = ["## Lab Report Analysis", ""]
+    for row in results:
+        lines.append(f"- **{row['parameter']}**: {row['value']} {row['unit']} ({row['flag']})")
+    text = "\n".join(lines) + "\n\n"
+    if len(text) < chars:
+        text += (FILLER_SENTENCE * (chars // len(FILLER_SENTENCE) + 1))[: chars - len(text)]
+    return f"{text}\n\n{RESULTS_MARKER}\n```json\n{json.dumps(results)}\n```"
+
+
+def recommendations_reply(chars=1500):
+    """Return a recommendations answer of about `chars` characters."""
+    body = (FILLER_SENTENCE * (chars // len(FILLER_SENTENCE) + 1))[:chars]
+    return f"- {body}\n- Review these suggestions with your doctor."
+
+
+class FakeResponse:
+    """The parts of a phidata RunResponse the pipeline reads."""
+
+    def __init__(self, content, metrics=None):
+        self.content = content
+        self.metrics = metrics or {}
+
+
+class FakeAgent:
+    """Answers agent.run() with a canned reply after a simulated model latency.
+
+    Token counts are estimated at four characters per token, plus a fixed cost
+    per image; `searches` web searches are run through the agent's tools first.
+    """
+
+    IMAGE_TOKENS = 258
+
+    def __init__(self, reply, latency=0.5, jitter=0.0, first_token_ratio=0.2, chunk_chars=64,
+                 tools=(), searches=0, seed=None):
+        self.reply = reply
+        self.latency = latency
+        self.jitter = jitter
+        self.first_token_ratio = first_token_ratio
+        self.chunk_chars = chunk_chars
+        self.tools = list(tools)
+        self.searches = searches
+        self.rng = random.Random(seed)
+        self.run_response = FakeResponse("")
+
+    def _latency(self):
+        return max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+
+    def _metrics(self, message, images, first_token):
+        input_tokens = len(message) // 4 + self.IMAGE_TOKENS * len(images or [])
+        return {
+            "input_tokens": [input_tokens],
+            "output_tokens": [len(self.reply) // 4],
+            "time": [first_token],
+            "time_to_first_token": [first_token],
+        }
+
+    def _search(self, message):
+        query = " ".join(message.split()[:12])
+        for index in range(self.searches):
+            for tool in self.tools:
+                search = getattr(tool, "web_search_using_tavily", None)
+                if search is not None:
+                    search(f"{query} {index}")
+
+    def run(self, message, stream=False, images=None, **kwargs):
+        self._search(message)
+        latency = self._latency()
+        first_token = latency * self.first_token_ratio
+        metrics = self._metrics(message, images, first_token)
+        if not stream:
+            time.sleep(latency)
+            self.run_response = FakeResponse(self.reply, metrics)
+            return self.run_response
+        return self._stream(latency, first_token, metrics)
+
+    def _stream(self, latency, first_token, metrics):
+        self.run_response = FakeResponse("", metrics)
+        chunks = [self.reply[i:i + self.chunk_chars] for i in range(0, len(self.reply), self.chunk_chars)]
+        time.sleep(first_token)
+        delay = (latency - first_token) / max(len(chunks), 1)
+        for chunk in chunks:
+            time.sleep(delay)
+            yield FakeResponse(chunk)
+        self.run_response = FakeResponse(self.reply, metrics)
+
+
+class FakeTavilyClient:
+    """Answers TavilyClient.search() with `results` made-up results after a simulated latency."""
+
+    def __init__(self, latency=0.3, result_chars=500):
+        self.latency = latency
+        self.result_chars = result_chars
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def search(self, query, max_results=5, **kwargs):
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.latency)
+        content = (FILLER_SENTENCE * (self.result_chars // len(FILLER_SENTENCE) + 1))[: self.result_chars]
+        return {
+            "query": query,
+            "answer": f"Summary for {query}",
+            "results": [
+                {"title": f"{query} ({index + 1})", "url": f"https://example.org/{index}", "content": content,
+                 "score": 1 - index / 10}
+                for index in range(max_results)
+            ],
+        }
+
+
+class FakeBackend:
+    """Builds fake analyzer and lifestyle agents with the signatures of the lab_pipeline factories."""
+
+    def __init__(self, model_latency=0.5, model_jitter=0.1, analysis_chars=3000, recommendation_chars=1500,
+                 result_rows=20, search_latency=0.3, searches_per_call=0, seed=0):
+        self.model_latency = model_latency
+        self.model_jitter = model_jitter
+        self.analysis_chars = analysis_chars
+        self.recommendation_chars = recommendation_chars
+        self.result_rows = result_rows
+        self.searches_per_call = searches_per_call
+        self.seed = seed
+        self.tavily = FakeTavilyClient(latency=search_latency)
+        self._agents = 0
+        self._lock = threading.Lock()
+
+    def _next_seed(self):
+        with self._lock:
+            self._agents += 1
+            return self.seed * 100003 + self._agents
+
+    def _tools(self, search_cache, search_limiter):
+        if not self.searches_per_call:
+            return []
+        from agent_tools import CachedTavilyTools
+        from search_cache import SearchCache
+
+        tools = CachedTavilyTools(
+            cache=search_cache if search_cache is not None else SearchCache(),
+            limiter=search_limiter,
+            api_key="offline",
+        )
+        tools.client = self.tavily
+        return [tools]
+
+    def create_lab_analyzer_agent(self, google_api_key=None, tavily_api_key=None, search_cache=None,
+                                  search_limiter=None):
+        return FakeAgent(
+            analysis_reply(self.result_rows, self.analysis_chars, self.seed),
+            latency=self.model_latency,
+            jitter=self.model_jitter,
+            tools=self._tools(search_cache, search_limiter),
+            searches=self.searches_per_call,
+            seed=self._next_seed(),
+        )
+
+    def create_lifestyle_agent(self, google_api_key=None, tavily_api_key=None, search_cache=None,
+                               search_limiter=None):
+        return FakeAgent(
+            recommendations_reply(self.recommendation_chars),
+            latency=self.model_latency,
+            jitter=self.model_jitter,
+            tools=self._tools(search_cache, search_limiter),
+            searches=self.searches_per_call,
+            seed=self._next_seed(),
+        )
+
+    @contextmanager
+    def installed(self):
+        """Make lab_pipeline (and so the app and batch runner) build fake agents while active."""
+        import lab_pipeline
+
+        originals = lab_pipeline.create_lab_analyzer_agent, lab_pipeline.create_lifestyle_agent
+        lab_pipeline.create_lab_analyzer_agent = self.create_lab_analyzer_agent
+        lab_pipeline.create_lifestyle_agent = self.create_lifestyle_agent
+        try:
+            yield self
+        finally:
+            lab_pipeline.create_lab_analyzer_agent, lab_pipeline.create_lifestyle_agent = originals
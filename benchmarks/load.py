@@ -0,0 +1,420 @@
+"""Load test: many simulated users of app2.py in one process, at increasing concurrency.
+
+Each simulated session uses Streamlit's AppTest to open the app, upload a
+synthetic report, fill in the profile, start the analysis, poll until it
+finishes (as the browser does) and download the PDF report. Gemini and Tavily
+are the local fakes from benchmarks/fakes.py. Sessions share the process and
+its cached resources (job pool, rate limiters, caches, blob store) the way
+sessions share a replica. There is no websocket, so serialization and network
+time are not included.
+
+For each concurrency level this reports rerun latency percentiles by step,
+session duration, CPU use, peak resident memory growth per session, and the
+first level where p95 rerun latency degrades past a multiple of the
+single-session p95.
+
+Usage:
+    python benchmarks/load.py
+    python benchmarks/load.py --levels 1,4,16,32 --model-latency 2 --json
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from unittest.mock import MagicMock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fakes import FakeBackend, make_report_image  # noqa: E402
+
+APP_PATH = os.path.join(ROOT, "app2.py")
+
+CONCURRENCY_LEVELS = (1, 2, 4, 8, 16)
+# p95 rerun latency this many times the single-session p95 counts as degraded
+DEGRADATION_FACTOR = 2.0
+# Seconds between reruns while an analysis is running, like the job progress poll
+POLL_INTERVAL = 0.5
+SESSION_TIMEOUT = 300
+
+# Limits high enough that the rate limiters never hold back the simulated users
+SECRETS = {
+    "GOOGLE_API_KEY": "load-test",
+    "TAVILY_API_KEY": "load-test",
+    "GEMINI_RPM": 1_000_000,
+    "GEMINI_TPM": 1_000_000_000,
+    "TAVILY_RPM": 1_000_000,
+}
+
+STEPS = ("open", "upload", "profile", "analyze", "poll", "download")
+
+# The session id the current thread's AppTest runs get
+current_session = threading.local()
+
+
+def percentile(samples, percent):
+    """Return the nearest-rank percentile of a list of samples, or None without samples."""
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+def resident_mb():
+    """Return the current resident set size of the process in MB (the peak where /proc is missing)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class MemorySampler:
+    """Samples resident memory on a background thread and keeps the peak."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = resident_mb()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="memory-sampler", daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, resident_mb())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, resident_mb())
+
+
+class DeferredDownloads:
+    """Keeps the callables behind deferred download buttons so sessions can "click" them.
+
+    In a browser the click asks the server to run the callable; AppTest has no
+    server, so the harness records each callable by file id and runs it itself.
+    """
+
+    def __init__(self):
+        self.callables = {}
+        self._lock = threading.Lock()
+        self._original = None
+
+    def install(self):
+        from streamlit.runtime.media_file_manager import MediaFileManager
+
+        self._original = original = MediaFileManager.add_deferred
+        downloads = self
+
+        def add_deferred(manager, data_callable, *args, **kwargs):
+            file_id = original(manager, data_callable, *args, **kwargs)
+            with downloads._lock:
+                downloads.callables[file_id] = data_callable
+            return file_id
+
+        MediaFileManager.add_deferred = add_deferred
+
+    def uninstall(self):
+        from streamlit.runtime.media_file_manager import MediaFileManager
+
+        MediaFileManager.add_deferred = self._original
+
+    def fetch(self, file_id):
+        with self._lock:
+            data_callable = self.callables.pop(file_id)
+        return data_callable()
+
+
+@contextmanager
+def shared_app_test_state(secrets=SECRETS):
+    """Let AppTest sessions run concurrently in one process, as sessions do on a server.
+
+    AppTest assumes one app at a time: each run installs a mock Runtime and the
+    session's secrets and config globally, and removes them when it finishes, under
+    any other session still running. Here every run sees one shared mock Runtime,
+    the same secrets and config, and (like a server) the script is compiled once.
+    AppTest also gives every session the id "test session id"; here each session
+    gets its own, so per-session state in the app (blob store, near-duplicate
+    scope) is not shared between them.
+    """
+    import streamlit as st
+    from streamlit import config
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.runtime.secrets import Secrets
+    from streamlit.testing.v1.local_script_runner import LocalScriptRunner
+
+    shared_runtime = MagicMock(spec=Runtime)
+    shared_runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    shared_runtime.cache_storage_manager = MemoryCacheStorageManager()
+    shared_secrets = Secrets()
+    shared_secrets._secrets = dict(secrets)
+
+    compiled = {}
+    compile_lock = threading.Lock()
+    get_bytecode = ScriptCache.get_bytecode
+
+    def get_shared_bytecode(cache, script_path):
+        with compile_lock:
+            if script_path not in compiled:
+                compiled[script_path] = get_bytecode(cache, script_path)
+            return compiled[script_path]
+
+    init_runner = LocalScriptRunner.__init__
+
+    def init_runner_with_session_id(runner, *args, **kwargs):
+        init_runner(runner, *args, **kwargs)
+        runner._session_id = getattr(current_session, "id", runner._session_id)
+
+    saved = (Runtime.__dict__["instance"], Runtime.__dict__["exists"], st.secrets, config.get_option("global.appTest"))
+    Runtime.instance = classmethod(lambda cls: shared_runtime)
+    Runtime.exists = classmethod(lambda cls: True)
+    ScriptCache.get_bytecode = get_shared_bytecode
+    LocalScriptRunner.__init__ = init_runner_with_session_id
+    st.secrets = shared_secrets
+    config.set_option("global.appTest", True)
+    try:
+        yield shared_runtime
+    finally:
+        Runtime.instance, Runtime.exists, st.secrets, app_test = saved
+        ScriptCache.get_bytecode = get_bytecode
+        LocalScriptRunner.__init__ = init_runner
+        config.set_option("global.appTest", app_test)
+
+
+class Session:
+    """One simulated user going from upload to download, timing every rerun."""
+
+    def __init__(self, index, report, downloads, poll_interval=POLL_INTERVAL, timeout=SESSION_TIMEOUT,
+                 secrets=SECRETS):
+        from streamlit.testing.v1 import AppTest
+
+        self.index = index
+        self.report = report
+        self.downloads = downloads
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.timings = {step: [] for step in STEPS}
+        self.session_id = f"load-test-{uuid.uuid4().hex[:12]}"
+        self.app = AppTest.from_file(APP_PATH, default_timeout=timeout)
+        self.app.secrets.update(secrets)
+
+    def rerun(self, step):
+        current_session.id = self.session_id
+        started = time.perf_counter()
+        self.app.run()
+        self.timings[step].append(time.perf_counter() - started)
+        if self.app.exception:
+            raise RuntimeError(f"app raised during {step}: {self.app.exception[0].message}")
+
+    def run(self):
+        app = self.app
+        self.rerun("open")
+        app.file_uploader[0].upload(f"report-{self.index}.jpg", self.report, "image/jpeg")
+        self.rerun("upload")
+
+        app.number_input[0].set_value(25 + self.index % 60)
+        app.selectbox[0].set_value(("Male", "Female")[self.index % 2])
+        app.text_area[0].input("Hypertension")
+        self.rerun("profile")
+
+        next(button for button in app.button if "Analyze" in button.label).click()
+        self.rerun("analyze")
+        deadline = time.monotonic() + self.timeout
+        while app.session_state["job_id"]:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"analysis did not finish in {self.timeout}s")
+            time.sleep(self.poll_interval)
+            self.rerun("poll")
+        if not app.session_state["analysis_complete"]:
+            errors = [error.value for error in app.error]
+            raise RuntimeError(f"analysis failed: {errors[:1]}")
+
+        started = time.perf_counter()
+        pdf = self.downloads.fetch(app.get("download_button")[0].proto.deferred_file_id)
+        self.timings["download"].append(time.perf_counter() - started)
+        if not pdf.startswith(b"%PDF"):
+            raise RuntimeError("the download is not a PDF")
+        return self.timings
+
+
+def run_level(sessions, reports, downloads, args, secrets=SECRETS):
+    """Run `sessions` users at once and return latency, CPU and memory figures for the level."""
+    timings = {step: [] for step in STEPS}
+    durations = []
+    errors = []
+    lock = threading.Lock()
+
+    def simulate(index):
+        started = time.perf_counter()
+        try:
+            session_timings = Session(index, reports[index], downloads, args.poll_interval, secrets=secrets).run()
+        except Exception as e:
+            with lock:
+                errors.append(f"{type(e).__name__}: {e}")
+            return
+        with lock:
+            durations.append(time.perf_counter() - started)
+            for step, samples in session_timings.items():
+                timings[step].extend(samples)
+
+    gc.collect()
+    rss_before = resident_mb()
+    cpu_before = os.times()
+    started = time.perf_counter()
+    with MemorySampler() as memory:
+        with ThreadPoolExecutor(max_workers=sessions, thread_name_prefix="session") as executor:
+            list(executor.map(simulate, range(sessions)))
+    elapsed = time.perf_counter() - started
+    cpu_after = os.times()
+    cpu_seconds = (cpu_after.user - cpu_before.user) + (cpu_after.system - cpu_before.system)
+
+    reruns = [sample for step in STEPS if step != "download" for sample in timings[step]]
+    return {
+        "sessions": sessions,
+        "completed": len(durations),
+        "errors": errors,
+        "elapsed_seconds": elapsed,
+        "rerun_p50_seconds": percentile(reruns, 50),
+        "rerun_p95_seconds": percentile(reruns, 95),
+        "rerun_max_seconds": max(reruns) if reruns else None,
+        "steps": {
+            step: {"count": len(samples), "p50_seconds": percentile(samples, 50),
+                   "p95_seconds": percentile(samples, 95)}
+            for step, samples in timings.items()
+        },
+        "session_p50_seconds": percentile(durations, 50),
+        "session_p95_seconds": percentile(durations, 95),
+        "cpu_cores": cpu_seconds / elapsed if elapsed else 0.0,
+        "peak_rss_mb": memory.peak,
+        "rss_growth_per_session_mb": (memory.peak - rss_before) / sessions,
+    }
+
+
+def find_degradation(levels, factor):
+    """Return the first concurrency level whose p95 rerun latency is `factor` times the lowest level's."""
+    baseline = levels[0]["rerun_p95_seconds"]
+    for level in levels[1:]:
+        p95 = level["rerun_p95_seconds"]
+        if baseline and p95 is not None and p95 > baseline * factor:
+            return level["sessions"]
+        if level["errors"]:
+            return level["sessions"]
+    return None
+
+
+def run_load_test(args):
+    """Run every concurrency level in turn against fake backends."""
+    backend = FakeBackend(
+        model_latency=args.model_latency,
+        model_jitter=args.model_latency * 0.2,
+        search_latency=args.search_latency,
+        searches_per_call=args.searches,
+    )
+    downloads = DeferredDownloads()
+    downloads.install()
+    levels = []
+    # The app's databases and blob store go to a temporary directory, not the checkout's .cache
+    cache_dir = tempfile.TemporaryDirectory(prefix="load-test-")
+    secrets = {**SECRETS, "CACHE_DIR": cache_dir.name}
+    try:
+        with backend.installed(), shared_app_test_state(secrets):
+            # Warm up imports and cached resources so the first level is not charged for them
+            Session(0, make_report_image(args.image_width), downloads, args.poll_interval, secrets=secrets).run()
+            for sessions in args.levels:
+                reports = [
+                    make_report_image(args.image_width, seed=sessions * 1000 + index + 1)
+                    for index in range(sessions)
+                ]
+                level = run_level(sessions, reports, downloads, args, secrets)
+                levels.append(level)
+                if not args.json:
+                    print(f"  {sessions} sessions done", file=sys.stderr)
+    finally:
+        downloads.uninstall()
+        cache_dir.cleanup()
+    return {
+        "config": {
+            "model_latency": args.model_latency,
+            "search_latency": args.search_latency,
+            "searches": args.searches,
+            "image_width": args.image_width,
+            "poll_interval": args.poll_interval,
+        },
+        "levels": levels,
+        "degrades_at": find_degradation(levels, args.degradation_factor),
+    }
+
+
+def print_results(results, factor):
+    print(
+        f"{'sessions':>8}{'done':>6}{'rerun p50':>11}{'rerun p95':>11}{'poll p95':>10}"
+        f"{'session p95':>13}{'download p95':>14}{'CPU cores':>11}{'MB/session':>12}"
+    )
+
+    def ms(seconds):
+        return f"{seconds * 1000:.0f} ms" if seconds is not None else "-"
+
+    for level in results["levels"]:
+        session_p95 = level["session_p95_seconds"]
+        print(
+            f"{level['sessions']:>8}{level['completed']:>6}{ms(level['rerun_p50_seconds']):>11}"
+            f"{ms(level['rerun_p95_seconds']):>11}{ms(level['steps']['poll']['p95_seconds']):>10}"
+            f"{(f'{session_p95:.1f} s' if session_p95 is not None else '-'):>13}"
+            f"{ms(level['steps']['download']['p95_seconds']):>14}"
+            f"{level['cpu_cores']:>11.2f}{level['rss_growth_per_session_mb']:>12.1f}"
+        )
+        for error in level["errors"][:3]:
+            print(f"         error: {error}")
+    if results["degrades_at"] is None:
+        print(f"p95 rerun latency stayed under {factor:g}x the single-session p95 at every level")
+    else:
+        print(f"p95 rerun latency degrades at {results['degrades_at']} concurrent sessions")
+
+
+def parse_list(value):
+    return tuple(int(item) for item in value.split(",") if item)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Drive concurrent simulated sessions through the app.")
+    parser.add_argument("--levels", type=parse_list, default=CONCURRENCY_LEVELS, help="comma separated session counts")
+    parser.add_argument("--model-latency", type=float, default=1.0, help="seconds per fake model call")
+    parser.add_argument("--search-latency", type=float, default=0.3, help="seconds per fake web search")
+    parser.add_argument("--searches", type=int, default=1, help="web searches per model call")
+    parser.add_argument("--image-width", type=int, default=2000, help="width of the uploaded report photos")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL, help="seconds between polls")
+    parser.add_argument("--degradation-factor", type=float, default=DEGRADATION_FACTOR,
+                        help="p95 growth over a single session that counts as degraded")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    # Sessions run the app outside `streamlit run`, which logs bare-mode warnings
+    logging.disable(logging.WARNING)
+    results = run_load_test(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results, args.degradation_factor)
+    return 1 if any(level["errors"] for level in results["levels"]) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""Rerun payload benchmark: bytes the app sends to the browser on every script run.
+
+Streamlit resends every element on each rerun, so this is what a user pays over
+the websocket for each click. Runs the app with AppTest and sums the size of
+the forward messages of each run; exits with status 1 when a rerun goes over
+the budget.
+
+Usage:
+    python benchmarks/payload.py
+    python benchmarks/payload.py --budget 20000 --json
+"""
+
+import argparse
+import json
+import os
+import sys
+import warnings
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Bytes a rerun of the idle page may send
+RERUN_PAYLOAD_BUDGET_BYTES = 16 * 1024
+
+# Number of largest elements listed in the report
+TOP_ELEMENTS = 5
+
+
+def element_label(msg):
+    """Describe the element a forward message carries, e.g. "markdown: <div class=..."."""
+    element = msg.delta.new_element
+    kind = element.WhichOneof("type") or msg.WhichOneof("type")
+    if kind == "markdown":
+        return f"markdown: {' '.join(element.markdown.body.split())[:50]}"
+    return kind
+
+
+def measure(runs):
+    """Run the app `runs` times and return the forward message bytes of each run."""
+    from streamlit.testing.v1 import AppTest
+    from streamlit.testing.v1 import local_script_runner
+
+    results = []
+    parse_tree = local_script_runner.parse_tree_from_messages
+
+    def record(messages):
+        sizes = Counter()
+        for msg in messages:
+            sizes[element_label(msg)] += msg.ByteSize()
+        results.append({
+            "bytes": sum(sizes.values()),
+            "messages": len(messages),
+            "largest": sizes.most_common(TOP_ELEMENTS),
+        })
+        return parse_tree(messages)
+
+    local_script_runner.parse_tree_from_messages = record
+    try:
+        app = AppTest.from_file(os.path.join(ROOT, "app2.py"), default_timeout=300)
+        app.secrets["GOOGLE_API_KEY"] = "benchmark"
+        app.secrets["TAVILY_API_KEY"] = "benchmark"
+        for _ in range(runs):
+            app.run()
+    finally:
+        local_script_runner.parse_tree_from_messages = parse_tree
+    if app.exception:
+        raise RuntimeError(f"app raised: {[e.message for e in app.exception]}")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the bytes sent to the browser per rerun.")
+    parser.add_argument("--budget", type=int, default=RERUN_PAYLOAD_BUDGET_BYTES, help="rerun budget in bytes")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter("ignore")
+    first, rerun = measure(2)
+    over_budget = rerun["bytes"] > args.budget
+    if args.json:
+        print(json.dumps({"first_run": first, "rerun": rerun, "budget": args.budget}, indent=2))
+        return 1 if over_budget else 0
+
+    print(f"first run: {first['bytes']:>8,} bytes in {first['messages']} messages")
+    print(f"rerun:     {rerun['bytes']:>8,} bytes in {rerun['messages']} messages (budget {args.budget:,})")
+    print("largest elements per rerun:")
+    for label, size in rerun["largest"]:
+        print(f"  {size:>8,}  {label}")
+    if over_budget:
+        print("rerun payload is over budget")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,297 @@
+"""Offline pipeline benchmark: throughput, latency percentiles and peak memory per stage.
+
+Gemini and Tavily are replaced by the local fakes in benchmarks/fakes.py, with
+configurable latency and response sizes, so runs cost no API quota and only the
+app's own work varies between builds. Synthetic reports cover photographed
+reports at several resolutions and text and scanned PDFs of several page counts.
+Each scenario calls the same functions as the app and the batch runner.
+
+Results can be saved as a baseline; later runs are compared with it and exit
+with status 1 when a scenario regresses past the threshold.
+
+Usage:
+    python benchmarks/pipeline.py
+    python benchmarks/pipeline.py --iterations 10 --model-latency 0 --json
+    python benchmarks/pipeline.py --save-baseline
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fakes import SAMPLE_PROFILE, FakeBackend, make_report_image, make_report_pdf  # noqa: E402
+
+DEFAULT_BASELINE_PATH = os.path.join(ROOT, "benchmarks", "baselines", "pipeline.json")
+
+# A scenario regresses when p95 latency or peak memory grow, or throughput drops, by more than this
+REGRESSION_THRESHOLD = 0.25
+# Differences smaller than this are timer noise, whatever the ratio
+MIN_LATENCY_DIFFERENCE_SECONDS = 0.005
+MIN_MEMORY_DIFFERENCE_MB = 1.0
+
+IMAGE_WIDTHS = (1000, 2000, 4000)
+PDF_PAGE_COUNTS = (1, 5)
+
+
+def percentile(samples, percent):
+    """Return the nearest-rank percentile of a list of samples."""
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+
+def measure(run, iterations, concurrency=1):
+    """Time `iterations` calls of run() on `concurrency` threads, after one warm-up call.
+
+    Peak memory is measured on one more call under tracemalloc, which slows Python
+    code down too much to be on while timing.
+    """
+    run()
+
+    def timed(_):
+        started = time.perf_counter()
+        run()
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            latencies = list(executor.map(timed, range(iterations)))
+    else:
+        latencies = [timed(index) for index in range(iterations)]
+    elapsed = time.perf_counter() - started
+
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "iterations": iterations,
+        "concurrency": concurrency,
+        "throughput_per_second": iterations / elapsed,
+        "p50_seconds": percentile(latencies, 50),
+        "p95_seconds": percentile(latencies, 95),
+        "p99_seconds": percentile(latencies, 99),
+        "peak_python_mb": peak / 1024 ** 2,
+    }
+
+
+def build_scenarios(args, backend, pools):
+    """Return {name: callable} for every scenario, each running one unit of app work."""
+    import app2
+    import lab_pipeline
+
+    profile = SAMPLE_PROFILE
+    images = {width: make_report_image(width, seed=width) for width in args.image_widths}
+    text_pdfs = {pages: make_report_pdf(pages) for pages in args.pdf_pages}
+    scanned_pdfs = {pages: make_report_pdf(pages, scanned=True) for pages in args.pdf_pages}
+    raw_analysis = backend.create_lab_analyzer_agent().reply
+    narrative, results, _ = lab_pipeline.extract_results(raw_analysis, profile)
+    findings = lab_pipeline.recommendation_findings(raw_analysis, profile)
+    recommendations, _ = lab_pipeline.generate_recommendations(
+        backend.create_lifestyle_agent, findings, profile, pools["sections"], args.section_timeout
+    )
+    report_image = images[min(images)]
+
+    def analyze(data, is_pdf=False):
+        return lambda: lab_pipeline.analyze_report(
+            backend.create_lab_analyzer_agent, data, is_pdf=is_pdf,
+            process_pool=pools["pdf"], page_executor=pools["pages"],
+        )
+
+    def resize(data):
+        def run():
+            # Empty the thumbnail cache so every call resizes
+            app2.get_thumbnail_cache().clear()
+            return app2.resize_image_for_display(data)
+        return run
+
+    def recommend():
+        return lab_pipeline.generate_recommendations(
+            backend.create_lifestyle_agent, findings, profile, pools["sections"], args.section_timeout
+        )
+
+    def create_pdf():
+        return app2.create_lab_report_pdf(report_image, narrative, recommendations, profile, results)
+
+    def end_to_end():
+        data = images[min(images)]
+        raw = lab_pipeline.analyze_report(backend.create_lab_analyzer_agent, data)
+        narrative, results, _ = lab_pipeline.extract_results(raw, profile)
+        recommendations, _ = lab_pipeline.generate_recommendations(
+            backend.create_lifestyle_agent, lab_pipeline.recommendation_findings(raw, profile), profile,
+            pools["sections"], args.section_timeout,
+        )
+        thumbnail = app2.resize_image_for_display(data)
+        return app2.create_lab_report_pdf(thumbnail, narrative, recommendations, profile, results)
+
+    scenarios = {}
+    for width, data in images.items():
+        scenarios[f"analyze_image_{width}px"] = analyze(data)
+    for pages in args.pdf_pages:
+        scenarios[f"analyze_text_pdf_{pages}p"] = analyze(text_pdfs[pages], is_pdf=True)
+        scenarios[f"analyze_scanned_pdf_{pages}p"] = analyze(scanned_pdfs[pages], is_pdf=True)
+    scenarios["recommendations"] = recommend
+    for width, data in images.items():
+        scenarios[f"resize_image_{width}px"] = resize(data)
+    scenarios["create_pdf"] = create_pdf
+    scenarios["end_to_end"] = end_to_end
+    return scenarios
+
+
+def run_benchmarks(args):
+    """Run every selected scenario and return the results with the configuration that produced them."""
+    backend = FakeBackend(
+        model_latency=args.model_latency,
+        model_jitter=args.model_latency * 0.2,
+        analysis_chars=args.analysis_chars,
+        recommendation_chars=args.recommendation_chars,
+        result_rows=args.result_rows,
+        search_latency=args.search_latency,
+        searches_per_call=args.searches,
+    )
+    import lab_pipeline
+
+    pools = {
+        "pdf": ProcessPoolExecutor(max_workers=args.pdf_workers, mp_context=multiprocessing.get_context("spawn")),
+        "pages": ThreadPoolExecutor(max_workers=args.page_concurrency),
+        "sections": ThreadPoolExecutor(
+            max_workers=len(lab_pipeline.RECOMMENDATION_SECTIONS) * args.concurrency
+        ),
+    }
+    scenarios = {}
+    try:
+        with backend.installed():
+            for name, run in build_scenarios(args, backend, pools).items():
+                if args.only and not any(pattern in name for pattern in args.only):
+                    continue
+                concurrency = args.concurrency if name == "end_to_end" else 1
+                iterations = args.iterations * concurrency
+                scenarios[name] = measure(run, iterations, concurrency)
+                if not args.json:
+                    print(f"  {name} done", file=sys.stderr)
+    finally:
+        for pool in pools.values():
+            pool.shutdown(cancel_futures=True)
+
+    return {
+        "config": {
+            "model_latency": args.model_latency,
+            "search_latency": args.search_latency,
+            "searches": args.searches,
+            "analysis_chars": args.analysis_chars,
+            "recommendation_chars": args.recommendation_chars,
+            "result_rows": args.result_rows,
+            "concurrency": args.concurrency,
+        },
+        "scenarios": scenarios,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def find_regressions(results, baseline, threshold):
+    """Return a message for every scenario that is worse than its baseline by more than threshold."""
+    regressions = []
+    for name, current in results["scenarios"].items():
+        previous = baseline["scenarios"].get(name)
+        if previous is None:
+            continue
+        p95, previous_p95 = current["p95_seconds"], previous["p95_seconds"]
+        if p95 > previous_p95 * (1 + threshold) and p95 - previous_p95 > MIN_LATENCY_DIFFERENCE_SECONDS:
+            regressions.append(f"{name}: p95 {previous_p95 * 1000:.0f} ms -> {p95 * 1000:.0f} ms")
+        throughput, previous_throughput = current["throughput_per_second"], previous["throughput_per_second"]
+        if throughput < previous_throughput * (1 - threshold):
+            regressions.append(f"{name}: throughput {previous_throughput:.2f}/s -> {throughput:.2f}/s")
+        memory, previous_memory = current["peak_python_mb"], previous["peak_python_mb"]
+        if memory > previous_memory * (1 + threshold) and memory - previous_memory > MIN_MEMORY_DIFFERENCE_MB:
+            regressions.append(f"{name}: peak memory {previous_memory:.1f} MB -> {memory:.1f} MB")
+    return regressions
+
+
+def load_baseline(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def print_results(results):
+    print(f"{'scenario':<28}{'ops/s':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'peak MB':>9}")
+    for name, result in results["scenarios"].items():
+        print(
+            f"{name:<28}{result['throughput_per_second']:>8.2f}{result['p50_seconds'] * 1000:>9.0f}"
+            f"{result['p95_seconds'] * 1000:>9.0f}{result['p99_seconds'] * 1000:>9.0f}"
+            f"{result['peak_python_mb']:>9.1f}"
+        )
+    print(f"max RSS: {results['max_rss_mb']:.0f} MB")
+
+
+def parse_list(value):
+    return tuple(int(item) for item in value.split(",") if item)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the analysis pipeline against local fakes.")
+    parser.add_argument("--iterations", type=int, default=5, help="timed calls per scenario")
+    parser.add_argument("--concurrency", type=int, default=4, help="parallel reports in the end_to_end scenario")
+    parser.add_argument("--only", action="append", help="run only scenarios whose name contains this (repeatable)")
+    parser.add_argument("--image-widths", type=parse_list, default=IMAGE_WIDTHS, help="comma separated widths")
+    parser.add_argument("--pdf-pages", type=parse_list, default=PDF_PAGE_COUNTS, help="comma separated page counts")
+    parser.add_argument("--model-latency", type=float, default=0.05, help="seconds per fake model call")
+    parser.add_argument("--search-latency", type=float, default=0.02, help="seconds per fake web search")
+    parser.add_argument("--searches", type=int, default=1, help="web searches per model call")
+    parser.add_argument("--analysis-chars", type=int, default=3000, help="size of the fake analysis")
+    parser.add_argument("--recommendation-chars", type=int, default=1500, help="size of each fake section")
+    parser.add_argument("--result-rows", type=int, default=20, help="structured results per fake analysis")
+    parser.add_argument("--section-timeout", type=float, default=45, help="seconds to wait for sections")
+    parser.add_argument("--pdf-workers", type=int, default=2, help="processes that read PDF pages")
+    parser.add_argument("--page-concurrency", type=int, default=4, help="PDF pages analyzed in parallel")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH, help="baseline file to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD, help="allowed regression ratio")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    # Importing the app outside `streamlit run` logs bare-mode warnings on every cached call
+    logging.disable(logging.WARNING)
+    results = run_benchmarks(args)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+    baseline = None if args.save_baseline else load_baseline(args.baseline)
+    regressions = []
+    if baseline is not None:
+        if baseline["config"] != results["config"]:
+            print("baseline was recorded with different fake settings; not comparing", file=sys.stderr)
+        else:
+            regressions = find_regressions(results, baseline, args.threshold)
+
+    if args.json:
+        print(json.dumps({**results, "regressions": regressions}, indent=2))
+    else:
+        print_results(results)
+        if baseline is None and not args.save_baseline:
+            print(f"no baseline at {args.baseline}; run with --save-baseline to record one")
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
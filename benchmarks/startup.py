@@ -0,0 +1,126 @@
+"""Startup benchmark: import time per dependency and time to first render of the app.
+
+Every measurement runs in a fresh interpreter, so nothing is imported yet, the
+same as a container cold start or a newly spawned worker process.
+
+Usage:
+    python benchmarks/startup.py --repeat 5
+    python benchmarks/startup.py --json > startup.json
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEPENDENCIES = [
+    "streamlit",
+    "PIL.Image",
+    "pypdfium2",
+    "numpy",
+    "pandas",
+    "reportlab.platypus",
+    "phi.agent",
+    "phi.model.google",
+    "phi.tools.tavily",
+    "lab_pipeline",
+    "batch_analyze",
+]
+
+# Modules that should only be loaded once a feature needs them
+LAZY_MODULES = ["pandas", "reportlab", "phi", "google.generativeai", "tavily"]
+
+IMPORT_SCRIPT = """
+import time, warnings
+warnings.simplefilter("ignore")
+started = time.perf_counter()
+import {module}
+print(time.perf_counter() - started)
+"""
+
+# The app's databases and blob store go to a temporary directory, not the checkout's .cache
+RENDER_SCRIPT = """
+import json, sys, tempfile, time, warnings
+warnings.simplefilter("ignore")
+from streamlit.testing.v1 import AppTest
+cache_dir = tempfile.TemporaryDirectory(prefix="startup-")
+app = AppTest.from_file({path!r}, default_timeout=300)
+app.secrets["GOOGLE_API_KEY"] = "benchmark"
+app.secrets["TAVILY_API_KEY"] = "benchmark"
+app.secrets["CACHE_DIR"] = cache_dir.name
+started = time.perf_counter()
+app.run()
+first = time.perf_counter() - started
+started = time.perf_counter()
+app.run()
+rerun = time.perf_counter() - started
+print(json.dumps({{
+    "first_render_seconds": first,
+    "rerun_seconds": rerun,
+    "exceptions": [e.message for e in app.exception],
+    "loaded": [name for name in {lazy!r} if name in sys.modules],
+}}))
+"""
+
+
+def run_python(script):
+    """Run a script in a fresh interpreter from the repository root and return its last output line."""
+    result = subprocess.run(
+        [sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    return result.stdout.strip().splitlines()[-1]
+
+
+def measure_imports(repeat):
+    """Return the median cold import time of each dependency in seconds."""
+    return {
+        module: statistics.median(
+            float(run_python(IMPORT_SCRIPT.format(module=module))) for _ in range(repeat)
+        )
+        for module in DEPENDENCIES
+    }
+
+
+def measure_render(repeat):
+    """Return the median time to first render and rerun of the app, and which heavy modules it loaded."""
+    path = os.path.join(ROOT, "app2.py")
+    runs = [json.loads(run_python(RENDER_SCRIPT.format(path=path, lazy=LAZY_MODULES))) for _ in range(repeat)]
+    return {
+        "first_render_seconds": statistics.median(run["first_render_seconds"] for run in runs),
+        "rerun_seconds": statistics.median(run["rerun_seconds"] for run in runs),
+        "exceptions": runs[-1]["exceptions"],
+        "loaded": runs[-1]["loaded"],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure cold import and first render times.")
+    parser.add_argument("--repeat", type=int, default=3, help="fresh interpreters per measurement")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    results = {"imports": measure_imports(args.repeat), "render": measure_render(args.repeat)}
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+
+    print(f"{'dependency':<22}{'import (ms)':>12}")
+    for module, seconds in results["imports"].items():
+        print(f"{module:<22}{seconds * 1000:>12.0f}")
+    render = results["render"]
+    print()
+    print(f"time to first render: {render['first_render_seconds'] * 1000:.0f} ms")
+    print(f"rerun:                {render['rerun_seconds'] * 1000:.0f} ms")
+    print(f"heavy modules loaded: {', '.join(render['loaded']) or 'none'}")
+    if render["exceptions"]:
+        print(f"app raised: {render['exceptions']}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
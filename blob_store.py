@@ -0,0 +1,348 @@
+"""Content-addressed store on local disk for large per-session artifacts.
+
+Sessions keep only handles (content digests) in session state; the bytes live
+on disk, compressed when that helps, and are shared when sessions hold the
+same content. Disk use is bounded per session and overall, with least recently
+used eviction, and a session's artifacts are released when the session ends.
+
+Several processes (app replicas, benchmarks) can share one root: each writes to
+its own subdirectory and holds a lock on it, and only subdirectories whose owner
+has exited are removed.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to the age of a directory's files
+    fcntl = None
+
+from bounded_cache import BoundedCache
+
+logger = logging.getLogger(__name__)
+
+# Smaller artifacts are not worth compressing
+COMPRESSION_MIN_BYTES = 1024
+# Compressed data is kept only when it saves at least this fraction (JPEG/PNG/PDF rarely do)
+COMPRESSION_MIN_SAVING = 0.1
+COMPRESSION_LEVEL = 6
+
+BLOB_FILE_PATTERN = re.compile(r"^[0-9a-f]{64}(\.z)?$")
+# Held (flock) by the process that owns a store directory
+OWNER_LOCK_FILE = "owner.lock"
+# Directories younger than this are left alone; their owner may not hold the lock yet
+NEW_DIRECTORY_GRACE_SECONDS = 60
+
+
+class BlobTooLargeError(ValueError):
+    """An artifact is larger than the per-session quota."""
+
+
+class BlobStore:
+    """Reference-counted blob files under root, owned by sessions.
+
+    put() stores bytes for a (session, name) pair and returns a handle; get()
+    returns the bytes for a handle, or None once the blob has been evicted.
+    A blob is deleted when no session refers to it anymore. Recently read
+    blobs are kept decompressed in a small shared memory cache.
+    """
+
+    def __init__(self, root, max_bytes=2 * 1024 ** 3, session_max_bytes=64 * 1024 ** 2,
+                 memory_cache_bytes=8 * 1024 ** 2, disconnect_grace_seconds=300,
+                 idle_timeout_seconds=6 * 3600, sweep_interval=60):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.session_max_bytes = session_max_bytes
+        self.disconnect_grace_seconds = disconnect_grace_seconds
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.sweep_interval = sweep_interval
+        self.memory = BoundedCache(max_entries=256, max_bytes=memory_cache_bytes)
+        self.evictions = 0
+        self.sessions_released = 0
+        # digest -> {"size", "stored_size", "compressed", "owners"}, least recently used first
+        self._blobs = OrderedDict()
+        # session id -> {"artifacts": {name: digest}, "last_seen": time}
+        self._sessions = {}
+        self._stored_total = 0
+        self._last_sweep = time.monotonic()
+        self._lock = threading.RLock()
+
+        os.makedirs(root, exist_ok=True)
+        self.directory = tempfile.mkdtemp(prefix=f"{os.getpid()}-", dir=root)
+        self._owner_lock = open(os.path.join(self.directory, OWNER_LOCK_FILE), "w")
+        if fcntl is not None:
+            fcntl.flock(self._owner_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._remove_abandoned_files()
+
+    def _remove_abandoned_files(self):
+        """Delete blobs left by processes that have exited; sessions do not survive a restart.
+
+        Store directories are removed once nobody holds their owner lock. Blob files
+        directly under root (or in directories without a lock) are removed only after
+        idle_timeout_seconds, when any session holding them would have been released.
+        """
+        now = time.time()
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or entry.path == self.directory:
+                continue
+            try:
+                if now - entry.stat().st_mtime < NEW_DIRECTORY_GRACE_SECONDS:
+                    continue
+                lock_path = os.path.join(entry.path, OWNER_LOCK_FILE)
+                if fcntl is not None and os.path.exists(lock_path):
+                    if not self._owner_exited(lock_path):
+                        continue
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    logger.info("Removed blobs left by an exited process in %s", entry.path)
+                    continue
+            except OSError:
+                continue
+            self._remove_old_files(entry.path, now)
+        self._remove_old_files(self.root, now, recursive=False)
+
+    @staticmethod
+    def _owner_exited(lock_path):
+        """Return True if no process holds the owner lock of a store directory."""
+        with open(lock_path, "a") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+            fcntl.flock(f, fcntl.LOCK_UN)
+        return True
+
+    def _remove_old_files(self, directory, now, recursive=True):
+        """Delete blob and temporary files not modified for idle_timeout_seconds."""
+        for path, _, files in os.walk(directory):
+            for name in files:
+                if not (BLOB_FILE_PATTERN.match(name) or name.endswith(".tmp")):
+                    continue
+                file_path = os.path.join(path, name)
+                try:
+                    if now - os.path.getmtime(file_path) > self.idle_timeout_seconds:
+                        os.remove(file_path)
+                except OSError:
+                    pass
+            if not recursive:
+                return
+
+    def _path(self, digest, compressed):
+        return os.path.join(self.directory, digest[:2], digest + (".z" if compressed else ""))
+
+    def put(self, session_id, name, data):
+        """Store data as the session's artifact `name`, replacing the previous one, and return its handle."""
+        if self.session_max_bytes and len(data) > self.session_max_bytes:
+            raise BlobTooLargeError(
+                f"{name} is {len(data) / 1024 ** 2:.1f} MB, over the "
+                f"{self.session_max_bytes / 1024 ** 2:.0f} MB per-session limit"
+            )
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            if digest not in self._blobs:
+                self._write(digest, data)
+            blob = self._blobs[digest]
+            self._blobs.move_to_end(digest)
+            session = self._session(session_id)
+            previous = session["artifacts"].get(name)
+            session["artifacts"][name] = digest
+            blob["owners"].add(session_id)
+            if previous is not None and previous != digest:
+                self._release(session_id, previous)
+            self._enforce_session_quota(session_id, keep=digest)
+            self._enforce_quota(keep=digest)
+        return digest
+
+    def get(self, handle):
+        """Return the bytes for a handle, or None if it is unknown or was evicted."""
+        if handle is None:
+            return None
+        data = self.memory.get(handle)
+        with self._lock:
+            blob = self._blobs.get(handle)
+            if blob is None:
+                return None
+            self._blobs.move_to_end(handle)
+            if data is not None:
+                return data
+            path = self._path(handle, blob["compressed"])
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            logger.warning("Blob %s is missing from disk", handle)
+            return None
+        if blob["compressed"]:
+            data = zlib.decompress(data)
+        self.memory.put(handle, data)
+        return data
+
+    def touch(self, session_id):
+        """Record that a session is alive."""
+        with self._lock:
+            self._session(session_id)
+
+    def remove(self, session_id, name):
+        """Drop one artifact of a session."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            digest = session["artifacts"].pop(name, None) if session is not None else None
+            if digest is not None:
+                self._release(session_id, digest)
+
+    def release_session(self, session_id):
+        """Drop every artifact of a session."""
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is None:
+                return
+            for digest in set(session["artifacts"].values()):
+                self._release(session_id, digest)
+            self.sessions_released += 1
+
+    def sweep(self, is_active=None, force=False):
+        """Release sessions that ended; runs at most every sweep_interval seconds unless forced.
+
+        is_active(session_id) tells whether a browser is still connected. Disconnected
+        sessions are kept for disconnect_grace_seconds so a reconnecting tab finds its
+        artifacts; any session idle for idle_timeout_seconds is released.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_sweep < self.sweep_interval:
+                return 0
+            self._last_sweep = now
+            ended = [
+                session_id for session_id, session in self._sessions.items()
+                if now - session["last_seen"] > self.idle_timeout_seconds
+                or (is_active is not None and now - session["last_seen"] > self.disconnect_grace_seconds
+                    and not is_active(session_id))
+            ]
+            for session_id in ended:
+                self.release_session(session_id)
+        return len(ended)
+
+    def _session(self, session_id):
+        session = self._sessions.get(session_id)
+        if session is None:
+            session = self._sessions[session_id] = {"artifacts": {}, "last_seen": 0.0}
+        session["last_seen"] = time.monotonic()
+        return session
+
+    def _write(self, digest, data):
+        """Write a new blob file and index it; the caller holds the lock."""
+        stored = data
+        compressed = False
+        if len(data) >= COMPRESSION_MIN_BYTES:
+            packed = zlib.compress(data, COMPRESSION_LEVEL)
+            if len(packed) <= len(data) * (1 - COMPRESSION_MIN_SAVING):
+                stored, compressed = packed, True
+        path = self._path(digest, compressed)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(stored)
+        os.replace(temp_path, path)
+        self._blobs[digest] = {
+            "size": len(data),
+            "stored_size": len(stored),
+            "compressed": compressed,
+            "owners": set(),
+        }
+        self._stored_total += len(stored)
+
+    def _release(self, session_id, digest):
+        """Drop one session's reference to a blob, deleting it when unreferenced; the caller holds the lock."""
+        blob = self._blobs.get(digest)
+        if blob is None:
+            return
+        session = self._sessions.get(session_id)
+        if session is not None and digest in session["artifacts"].values():
+            return
+        blob["owners"].discard(session_id)
+        if not blob["owners"]:
+            self._delete(digest)
+
+    def _delete(self, digest):
+        """Remove a blob from disk and from every session; the caller holds the lock."""
+        blob = self._blobs.pop(digest)
+        self._stored_total -= blob["stored_size"]
+        for session_id in blob["owners"]:
+            artifacts = self._sessions.get(session_id, {}).get("artifacts", {})
+            for name in [name for name, handle in artifacts.items() if handle == digest]:
+                del artifacts[name]
+        try:
+            os.remove(self._path(digest, blob["compressed"]))
+        except OSError:
+            pass
+
+    def _session_bytes(self, session_id):
+        digests = set(self._sessions[session_id]["artifacts"].values())
+        return sum(self._blobs[digest]["stored_size"] for digest in digests)
+
+    def _enforce_session_quota(self, session_id, keep):
+        """Evict the session's least recently used artifacts while it is over quota."""
+        if not self.session_max_bytes:
+            return
+        artifacts = self._sessions[session_id]["artifacts"]
+        for digest in list(self._blobs):
+            if self._session_bytes(session_id) <= self.session_max_bytes:
+                return
+            if digest != keep and digest in artifacts.values():
+                for name in [name for name, handle in artifacts.items() if handle == digest]:
+                    del artifacts[name]
+                self._release(session_id, digest)
+                self.evictions += 1
+
+    def _enforce_quota(self, keep):
+        """Evict the least recently used blobs while the store is over max_bytes."""
+        while self._stored_total > self.max_bytes and len(self._blobs) > 1:
+            digest = next(digest for digest in self._blobs if digest != keep)
+            logger.info("Evicting blob %s to stay under the store quota", digest[:12])
+            self._delete(digest)
+            self.evictions += 1
+
+    def session_stats(self, session_id):
+        """Return the artifact count and bytes held for one session."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return {"artifacts": 0, "bytes": 0, "stored_bytes": 0}
+            digests = set(session["artifacts"].values())
+            return {
+                "artifacts": len(session["artifacts"]),
+                "bytes": sum(self._blobs[digest]["size"] for digest in digests),
+                "stored_bytes": sum(self._blobs[digest]["stored_size"] for digest in digests),
+            }
+
+    def stats(self):
+        """Return store totals and the bytes held by each session, largest first."""
+        now = time.monotonic()
+        with self._lock:
+            session_ids = list(self._sessions)
+            idle = {session_id: now - self._sessions[session_id]["last_seen"] for session_id in session_ids}
+            blobs = len(self._blobs)
+            stored_total = self._stored_total
+            size_total = sum(blob["size"] for blob in self._blobs.values())
+        sessions = [
+            {"session": session_id, "idle_seconds": idle[session_id], **self.session_stats(session_id)}
+            for session_id in session_ids
+        ]
+        sessions.sort(key=lambda session: session["stored_bytes"], reverse=True)
+        return {
+            "blobs": blobs,
+            "bytes": size_total,
+            "stored_bytes": stored_total,
+            "evictions": self.evictions,
+            "sessions_released": self.sessions_released,
+            "memory_cache": self.memory.stats(),
+            "sessions": sessions,
+        }
@@ -0,0 +1,91 @@
+"""Small thread-safe in-memory LRU cache shared across Streamlit sessions."""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class BoundedCache:
+    """LRU cache bounded by entry count and, optionally, total size in bytes and entry age."""
+
+    def __init__(self, max_entries=32, max_bytes=None, sizeof=len, ttl_seconds=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._created = {}
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the cached value for a key and mark it as recently used."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            if self.ttl_seconds and time.monotonic() - self._created[key] > self.ttl_seconds:
+                self._remove(key)
+                self.evictions += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key, value):
+        """Store a value, evicting the least recently used entries when over budget."""
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = value
+            self._sizes[key] = size
+            self._created[key] = time.monotonic()
+            self._total += size
+            while self._entries and (
+                len(self._entries) > self.max_entries
+                or (self.max_bytes is not None and self._total > self.max_bytes)
+            ):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        """Drop one entry; the caller holds the lock."""
+        del self._entries[key]
+        del self._created[key]
+        self._total -= self._sizes.pop(key)
+
+    def get_or_create(self, key, factory):
+        """Return the cached value, or build it with factory() and cache it unless it is None."""
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            if value is not None:
+                self.put(key, value)
+        return value
+
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._created.clear()
+            self._total = 0
+
+    def stats(self):
+        """Return hit/miss counters and current occupancy."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._total,
+            }
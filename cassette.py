@@ -0,0 +1,271 @@
+"""Record and replay agent calls, so real sessions can be re-run without calling Gemini or Tavily.
+
+In record mode every agent.run() is passed to the real agent and its request,
+answer, token metrics, tool calls and timing are appended to a cassette: a gzip
+compressed JSON Lines file. In replay mode agents are not built at all; each call
+is answered from the cassette by its normalized request (agent name, message with
+whitespace collapsed and digests of the images). Repeated identical requests are
+served in recorded order. Replay can wait the original latency divided by a speed
+factor, or answer at once.
+
+Cassettes hold the report contents sent to the model, so store them like uploads.
+"""
+
+import atexit
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+RECORD = "record"
+REPLAY = "replay"
+
+# Characters per streamed chunk when replaying a streamed call
+REPLAY_CHUNK_CHARS = 64
+
+
+class CassetteMissError(LookupError):
+    """A replayed agent got a request that is not on the cassette."""
+
+
+def image_digest(image):
+    """Return a short stable digest for an image given as bytes, a path or a URL."""
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        data = bytes(image)
+    else:
+        data = str(image).encode("utf-8")
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+def normalize_message(message):
+    """Collapse whitespace so formatting-only differences do not change the key."""
+    return " ".join(str(message or "").split())
+
+
+def request_key(agent_name, message, images=None):
+    """Return the cassette key for one agent request."""
+    payload = json.dumps(
+        [agent_name, normalize_message(message), [image_digest(image) for image in images or []]]
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def tool_calls(run_response):
+    """Return the tool calls phidata recorded for a run as plain dicts."""
+    calls = []
+    for call in getattr(run_response, "tools", None) or []:
+        calls.append({
+            "name": call.get("tool_name"),
+            "arguments": call.get("tool_args"),
+            "result": call.get("content"),
+        })
+    return calls
+
+
+class ReplayedResponse:
+    """The parts of a phidata RunResponse the pipeline reads."""
+
+    def __init__(self, content, metrics=None, tools=None):
+        self.content = content
+        self.metrics = metrics or {}
+        self.tools = tools or []
+
+
+class Cassette:
+    """One cassette file opened for recording or for replay."""
+
+    def __init__(self, path, mode=REPLAY, speed=None):
+        if mode not in (RECORD, REPLAY):
+            raise ValueError(f"cassette mode must be {RECORD!r} or {REPLAY!r}, not {mode!r}")
+        self.path = path
+        self.mode = mode
+        self.speed = speed
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+        self._entries = {}
+        self._positions = {}
+        self._file = None
+        self._lock = threading.Lock()
+        if mode == REPLAY:
+            self._load()
+        else:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+
+    def _load(self):
+        """Read every entry, keeping the ones before a truncated tail from an interrupted recording."""
+        count = 0
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self._entries.setdefault(entry["key"], []).append(entry)
+                    count += 1
+        except (EOFError, zlib.error, json.JSONDecodeError) as e:
+            logger.warning("Cassette %s ends early (%s); replaying the %d complete entries", self.path, e, count)
+        logger.info("Loaded %d recorded calls for %d requests from %s", count, len(self._entries), self.path)
+
+    def record(self, agent_name, message, images, content, metrics, tools, seconds, first_chunk_seconds=None):
+        """Append one call to the cassette."""
+        entry = {
+            "key": request_key(agent_name, message, images),
+            "agent": agent_name,
+            "message": normalize_message(message),
+            "images": [image_digest(image) for image in images or []],
+            "content": content,
+            "metrics": metrics or {},
+            "tools": tools,
+            "seconds": round(seconds, 3),
+            "first_chunk_seconds": round(first_chunk_seconds, 3) if first_chunk_seconds is not None else None,
+            "recorded_at": time.time(),
+        }
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._file is None:
+                self._file = gzip.open(self.path, "at", encoding="utf-8")
+            self._file.write(line)
+            # A sync flush keeps everything written so far readable if the process dies
+            self._file.flush()
+            self.recorded += 1
+
+    def lookup(self, agent_name, message, images=None):
+        """Return the next recorded entry for a request; repeated requests get their recordings in order."""
+        key = request_key(agent_name, message, images)
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                self.misses += 1
+                raise CassetteMissError(
+                    f"no recorded {agent_name} call for: {normalize_message(message)[:120]}"
+                )
+            position = self._positions.get(key, 0)
+            self._positions[key] = position + 1
+            self.replayed += 1
+            # Past the last recording, keep serving the last one
+            return entries[min(position, len(entries) - 1)]
+
+    def wait(self, seconds):
+        """Sleep for a recorded duration scaled by the speed factor; no wait without one."""
+        if self.speed and seconds:
+            time.sleep(seconds / self.speed)
+
+    def wrap(self, agent, agent_name):
+        """Return an agent that records into this cassette, or a replaying stand-in in replay mode."""
+        if self.mode == REPLAY:
+            return ReplayAgent(self, agent_name)
+        return RecordingAgent(agent, self, agent_name)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "path": self.path,
+            "recorded": self.recorded,
+            "replayed": self.replayed,
+            "misses": self.misses,
+            "requests": len(self._entries),
+        }
+
+
+class RecordingAgent:
+    """Agent wrapper that passes every run to the real agent and records it on a cassette."""
+
+    def __init__(self, agent, cassette, agent_name):
+        self.agent = agent
+        self.cassette = cassette
+        self.agent_name = agent_name
+
+    def __getattr__(self, name):
+        return getattr(self.agent, name)
+
+    def run(self, message=None, *args, stream=False, images=None, **kwargs):
+        started = time.monotonic()
+        response = self.agent.run(message, *args, stream=stream, images=images, **kwargs)
+        if not stream:
+            self._record(message, images, response.content, response, started)
+            return response
+        return self._stream(response, message, images, started)
+
+    def _stream(self, chunks, message, images, started):
+        parts = []
+        first_chunk = None
+        for chunk in chunks:
+            if first_chunk is None:
+                first_chunk = time.monotonic() - started
+            if chunk.content:
+                parts.append(chunk.content)
+            yield chunk
+        self._record(message, images, "".join(parts), None, started, first_chunk)
+
+    def _record(self, message, images, content, response, started, first_chunk=None):
+        run_response = response if response is not None else getattr(self.agent, "run_response", None)
+        try:
+            self.cassette.record(
+                self.agent_name, message, images, content,
+                getattr(run_response, "metrics", None), tool_calls(run_response),
+                time.monotonic() - started, first_chunk,
+            )
+        except Exception as e:
+            logger.warning("Could not record %s call: %s", self.agent_name, e)
+
+
+class ReplayAgent:
+    """Stand-in for an agent that answers every run from a cassette."""
+
+    def __init__(self, cassette, agent_name):
+        self.cassette = cassette
+        self.agent_name = agent_name
+        self.run_response = ReplayedResponse("")
+
+    def run(self, message=None, *args, stream=False, images=None, **kwargs):
+        entry = self.cassette.lookup(self.agent_name, message, images)
+        if not stream:
+            self.cassette.wait(entry["seconds"])
+            self.run_response = ReplayedResponse(entry["content"], entry["metrics"], entry["tools"])
+            return self.run_response
+        return self._stream(entry)
+
+    def _stream(self, entry):
+        content = entry["content"] or ""
+        chunks = [content[i:i + REPLAY_CHUNK_CHARS] for i in range(0, len(content), REPLAY_CHUNK_CHARS)]
+        first_chunk = entry["first_chunk_seconds"] or 0.0
+        self.cassette.wait(first_chunk)
+        delay = max(entry["seconds"] - first_chunk, 0.0) / max(len(chunks), 1)
+        for chunk in chunks:
+            self.cassette.wait(delay)
+            yield ReplayedResponse(chunk)
+        self.run_response = ReplayedResponse(content, entry["metrics"], entry["tools"])
+
+
+@lru_cache(maxsize=None)
+def get_cassette():
+    """Return the process cassette configured by $AGENT_CASSETTE_MODE, or None when it is unset.
+
+    $AGENT_CASSETTE_PATH names the file (.cache/agent_calls.jsonl.gz by default) and
+    $AGENT_REPLAY_SPEED, when set, replays at the original latency divided by it.
+    """
+    mode = os.environ.get("AGENT_CASSETTE_MODE")
+    if not mode:
+        return None
+    path = os.environ.get("AGENT_CASSETTE_PATH") or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), ".cache", "agent_calls.jsonl.gz"
+    )
+    speed = os.environ.get("AGENT_REPLAY_SPEED")
+    cassette = Cassette(path, mode.lower(), float(speed) if speed else None)
+    atexit.register(cassette.close)
+    logger.info("Agent calls are %sed %s %s", mode.lower(), "to" if mode.lower() == RECORD else "from", path)
+    return cassette
@@ -0,0 +1,119 @@
+"""Preprocessing pipeline that shrinks lab report photos before they are sent to the model."""
+
+import logging
+import time
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Refuse to decode anything larger than this (decompression bomb protection)
+MAX_IMAGE_PIXELS = 50_000_000
+
+FORMAT_EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp", "PNG": ".png"}
+FORMAT_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+
+def preprocess_image(data, max_long_edge=2048, grayscale=False, autocontrast=False, output_format="JPEG", quality=85):
+    """Auto-rotate, downscale, optionally normalize and re-encode an image.
+
+    Returns a tuple of (image bytes, file extension, stats). If the original is already
+    in the output format and the processed image would not be smaller, the original
+    bytes are returned unchanged.
+    """
+    stages = []
+
+    def mark(name, started):
+        stages.append((name, (time.perf_counter() - started) * 1000))
+
+    started = time.perf_counter()
+    img = open_image(data)
+    original_format = img.format
+    if img.format == "JPEG":
+        # Let libjpeg decode at a reduced scale when the photo is much larger than needed
+        img.draft("RGB", (max_long_edge, max_long_edge))
+    img.load()
+    mark("decode", started)
+
+    started = time.perf_counter()
+    ImageOps.exif_transpose(img, in_place=True)
+    mark("exif_rotate", started)
+
+    started = time.perf_counter()
+    if max(img.size) > max_long_edge:
+        img.thumbnail((max_long_edge, max_long_edge), Image.Resampling.LANCZOS)
+    mark("downscale", started)
+
+    started = time.perf_counter()
+    if grayscale:
+        img = img.convert("L")
+    elif img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    if autocontrast:
+        img = ImageOps.autocontrast(img, cutoff=1)
+    mark("normalize", started)
+
+    started = time.perf_counter()
+    buf = BytesIO()
+    save_kwargs = {"optimize": True}
+    if output_format in ("JPEG", "WEBP"):
+        save_kwargs["quality"] = quality
+    img.save(buf, format=output_format, **save_kwargs)
+    processed = buf.getvalue()
+    mark("encode", started)
+
+    stats = {
+        "original_bytes": len(data),
+        "processed_bytes": len(processed),
+        "original_format": original_format,
+        "size": img.size,
+        "stages_ms": dict(stages),
+    }
+    if original_format == output_format and len(processed) >= len(data):
+        stats["processed_bytes"] = len(data)
+        stats["kept_original"] = True
+        extension = FORMAT_EXTENSIONS.get(original_format, "")
+        log_preprocessing(stats)
+        return data, extension, stats
+
+    stats["kept_original"] = False
+    log_preprocessing(stats)
+    return processed, FORMAT_EXTENSIONS[output_format], stats
+
+
+def open_image(data, max_pixels=MAX_IMAGE_PIXELS):
+    """Open an image lazily, rejecting it before decoding if it has too many pixels."""
+    img = Image.open(BytesIO(data))
+    if img.width * img.height > max_pixels:
+        raise ValueError(f"image is {img.width}x{img.height}, which exceeds the {max_pixels:,} pixel limit")
+    return img
+
+
+def create_thumbnail(data, width, output_format="WEBP", quality=80):
+    """Decode an image at reduced scale where possible and return a small display copy."""
+    img = open_image(data)
+    if img.format == "JPEG":
+        img.draft("RGB", (width, width))
+    ImageOps.exif_transpose(img, in_place=True)
+
+    height = max(1, round(width * img.height / img.width))
+    img = img.resize((width, height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+
+    buf = BytesIO()
+    img.save(buf, format=output_format, quality=quality)
+    return buf.getvalue()
+
+
+def log_preprocessing(stats):
+    """Log the bytes saved and per-stage latency of one preprocessing run."""
+    saved = stats["original_bytes"] - stats["processed_bytes"]
+    ratio = stats["original_bytes"] / max(stats["processed_bytes"], 1)
+    timings = ", ".join(f"{name}={ms:.1f}ms" for name, ms in stats["stages_ms"].items())
+    logger.info(
+        "Preprocessed image: %d -> %d bytes (saved %d, %.1fx), %dx%d, %s",
+        stats["original_bytes"], stats["processed_bytes"], saved, ratio,
+        stats["size"][0], stats["size"][1], timings,
+    )
@@ -0,0 +1,126 @@
+"""Background jobs that keep running, and keep their results, independently of any Streamlit script run."""
+
+import logging
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+FINISHED_STATUSES = (DONE, FAILED)
+
+
+class Job:
+    """State of one background job; written by its worker thread and read by any session."""
+
+    def __init__(self, job_id, key=None):
+        self.id = job_id
+        self.key = key
+        self.status = QUEUED
+        self.stage = ""
+        self.queue_position = None
+        # Which step queue_position refers to
+        self.queue_stage = None
+        self.result = None
+        self.error = None
+        self.error_type = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.streams = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"Job({self.id!r}, {self.status})"
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATUSES
+
+    @property
+    def elapsed(self):
+        """Seconds since the job was submitted, up to when it finished."""
+        return (self.finished_at or time.time()) - self.created_at
+
+    def update(self, **fields):
+        """Set progress fields such as stage or queue_position."""
+        with self._lock:
+            for name, value in fields.items():
+                setattr(self, name, value)
+
+    def stream(self, name):
+        """Return the list partial output for `name` is appended to (list.append is thread-safe)."""
+        with self._lock:
+            return self.streams.setdefault(name, [])
+
+    def stream_text(self, name):
+        """Return the partial output received so far for `name`."""
+        return "".join(self.streams.get(name, ()))
+
+
+class JobManager:
+    """Runs jobs on an executor and keeps them by id until they expire.
+
+    Submitting with a key that matches an unfinished job returns that job instead of
+    starting a duplicate, so several sessions can attach to the same work.
+    """
+
+    def __init__(self, executor, retention_seconds=3600, max_jobs=500):
+        self.executor = executor
+        self.retention_seconds = retention_seconds
+        self.max_jobs = max_jobs
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, key=None, **kwargs):
+        """Start fn(job, *args, **kwargs) in the background and return its Job."""
+        with self._lock:
+            if key is not None:
+                for job in self._jobs.values():
+                    if job.key == key and not job.finished:
+                        return job
+            self._prune()
+            job = Job(uuid.uuid4().hex[:12], key)
+            self._jobs[job.id] = job
+        self.executor.submit(self._run, job, fn, args, kwargs)
+        return job
+
+    def get(self, job_id):
+        """Return the job with this id, or None if it never existed or has expired."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job, fn, args, kwargs):
+        job.update(status=RUNNING, started_at=time.time())
+        try:
+            result = fn(job, *args, **kwargs)
+        except Exception as e:
+            logger.exception("Job %s failed", job.id)
+            job.update(status=FAILED, error=str(e), error_type=type(e).__name__, finished_at=time.time())
+        else:
+            job.update(status=DONE, result=result, queue_position=None, finished_at=time.time())
+
+    def _prune(self):
+        """Forget expired finished jobs, then the oldest finished ones over max_jobs; the caller holds the lock."""
+        now = time.time()
+        finished = sorted(
+            (job for job in self._jobs.values() if job.finished), key=lambda job: job.finished_at
+        )
+        excess = len(self._jobs) - self.max_jobs + 1
+        for job in finished:
+            if now - job.finished_at > self.retention_seconds or excess > 0:
+                del self._jobs[job.id]
+                excess -= 1
+
+    def stats(self):
+        """Return the number of known jobs in each status."""
+        with self._lock:
+            counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+            for job in self._jobs.values():
+                counts[job.status] += 1
+        return counts
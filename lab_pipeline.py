@@ -0,0 +1,490 @@
+"""Streamlit-free lab report pipeline shared by the web app and the batch CLI."""
+
+import contextvars
+import logging
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from analysis_cache import hash_text, make_cache_key
+from cassette import REPLAY, get_cassette
+from image_preprocessing import preprocess_image
+from lab_results import STRUCTURED_RESULTS_INSTRUCTIONS, parse_structured_results
+from near_duplicates import same_results
+from pdf_reports import NO_LAB_VALUES, extract_pages
+from prompt_builder import compact_profile, summarize_findings
+from rate_limiter import queue_callback, report_queue_position
+from reference_ranges import fill_reference_ranges
+from token_usage import get_token_ledger, run_metrics, usage_from_metrics
+from tracing import span
+
+logger = logging.getLogger(__name__)
+
+MODEL_ID = "gemini-2.0-flash-exp"
+
+# Image preprocessing applied before the report is sent to the model
+IMAGE_PREPROCESSING = True
+IMAGE_PREPROCESSING_OPTIONS = {
+    "max_long_edge": 2048,
+    "grayscale": False,
+    "autocontrast": False,
+    "output_format": "JPEG",
+    "quality": 85,
+}
+
+# Multi-page PDF reports
+PDF_MAX_PAGES = 20
+PDF_RENDER_DPI = 150
+PDF_MIN_TEXT_CHARS = 200
+
+# Recommendations are generated one section per request when enabled
+PARALLEL_RECOMMENDATIONS = True
+
+RECOMMENDATION_SECTIONS = [
+    ("🍽️ Meal Plans", "Specific meal plans and recipes with breakfast, lunch, dinner, and snack suggestions"),
+    ("🏃 Exercise Routines", "Detailed exercise routines with specific types, duration, and frequency of physical activities"),
+    ("🌙 Lifestyle Modifications", "Lifestyle modifications covering sleep schedule, stress management, and habits to change"),
+    ("🌿 Natural Remedies & Supplements", "Safe, evidence-based natural remedies and supplements"),
+    ("📈 Monitoring Tips", "Monitoring and tracking tips to follow progress and improvements"),
+    ("⏱️ Timeline", "Timeline for expected improvements with these lifestyle changes"),
+]
+
+# Profile fields each recommendations section is given (see prompt_builder.PROFILE_FIELDS)
+SECTION_PROFILE_FIELDS = {
+    "🍽️ Meal Plans": ["age", "sex", "conditions", "medications", "diet"],
+    "🏃 Exercise Routines": ["age", "sex", "activity", "conditions"],
+    "🌙 Lifestyle Modifications": ["age", "activity", "conditions"],
+    "🌿 Natural Remedies & Supplements": ["age", "sex", "conditions", "medications", "diet"],
+    "📈 Monitoring Tips": ["conditions", "medications"],
+    "⏱️ Timeline": ["age", "conditions"],
+}
+
+ANALYSIS_PROMPT = "Analyze this lab report image and provide comprehensive health insights in simple, easy-to-understand language. Include all test values, explain abnormal results, and provide specific lifestyle and dietary recommendations."
+
+PAGE_ANALYSIS_PROMPT = """
+This is page {page} of a multi-page lab report. Extract every test on this page with its value, unit, reference range, and whether it is HIGH, LOW, or NORMAL.
+Only report what is on this page; the pages will be combined afterwards.
+If this page contains no lab test results, reply with exactly {marker}.
+"""
+
+SYSTEM_PROMPT = """
+You are an expert medical lab report analyzer with specialized knowledge in interpreting laboratory test results and providing health insights in simple, easy-to-understand language.
+
+Your role is to analyze medical lab reports from images, identify all test parameters with their values and reference ranges, and provide comprehensive health insights in layman's terms.
+
+Focus on:
+1. Extracting all test parameters, values, and reference ranges
+2. Identifying which parameters are within normal limits and which are abnormal
+3. Explaining what each abnormal parameter means in simple terms
+4. Providing specific lifestyle and dietary recommendations for abnormal values
+5. Suggesting when to consult a healthcare provider
+"""
+
+INSTRUCTIONS = """
+Analyze the lab report image and provide information in this structured format:
+
+**Test Summary:**
+- List all tests performed with their values and reference ranges
+- Clearly mark which values are HIGH, LOW, or NORMAL
+
+**What Your Results Mean (In Simple Terms):**
+- Explain each abnormal result in easy-to-understand language
+- Avoid medical jargon and use everyday terms
+- Explain potential health implications
+
+**Lifestyle Changes Needed:**
+- Provide specific, actionable lifestyle modifications for abnormal values
+- Include exercise recommendations, sleep habits, stress management
+- Be specific about duration and frequency
+
+**Diet Recommendations:**
+- Suggest specific foods to eat more of
+- List foods to avoid or limit
+- Provide meal planning tips if relevant
+- Include hydration recommendations
+
+**When to See a Doctor:**
+- Indicate urgency level (immediate, within days, routine follow-up)
+- Explain red flags that require immediate attention
+- Suggest which specialist to consult if needed
+
+**Follow-up Testing:**
+- Recommend when to retest
+- Suggest additional tests if needed
+
+Always emphasize that this analysis is for educational purposes and should not replace professional medical advice.
+"""
+
+FOLLOW_UP_PROMPT = """
+You are a health and wellness expert giving personalized lifestyle and dietary recommendations for abnormal lab findings.
+Make every recommendation practical, specific (foods, amounts, durations, frequencies) and easy to follow for the average person, and respect the person's conditions, medications and dietary restrictions.
+"""
+
+RECOMMENDATIONS_QUERY = """Abnormal lab findings:
+{findings}
+
+Profile: {profile}
+
+Provide detailed, personalized recommendations with these sections: meal plans and recipes (breakfast, lunch, dinner, snacks); exercise routines (type, duration, frequency); lifestyle modifications (sleep, stress, habits); safe evidence-based natural remedies and supplements; monitoring and tracking tips; timeline for expected improvements."""
+
+SECTION_QUERY = """Abnormal lab findings:
+{findings}
+
+Profile: {profile}
+
+Provide only this part of the personalized recommendations: {focus}.
+Be detailed and specific. Do not repeat the lab results and do not cover other topics."""
+
+REFERENCE_RANGE_INSTRUCTIONS = """
+When the report does not print a reference range for a test, call lookup_reference_range first and only search the web for tests it does not know.
+"""
+
+SECTION_TIMEOUT_NOTE = "_This section is taking longer than expected. Please run the analysis again to include it._"
+# Seconds in total a section may wait for a worker or a model slot on top of its own timeout
+SECTION_MAX_QUEUE_SECONDS = 600
+# Seconds between checks on a section whose clock may still move
+SECTION_POLL_SECONDS = 0.5
+
+
+def create_lab_analyzer_agent(google_api_key=None, tavily_api_key=None, search_cache=None, search_limiter=None):
+    """Build a new lab report analyzer agent (keys fall back to the environment).
+
+    Web searches go through search_cache, or the process-wide in-memory cache when None,
+    and live searches are rate limited by search_limiter when given. When a cassette is
+    configured, calls are recorded, or answered from it without building an agent.
+    """
+    cassette = get_cassette()
+    if cassette is not None and cassette.mode == REPLAY:
+        return cassette.wrap(None, "lab_analyzer")
+
+    # phidata and the Gemini SDK are slow to import, so load them with the first agent
+    from phi.agent import Agent
+    from phi.model.google import Gemini
+
+    from agent_tools import CachedTavilyTools, ReferenceRangeTools
+
+    agent = Agent(
+        model=Gemini(id=MODEL_ID, api_key=google_api_key),
+        system_prompt=SYSTEM_PROMPT,
+        instructions=INSTRUCTIONS + REFERENCE_RANGE_INSTRUCTIONS + STRUCTURED_RESULTS_INSTRUCTIONS,
+        tools=[
+            ReferenceRangeTools(),
+            CachedTavilyTools(cache=search_cache, limiter=search_limiter, api_key=tavily_api_key),
+        ],
+        markdown=True,
+    )
+    return cassette.wrap(agent, "lab_analyzer") if cassette is not None else agent
+
+
+def create_lifestyle_agent(google_api_key=None, tavily_api_key=None, search_cache=None, search_limiter=None):
+    """Build a new lifestyle recommendations agent (keys fall back to the environment)."""
+    cassette = get_cassette()
+    if cassette is not None and cassette.mode == REPLAY:
+        return cassette.wrap(None, "lifestyle")
+
+    from phi.agent import Agent
+    from phi.model.google import Gemini
+
+    from agent_tools import CachedTavilyTools
+
+    agent = Agent(
+        model=Gemini(id=MODEL_ID, api_key=google_api_key),
+        system_prompt=FOLLOW_UP_PROMPT,
+        tools=[CachedTavilyTools(cache=search_cache, limiter=search_limiter, api_key=tavily_api_key)],
+        markdown=True,
+    )
+    return cassette.wrap(agent, "lifestyle") if cassette is not None else agent
+
+
+def run_agent(agent, message, images=None, on_chunk=None, stage="model", usage=None):
+    """Run an agent and return its text; streams each chunk to on_chunk when given.
+
+    The call's token usage is recorded in the process-wide ledger under `stage`
+    and appended to the usage list when one is given.
+    """
+    started = time.monotonic()
+    with span(stage) as attributes:
+        if on_chunk is None:
+            response = agent.run(message, images=images)
+            content = response.content.strip()
+        else:
+            response = None
+            parts = []
+            for chunk in agent.run(message, stream=True, images=images):
+                if chunk.content:
+                    parts.append(chunk.content)
+                    on_chunk(chunk.content)
+            content = "".join(parts).strip()
+        call_usage = usage_from_metrics(run_metrics(agent, response))
+        attributes.update(call_usage)
+
+    call = get_token_ledger().record(stage, call_usage, time.monotonic() - started)
+    if usage is not None:
+        usage.append(call)
+    return content
+
+
+def analysis_message(report_text=None):
+    """Return the analyzer message for an image, or for report text when given."""
+    if report_text is None:
+        return ANALYSIS_PROMPT
+    return ANALYSIS_PROMPT.replace("lab report image", "lab report") + f"\n\nLab report content:\n{report_text}"
+
+
+def recommendations_query(findings, user_profile, focus=None, fields=None):
+    """Return the lifestyle agent query, for all sections or a single focus.
+
+    findings is the compact summary from summarize_findings; only the profile
+    fields listed in `fields` are included when given.
+    """
+    profile = compact_profile(user_profile, fields)
+    if focus is not None:
+        return SECTION_QUERY.format(findings=findings, profile=profile, focus=focus)
+    return RECOMMENDATIONS_QUERY.format(findings=findings, profile=profile)
+
+
+def prepare_model_image(file_bytes):
+    """Return the bytes to send to the model for an image upload."""
+    if not IMAGE_PREPROCESSING:
+        return file_bytes
+    with span("preprocess_image"):
+        processed, _, _ = preprocess_image(file_bytes, **IMAGE_PREPROCESSING_OPTIONS)
+    return processed
+
+
+def read_pdf_pages(pdf_data, executor=None):
+    """Split a PDF into pages and drop the ones that cannot contain lab results."""
+    with span("read_pdf"):
+        pages = extract_pages(
+            pdf_data,
+            executor,
+            dpi=PDF_RENDER_DPI,
+            max_pages=PDF_MAX_PAGES,
+            min_text_chars=PDF_MIN_TEXT_CHARS,
+        )
+    return [page for page in pages if page["has_lab_values"]]
+
+
+def analyze_pdf_page(create_agent, page, usage=None):
+    """Extract the lab results from one PDF page on a fresh agent (safe in worker threads)."""
+    prompt = PAGE_ANALYSIS_PROMPT.format(page=page["page"], marker=NO_LAB_VALUES)
+    agent = create_agent()
+    if page["text"] is not None:
+        return run_agent(agent, f"{prompt}\n\nPage text:\n{page['text']}", stage="pdf_page", usage=usage)
+    return run_agent(agent, prompt, images=[page["image"]], stage="pdf_page", usage=usage)
+
+
+def merge_page_results(pages, contents):
+    """Combine per-page findings into report text, skipping pages without results."""
+    page_results = [
+        f"### Page {page['page']}\n\n{content}"
+        for page, content in zip(pages, contents)
+        if content and NO_LAB_VALUES not in content
+    ]
+    if not page_results:
+        return None
+    return "Results extracted from each page of a multi-page report:\n\n" + "\n\n".join(page_results)
+
+
+def generate_recommendation_section(create_agent, findings, user_profile, title, focus, chunks=None, usage=None):
+    """Generate one recommendations section on a fresh agent (safe in worker threads).
+
+    When a chunks list is given, the response is streamed and partial text is appended to it.
+    """
+    query = recommendations_query(findings, user_profile, focus, SECTION_PROFILE_FIELDS.get(title))
+    on_chunk = chunks.append if chunks is not None else None
+    return run_agent(create_agent(), query, on_chunk=on_chunk, stage=f"recommendations: {title}", usage=usage)
+
+
+def run_recommendation_section(clocks, index, *args):
+    """Run one section, setting clocks[index] when it starts and again after each rate limiter wait."""
+    clocks[index] = time.monotonic()
+    outer = queue_callback.get()
+
+    def on_wait(position, waited):
+        clocks[index] = time.monotonic()
+        if outer is not None:
+            outer(position, waited)
+
+    with report_queue_position(on_wait):
+        return generate_recommendation_section(*args)
+
+
+def submit_recommendation_sections(executor, create_agent, findings, user_profile, buffers=None, usage=None):
+    """Start every recommendations section on the executor.
+
+    Returns the futures in section order and the list of their start times (None until started).
+    """
+    buffers = buffers or [None] * len(RECOMMENDATION_SECTIONS)
+    clocks = [None] * len(RECOMMENDATION_SECTIONS)
+    futures = [
+        executor.submit(
+            contextvars.copy_context().run,
+            run_recommendation_section, clocks, index,
+            create_agent, findings, user_profile, title, focus, chunks, usage,
+        )
+        for index, ((title, focus), chunks) in enumerate(zip(RECOMMENDATION_SECTIONS, buffers))
+    ]
+    return futures, clocks
+
+
+def wait_for_section(future, clocks, index, section_timeout, max_queue_seconds=SECTION_MAX_QUEUE_SECONDS):
+    """Return a section's result, allowing section_timeout from when it started work.
+
+    Time queued for a worker or a rate limiter slot does not count, up to max_queue_seconds
+    in total. Raises FutureTimeoutError when the section runs out of time.
+    """
+    hard_deadline = time.monotonic() + max_queue_seconds + section_timeout
+    while not future.done():
+        started = clocks[index]
+        deadline = hard_deadline if started is None else min(started + section_timeout, hard_deadline)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise FutureTimeoutError()
+        try:
+            return future.result(timeout=min(remaining, SECTION_POLL_SECONDS))
+        except FutureTimeoutError:
+            continue
+    return future.result()
+
+
+def collect_recommendation_sections(futures, clocks, section_timeout):
+    """Wait for every section and merge them in section order.
+
+    Returns (merged markdown, number of sections that completed).
+    """
+    sections = []
+    completed = 0
+    for index, ((title, _), future) in enumerate(zip(RECOMMENDATION_SECTIONS, futures)):
+        try:
+            content = wait_for_section(future, clocks, index, section_timeout)
+            completed += 1
+        except FutureTimeoutError:
+            future.cancel()
+            content = SECTION_TIMEOUT_NOTE
+        except Exception as e:
+            content = f"_This section could not be generated: {e}_"
+        sections.append(f"### {title}\n\n{content}")
+    return "\n\n".join(sections), completed
+
+
+def prompt_hash():
+    """Hash the prompts and settings that shape an analysis and its recommendations."""
+    sections = repr(RECOMMENDATION_SECTIONS) if PARALLEL_RECOMMENDATIONS else ""
+    preprocessing = repr(sorted(IMAGE_PREPROCESSING_OPTIONS.items())) if IMAGE_PREPROCESSING else ""
+    return hash_text(
+        SYSTEM_PROMPT + INSTRUCTIONS + REFERENCE_RANGE_INSTRUCTIONS + STRUCTURED_RESULTS_INSTRUCTIONS
+        + FOLLOW_UP_PROMPT + RECOMMENDATIONS_QUERY + SECTION_QUERY + repr(SECTION_PROFILE_FIELDS)
+        + sections + preprocessing
+    )
+
+
+def analysis_version():
+    """Identify the current model, prompts and settings; cached analyses from other versions are stale."""
+    return hash_text(MODEL_ID + prompt_hash())
+
+
+def analysis_cache_key(file_bytes, user_profile):
+    """Build the analysis cache key for an upload under the current model, prompts and settings."""
+    return make_cache_key(file_bytes, MODEL_ID, prompt_hash(), user_profile)
+
+
+def extract_results(raw_analysis, user_profile=None):
+    """Split an analyzer answer into (narrative, results, errors), filling missing ranges for the profile."""
+    narrative, results, errors = parse_structured_results(raw_analysis)
+    return narrative, fill_reference_ranges(results, user_profile), errors
+
+
+def find_reusable_recommendations(analysis_cache, raw_analysis, cache_keys, user_profile=None):
+    """Return the recommendations cached under the first of cache_keys whose analysis read the same results.
+
+    cache_keys are earlier uploads that look like this one; a look-alike is a different report
+    unless its results match, so None is returned when none of them do.
+    """
+    _, results, _ = extract_results(raw_analysis, user_profile)
+    for cache_key in cache_keys:
+        # Checking candidates is not a cache lookup for this upload, so it stays out of the hit rate
+        cached = analysis_cache.peek(cache_key)
+        if not cached or not cached["recommendations"]:
+            continue
+        _, earlier_results, _ = extract_results(cached["analysis"], user_profile)
+        if same_results(results, earlier_results):
+            return cached["recommendations"]
+    return None
+
+
+def recommendation_findings(raw_analysis, user_profile=None):
+    """Return the compact abnormal findings of an analyzer answer for the recommendations prompts."""
+    narrative, results, _ = extract_results(raw_analysis, user_profile)
+    return summarize_findings(results, narrative)
+
+
+def analyze_report(create_agent, data, is_pdf=False, process_pool=None, page_executor=None, on_chunk=None,
+                   usage=None):
+    """Run the full analysis for one report without any UI, returning the raw analyzer answer.
+
+    The answer ends with the structured results block; see lab_results.parse_structured_results.
+
+    PDF pages are read on process_pool and analyzed on page_executor when given. The final
+    analysis is streamed to on_chunk when given, and each call's token usage is appended
+    to usage when given.
+    """
+    if not is_pdf:
+        try:
+            image = prepare_model_image(data)
+        except Exception as e:
+            logger.warning("Could not optimize image, sending the original: %s", e)
+            image = data
+        return run_agent(
+            create_agent(), analysis_message(), images=[image], on_chunk=on_chunk, stage="analysis", usage=usage
+        )
+
+    pages = read_pdf_pages(data, process_pool)
+    if not pages:
+        raise ValueError("no lab test results were found in this PDF")
+    if len(pages) == 1:
+        page = pages[0]
+        images = [page["image"]] if page["text"] is None else None
+        return run_agent(
+            create_agent(), analysis_message(page["text"]), images=images, on_chunk=on_chunk,
+            stage="analysis", usage=usage,
+        )
+
+    if page_executor is None:
+        contents = [analyze_pdf_page(create_agent, page, usage) for page in pages]
+    else:
+        # Copy the context so page spans stay under the caller's trace
+        futures = [
+            page_executor.submit(contextvars.copy_context().run, analyze_pdf_page, create_agent, page, usage)
+            for page in pages
+        ]
+        contents = [future.result() for future in futures]
+    merged_pages = merge_page_results(pages, contents)
+    if merged_pages is None:
+        raise ValueError("no lab test results were found in this PDF")
+    return run_agent(
+        create_agent(), analysis_message(merged_pages), on_chunk=on_chunk, stage="analysis", usage=usage
+    )
+
+
+def generate_recommendations(create_agent, findings, user_profile, executor=None, section_timeout=45,
+                             buffers=None, usage=None):
+    """Generate the lifestyle recommendations without any UI.
+
+    Returns (recommendations, complete): recommendations is None if nothing completed, and
+    complete is False when any section timed out or failed, so the text must not be cached.
+    findings is the compact summary from recommendation_findings. Each section gets
+    section_timeout seconds from when it starts work. When buffers (one list per
+    section) are given, partial output is appended to them; without sections, everything is
+    streamed to the first one. Each call's token usage is appended to usage when given.
+    """
+    if not PARALLEL_RECOMMENDATIONS or executor is None:
+        on_chunk = buffers[0].append if buffers else None
+        recommendations = run_agent(
+            create_agent(), recommendations_query(findings, user_profile), on_chunk=on_chunk,
+            stage="recommendations", usage=usage,
+        )
+        return recommendations, bool(recommendations)
+
+    futures, clocks = submit_recommendation_sections(executor, create_agent, findings, user_profile, buffers, usage)
+    recommendations, completed = collect_recommendation_sections(futures, clocks, section_timeout)
+    return (recommendations if completed else None), completed == len(RECOMMENDATION_SECTIONS)
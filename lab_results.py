@@ -0,0 +1,166 @@
+"""Typed, compact records for the lab test results extracted by the analyzer."""
+
+import json
+import re
+
+FLAGS = ("LOW", "NORMAL", "HIGH", "ABNORMAL", "UNKNOWN")
+
+# The analyzer ends its answer with this marker followed by a fenced JSON array
+RESULTS_MARKER = "LAB_RESULTS_JSON"
+
+STRUCTURED_RESULTS_INSTRUCTIONS = f"""
+
+After the analysis, output a line containing only {RESULTS_MARKER}, followed by a ```json code block holding an array with one object per test:
+{{"parameter": str, "value": number or string, "unit": str or null, "reference_low": number or null, "reference_high": number or null, "reference_range": str or null, "flag": "LOW" | "NORMAL" | "HIGH" | "ABNORMAL" | "UNKNOWN"}}
+Use numbers (not strings) for numeric values and limits. Do not add anything after the code block.
+"""
+
+JSON_BLOCK_PATTERN = re.compile(r"```(?:json)?\s*(\[.*?\])\s*```", re.DOTALL)
+NUMBER_PATTERN = re.compile(r"^[<>≤≥=~]?\s*(-?\d+(?:\.\d+)?)")
+# A comma followed by exactly three digits groups thousands ("250,000", "1,200"); any other
+# comma between digits is a decimal point ("4,5", "0,125")
+THOUSANDS_PATTERN = re.compile(r"(?<![\d.,])[1-9]\d{0,2}(?:,\d{3})+(?![\d,])")
+DECIMAL_COMMA_PATTERN = re.compile(r"(?<=\d),(?=\d)")
+
+
+def _remove_thousands_separators(match):
+    return match.group(0).replace(",", "")
+
+
+def normalize_numbers(text):
+    """Rewrite the numbers in text with "." as the decimal point and no thousands separators."""
+    return DECIMAL_COMMA_PATTERN.sub(".", THOUSANDS_PATTERN.sub(_remove_thousands_separators, text))
+
+
+class LabResult:
+    """One extracted test result; __slots__ keeps each record small and fixed-size."""
+
+    __slots__ = (
+        "parameter",
+        "value",
+        "value_text",
+        "unit",
+        "reference_low",
+        "reference_high",
+        "reference_range",
+        "flag",
+    )
+
+    def __init__(self, parameter, value=None, value_text="", unit=None, reference_low=None,
+                 reference_high=None, reference_range=None, flag="UNKNOWN"):
+        self.parameter = parameter
+        self.value = value
+        self.value_text = value_text
+        self.unit = unit
+        self.reference_low = reference_low
+        self.reference_high = reference_high
+        self.reference_range = reference_range
+        self.flag = flag
+
+    def __repr__(self):
+        return f"LabResult({self.parameter!r}, {self.value_text!r} {self.unit or ''}, {self.flag})"
+
+    def __eq__(self, other):
+        return isinstance(other, LabResult) and self.as_tuple() == other.as_tuple()
+
+    def as_tuple(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @property
+    def is_abnormal(self):
+        return self.flag in ("LOW", "HIGH", "ABNORMAL")
+
+
+def _to_number(value, field):
+    """Coerce a JSON number or numeric string to float; None stays None."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f"{field} must be a number, got {value!r}")
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = NUMBER_PATTERN.match(normalize_numbers(str(value).strip()))
+    if match is None:
+        raise ValueError(f"{field} must be a number, got {value!r}")
+    return float(match.group(1))
+
+
+def validate_result(entry):
+    """Validate one raw JSON object against the result schema and build a LabResult."""
+    if not isinstance(entry, dict):
+        raise ValueError(f"result must be an object, got {type(entry).__name__}")
+    parameter = str(entry.get("parameter") or "").strip()
+    if not parameter:
+        raise ValueError("result is missing its parameter name")
+
+    raw_value = entry.get("value")
+    value_text = "" if raw_value is None else str(raw_value).strip()
+    try:
+        value = _to_number(raw_value, "value")
+    except ValueError:
+        # Qualitative results such as "Negative" keep their text only
+        value = None
+
+    flag = str(entry.get("flag") or "UNKNOWN").strip().upper()
+    if flag not in FLAGS:
+        raise ValueError(f"{parameter}: unknown flag {flag!r}")
+
+    unit = entry.get("unit")
+    reference_range = entry.get("reference_range")
+    return LabResult(
+        parameter=parameter,
+        value=value,
+        value_text=value_text,
+        unit=str(unit).strip() if unit else None,
+        reference_low=_to_number(entry.get("reference_low"), f"{parameter} reference_low"),
+        reference_high=_to_number(entry.get("reference_high"), f"{parameter} reference_high"),
+        reference_range=str(reference_range).strip() if reference_range else None,
+        flag=flag,
+    )
+
+
+def strip_structured_results(text):
+    """Return the narrative part of an analysis, without the structured results block."""
+    if not text:
+        return text
+    index = text.find(RESULTS_MARKER)
+    if index == -1:
+        return text
+    return text[:index].rstrip()
+
+
+def parse_structured_results(text):
+    """Split an analyzer answer into (narrative, list of LabResult, list of validation errors)."""
+    narrative = strip_structured_results(text)
+    index = (text or "").find(RESULTS_MARKER)
+    if index == -1:
+        return narrative, [], []
+
+    match = JSON_BLOCK_PATTERN.search(text, index)
+    if match is None:
+        return narrative, [], ["structured results block is missing or not a JSON array"]
+    try:
+        entries = json.loads(match.group(1))
+    except json.JSONDecodeError as e:
+        return narrative, [], [f"structured results are not valid JSON: {e}"]
+
+    results = []
+    errors = []
+    for entry in entries:
+        try:
+            results.append(validate_result(entry))
+        except ValueError as e:
+            errors.append(str(e))
+    return narrative, results, errors
+
+
+def results_to_frame(results):
+    """Return the results as a columnar pandas DataFrame."""
+    import pandas as pd
+
+    return pd.DataFrame.from_records(
+        [result.as_tuple() for result in results], columns=list(LabResult.__slots__)
+    )
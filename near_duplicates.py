@@ -0,0 +1,256 @@
+"""Perceptual hashes of report photos and an index for finding near-duplicate uploads.
+
+A re-photographed, cropped or re-encoded copy of a report has different bytes,
+so it misses the analysis cache, but its perceptual hash (pHash) stays within a
+few bits of the original's. The index keeps the hash of every analyzed upload
+in a BK-tree, which finds every hash within a Hamming distance without
+comparing against all of them.
+
+Reports from the same lab share a layout. Two different reports from one lab can
+hash as close together as two photos of the same report (often at distance 0),
+so a match only names candidates. Results are reused only after the new upload
+has been analyzed and same_results() finds it read the same values.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+from image_preprocessing import open_image
+
+# Bits per side of the hash; the hash has hash_size ** 2 - 1 bits
+HASH_SIZE = 8
+# Hashes at most this many bits apart are near-duplicates
+MAX_DISTANCE = 8
+# The DCT is taken over an image this many times the hash size per side
+DCT_FACTOR = 4
+# Pixels darker than this (0-255, after autocontrast) count as content when trimming margins
+CONTENT_THRESHOLD = 195
+
+
+def perceptual_hash(data, hash_size=HASH_SIZE):
+    """Return the pHash of an image as an int: the signs of its lowest DCT frequencies around their median.
+
+    Margins are trimmed first, so a tighter or looser crop of the same page hashes alike.
+    """
+    import numpy as np
+    from PIL import Image, ImageOps
+
+    size = hash_size * DCT_FACTOR
+    img = open_image(data)
+    if img.format == "JPEG":
+        img.draft("L", (size * 4, size * 4))
+    img = ImageOps.exif_transpose(img).convert("L")
+    img = ImageOps.autocontrast(img, cutoff=1)
+    content = img.point(lambda value: 255 if value < CONTENT_THRESHOLD else 0).getbbox()
+    if content:
+        img = img.crop(content)
+    pixels = np.asarray(img.resize((size, size), Image.Resampling.LANCZOS), dtype=np.float64)
+
+    k = np.arange(size)
+    dct = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * size))
+    frequencies = (dct @ pixels @ dct.T)[:hash_size, :hash_size].flatten()[1:]
+    bits = frequencies > np.median(frequencies)
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def result_signature(results):
+    """Return the set of (parameter, value, unit) read from a report, ignoring case and spacing."""
+
+    def normalize(text):
+        return " ".join(str(text or "").lower().split())
+
+    return frozenset(
+        (normalize(result.parameter), result.value if result.value is not None else normalize(result.value_text),
+         normalize(result.unit))
+        for result in results
+    )
+
+
+def same_results(results, other_results):
+    """Return True if two analyses read exactly the same non-empty set of test results."""
+    signature = result_signature(results)
+    return bool(signature) and signature == result_signature(other_results)
+
+
+class BKTree:
+    """Burkhard-Keller tree over integer hashes under the Hamming distance.
+
+    Each node keeps its children by their distance to it, so a search for hashes
+    within d of a query only descends into children at distance (k - d)..(k + d),
+    where k is the query's distance to the node (the triangle inequality).
+    """
+
+    def __init__(self):
+        # node: [hash, values, {distance: child node}]
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, key, value):
+        self._size += 1
+        if self._root is None:
+            self._root = [key, [value], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming_distance(key, node[0])
+            if distance == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, [value], {}]
+                return
+            node = child
+
+    def search(self, key, max_distance):
+        """Return (distance, value) for every value within max_distance of key, nearest first."""
+        matches = []
+        pending = [self._root] if self._root is not None else []
+        while pending:
+            node = pending.pop()
+            distance = hamming_distance(key, node[0])
+            if distance <= max_distance:
+                matches.extend((distance, value) for value in node[1])
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    pending.append(child)
+        matches.sort(key=lambda match: match[0])
+        return matches
+
+
+class NearDuplicateIndex:
+    """Hashes of analyzed uploads with the analysis cache keys they were stored under.
+
+    Entries are kept in a BK-tree in memory and, when a path is given, in SQLite so
+    they survive restarts. Each entry records a scope (the session that uploaded it),
+    a digest of the user profile and the analysis version, so callers can restrict
+    matches to one session and tell whether the cached recommendations still apply.
+    An upload analyzed in several scopes has an entry in each.
+    The oldest entries are dropped beyond max_entries.
+    """
+
+    def __init__(self, path=None, max_entries=5000):
+        self.path = path
+        self.max_entries = max_entries
+        self.lookups = 0
+        self.matches = 0
+        self._entries = {}
+        self._tree = BKTree()
+        self._lock = threading.Lock()
+        self._conn = None
+
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            # The earlier table held one scope per upload; its entries are only a cache
+            self._conn.execute("DROP TABLE IF EXISTS image_hashes")
+            # An empty scope stands for None, which a primary key cannot hold
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS upload_hashes (
+                    cache_key TEXT NOT NULL,
+                    scope TEXT NOT NULL,
+                    hash TEXT NOT NULL,
+                    profile TEXT,
+                    version TEXT,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (cache_key, scope)
+                )
+                """
+            )
+            self._conn.commit()
+            rows = self._conn.execute(
+                "SELECT cache_key, hash, scope, profile, version, created_at FROM upload_hashes ORDER BY created_at"
+            ).fetchall()
+            for cache_key, image_hash, scope, profile, version, created_at in rows:
+                self._entries[cache_key, scope or None] = {
+                    "cache_key": cache_key,
+                    "hash": int(image_hash, 16),
+                    "scope": scope or None,
+                    "profile": profile,
+                    "version": version,
+                    "created_at": created_at,
+                }
+        self._rebuild()
+
+    def _rebuild(self):
+        """Drop the oldest entries beyond max_entries and rebuild the tree; the caller holds the lock."""
+        entries = sorted(self._entries.values(), key=lambda entry: entry["created_at"])
+        stale = entries[:max(0, len(entries) - self.max_entries)]
+        for entry in stale:
+            del self._entries[entry["cache_key"], entry["scope"]]
+        if stale and self._conn is not None:
+            self._conn.executemany(
+                "DELETE FROM upload_hashes WHERE cache_key = ? AND scope = ?",
+                [(entry["cache_key"], entry["scope"] or "") for entry in stale],
+            )
+            self._conn.commit()
+        self._tree = BKTree()
+        for key, entry in self._entries.items():
+            self._tree.add(entry["hash"], key)
+
+    def add(self, image_hash, cache_key, scope=None, profile=None, version=None):
+        """Record the hash of an upload whose analysis is cached under cache_key."""
+        scope = scope or None
+        entry = {
+            "cache_key": cache_key,
+            "hash": image_hash,
+            "scope": scope,
+            "profile": profile,
+            "version": version,
+            "created_at": time.time(),
+        }
+        key = (cache_key, scope)
+        with self._lock:
+            replaced = self._entries.get(key)
+            self._entries[key] = entry
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO upload_hashes (cache_key, hash, scope, profile, version, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (cache_key, format(image_hash, "x"), scope or "", profile, version, entry["created_at"]),
+                )
+                self._conn.commit()
+            # Rebuilding is only needed to forget a replaced hash or to prune, and pruning
+            # in batches of a tenth keeps it rare
+            if (replaced is not None and replaced["hash"] != image_hash) or \
+                    len(self._entries) > self.max_entries * 1.1:
+                self._rebuild()
+            elif replaced is None:
+                self._tree.add(image_hash, key)
+
+    def find(self, image_hash, max_distance=MAX_DISTANCE, scope=None, version=None):
+        """Return the entries within max_distance bits of a hash, nearest first, with their distance.
+
+        Only entries from `scope` and recorded under `version` are returned when those are given.
+        """
+        with self._lock:
+            self.lookups += 1
+            matches = []
+            for distance, key in self._tree.search(image_hash, max_distance):
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if scope is not None and entry["scope"] != scope:
+                    continue
+                if version is not None and entry["version"] != version:
+                    continue
+                matches.append({**entry, "distance": distance})
+            if matches:
+                self.matches += 1
+        return matches
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "lookups": self.lookups, "matches": self.matches}
@@ -0,0 +1,91 @@
+"""Split multi-page PDF lab reports into per-page text or images for analysis."""
+
+import re
+from io import BytesIO
+
+import pypdfium2 as pdfium
+
+# Reply the model gives for pages that contain no lab results
+NO_LAB_VALUES = "NO_LAB_VALUES"
+
+# A number followed by a unit, or a numeric reference range such as "3.5-5.0" or "< 200"
+LAB_VALUE_PATTERN = re.compile(
+    r"\d+(?:\.\d+)?\s*(?:mg/dl|mmol/l|g/dl|g/l|u/l|iu/l|miu/l|ng/ml|pg/ml|ng/dl|µg/dl|ug/dl|meq/l|fl|pg|%|x10|10\^)"
+    r"|\d+(?:\.\d+)?\s*[-–]\s*\d+(?:\.\d+)?"
+    r"|[<>≤≥]\s*\d+(?:\.\d+)?",
+    re.IGNORECASE,
+)
+
+
+def get_page_count(data):
+    """Return the number of pages in a PDF."""
+    pdf = pdfium.PdfDocument(data)
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+
+def render_page(data, index, dpi=150, quality=85):
+    """Rasterize one page of a PDF to JPEG bytes."""
+    pdf = pdfium.PdfDocument(data)
+    try:
+        return _render(pdf[index], dpi, quality)
+    finally:
+        pdf.close()
+
+
+def has_lab_values(text, min_matches=3):
+    """Heuristically decide whether extracted page text contains lab results."""
+    return len(LAB_VALUE_PATTERN.findall(text or "")) >= min_matches
+
+
+def extract_page(data, index, dpi=150, min_text_chars=200):
+    """Return a page's text layer if it has one, otherwise a rasterized image of it.
+
+    Runs in a worker process, so it opens its own copy of the document.
+    """
+    pdf = pdfium.PdfDocument(data)
+    try:
+        page = pdf[index]
+        textpage = page.get_textpage()
+        text = textpage.get_text_range().strip()
+        textpage.close()
+
+        if len(text) >= min_text_chars:
+            return {
+                "page": index + 1,
+                "text": text,
+                "image": None,
+                "has_lab_values": has_lab_values(text),
+            }
+        return {
+            "page": index + 1,
+            "text": None,
+            "image": _render(page, dpi),
+            # Scanned pages can only be judged by the model
+            "has_lab_values": True,
+        }
+    finally:
+        pdf.close()
+
+
+def extract_pages(data, executor=None, dpi=150, max_pages=20, min_text_chars=200):
+    """Extract every page of a PDF, in parallel when an executor is given, in page order."""
+    page_count = min(get_page_count(data), max_pages)
+    if executor is None:
+        return [extract_page(data, index, dpi, min_text_chars) for index in range(page_count)]
+
+    futures = [
+        executor.submit(extract_page, data, index, dpi, min_text_chars)
+        for index in range(page_count)
+    ]
+    return [future.result() for future in futures]
+
+
+def _render(page, dpi, quality=85):
+    """Render a pdfium page to JPEG bytes."""
+    image = page.render(scale=dpi / 72).to_pil().convert("RGB")
+    buf = BytesIO()
+    image.save(buf, format="JPEG", quality=quality, optimize=True)
+    return buf.getvalue()
@@ -0,0 +1,80 @@
+"""Compact inputs for the lifestyle agent: the abnormal findings and only the profile fields a section needs."""
+
+import re
+
+from range_classifier import classify_results
+from reference_ranges import format_range
+
+# Profile lines written by the app, mapped to the short names used in prompts
+PROFILE_FIELDS = {
+    "age": "age",
+    "gender": "sex",
+    "sex": "sex",
+    "activity level": "activity",
+    "current health conditions": "conditions",
+    "current medications": "medications",
+    "dietary preferences": "diet",
+}
+EMPTY_PROFILE_VALUES = {"", "none", "none specified", "n/a", "na", "-"}
+
+ABNORMAL_STATUSES = ("LOW", "HIGH", "ABNORMAL")
+
+# Used when the analyzer returned no structured results
+FALLBACK_MAX_CHARS = 3000
+DISCLAIMER_PATTERN = re.compile(r"[^\n]*(?:educational purposes|replace professional medical advice)[^\n]*", re.IGNORECASE)
+MARKDOWN_PATTERN = re.compile(r"[*_`#>]+")
+
+PROFILE_LINE_PATTERN = re.compile(r"^\s*([A-Za-z][A-Za-z ]*?)\s*:\s*(.*?)\s*$")
+
+
+def parse_profile_fields(user_profile):
+    """Read the app's "Field: value" profile text into {short name: value}, skipping empty fields."""
+    fields = {}
+    for line in (user_profile or "").splitlines():
+        match = PROFILE_LINE_PATTERN.match(line)
+        if not match:
+            continue
+        name = PROFILE_FIELDS.get(match.group(1).lower())
+        value = " ".join(match.group(2).split())
+        if name and value.lower() not in EMPTY_PROFILE_VALUES:
+            fields[name] = value
+    return fields
+
+
+def compact_profile(user_profile, fields=None):
+    """Return the profile as one short line, restricted to `fields` when given."""
+    values = parse_profile_fields(user_profile)
+    names = fields if fields is not None else list(values)
+    parts = [f"{name}: {values[name]}" for name in names if name in values]
+    return "; ".join(parts) or "not given"
+
+
+def format_finding(result, status):
+    """Format one result as "Glucose 126 mg/dL HIGH (ref 70-99)"."""
+    value = f"{result.value_text} {result.unit or ''}".strip()
+    reference = result.reference_range or format_range(result.reference_low, result.reference_high)
+    text = f"{result.parameter} {value} {status}"
+    return f"{text} (ref {reference})" if reference else text
+
+
+def summarize_findings(results, narrative=None):
+    """Return the abnormal findings as compact lines for the recommendations prompt.
+
+    Normal results are left out. Without structured results, the narrative is sent
+    with its markdown and disclaimers removed, truncated to FALLBACK_MAX_CHARS.
+    """
+    if results:
+        classified = classify_results(results)
+        findings = [
+            format_finding(result, row.status)
+            for result, row in zip(results, classified.itertuples())
+            if row.status in ABNORMAL_STATUSES
+        ]
+        if findings:
+            return "\n".join(f"- {finding}" for finding in findings)
+        return f"All {len(results)} results are within their reference ranges."
+
+    text = DISCLAIMER_PATTERN.sub("", narrative or "")
+    text = MARKDOWN_PATTERN.sub("", text)
+    text = "\n".join(" ".join(line.split()) for line in text.splitlines() if line.strip())
+    return text[:FALLBACK_MAX_CHARS]
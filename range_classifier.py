@@ -0,0 +1,160 @@
+"""Vectorized classification of lab values against their reference ranges."""
+
+import re
+
+from lab_results import normalize_numbers
+
+_NUMBER = r"(-?\d+(?:\.\d+)?)"
+
+# Compiled once at import; pandas applies them to whole columns at a time
+RANGE_RE = re.compile(rf"^\s*{_NUMBER}\s*(?:-|–|—|to)\s*{_NUMBER}")
+UPPER_RE = re.compile(rf"^\s*(<=|≤|<|up to|upto|below|less than)\s*{_NUMBER}")
+LOWER_RE = re.compile(rf"^\s*(>=|≥|>|above|greater than|more than|over)\s*{_NUMBER}")
+VALUE_RE = re.compile(rf"^\s*(?:<=|≤|<|>=|≥|>|=|~)?\s*{_NUMBER}")
+
+QUALITATIVE_NORMAL = {
+    "negative", "non-reactive", "nonreactive", "non reactive", "absent", "nil", "none",
+    "not detected", "normal", "clear",
+}
+QUALITATIVE_ABNORMAL = {
+    "positive", "reactive", "present", "detected", "abnormal", "trace",
+}
+QUALITATIVE_VALUES = QUALITATIVE_NORMAL | QUALITATIVE_ABNORMAL
+
+PARSE_OK = "ok"
+PARSE_QUALITATIVE = "qualitative"
+PARSE_NO_REFERENCE = "no_reference"
+PARSE_BAD_REFERENCE = "unparsed_reference"
+PARSE_BAD_VALUE = "unparsed_value"
+
+
+def _clean(texts):
+    """Normalize a column of strings: str dtype, trimmed, lowercased, numbers as lab_results reads them."""
+    # pandas is imported on first use so importing this module stays cheap
+    import pandas as pd
+
+    return (
+        pd.Series(texts, dtype="object")
+        .fillna("")
+        .astype(str)
+        .str.strip()
+        .str.lower()
+        .map(normalize_numbers)
+    )
+
+
+def parse_reference_ranges(reference_ranges):
+    """Parse reference range strings into low/high limits and their inclusiveness.
+
+    Handles "x-y", "x to y", "<x", "≤x", ">x", "≥x" and qualitative references.
+    """
+    import pandas as pd
+
+    text = _clean(reference_ranges)
+
+    both = text.str.extract(RANGE_RE)
+    upper = text.str.extract(UPPER_RE)
+    lower = text.str.extract(LOWER_RE)
+
+    low = pd.to_numeric(both[0], errors="coerce").fillna(pd.to_numeric(lower[1], errors="coerce"))
+    high = pd.to_numeric(both[1], errors="coerce").fillna(pd.to_numeric(upper[1], errors="coerce"))
+
+    return pd.DataFrame({
+        "low": low,
+        "high": high,
+        # Only a bare "<x" or ">x" excludes the limit itself
+        "low_inclusive": ~lower[0].isin([">", "above", "greater than", "more than", "over"]),
+        "high_inclusive": ~upper[0].isin(["<", "below", "less than"]),
+        "qualitative": text.isin(QUALITATIVE_VALUES),
+        "qualitative_normal": text.isin(QUALITATIVE_NORMAL),
+        "empty": text.eq(""),
+    })
+
+
+def classify(values, reference_ranges, reference_low=None, reference_high=None):
+    """Classify many values at once against their reference ranges.
+
+    Numeric limits in reference_low/reference_high take precedence over limits parsed
+    from the reference text. Returns a DataFrame with value_num, low, high, status
+    (LOW, NORMAL, HIGH, ABNORMAL or UNKNOWN) and a per-row parse_status.
+    """
+    import numpy as np
+    import pandas as pd
+
+    value_text = _clean(values)
+    value_num = pd.to_numeric(value_text.str.extract(VALUE_RE)[0], errors="coerce")
+
+    ranges = parse_reference_ranges(reference_ranges)
+    ranges.index = value_text.index
+    low = ranges["low"]
+    high = ranges["high"]
+    if reference_low is not None:
+        low = pd.to_numeric(pd.Series(reference_low, index=value_text.index), errors="coerce").fillna(low)
+    if reference_high is not None:
+        high = pd.to_numeric(pd.Series(reference_high, index=value_text.index), errors="coerce").fillna(high)
+
+    value = value_num.to_numpy(dtype=float)
+    low_values = low.to_numpy(dtype=float)
+    high_values = high.to_numpy(dtype=float)
+    has_value = ~np.isnan(value)
+    has_limit = ~(np.isnan(low_values) & np.isnan(high_values))
+
+    with np.errstate(invalid="ignore"):
+        below = np.where(ranges["low_inclusive"], value < low_values, value <= low_values)
+        above = np.where(ranges["high_inclusive"], value > high_values, value >= high_values)
+
+    value_qualitative = value_text.isin(QUALITATIVE_VALUES).to_numpy()
+    reference_qualitative = ranges["qualitative"].to_numpy()
+    both_qualitative = value_qualitative & reference_qualitative
+    value_normal = value_text.isin(QUALITATIVE_NORMAL).to_numpy()
+    qualitative_match = both_qualitative & (value_normal == ranges["qualitative_normal"].to_numpy())
+
+    numeric = has_value & has_limit
+    status = np.select(
+        [numeric & below, numeric & above, numeric, qualitative_match, both_qualitative],
+        ["LOW", "HIGH", "NORMAL", "NORMAL", "ABNORMAL"],
+        default="UNKNOWN",
+    )
+
+    no_reference = ranges["empty"].to_numpy() & ~has_limit
+    parse_status = np.select(
+        [
+            both_qualitative,
+            no_reference,
+            ~has_limit & ~reference_qualitative,
+            ~has_value & ~value_qualitative,
+            reference_qualitative & ~value_qualitative,
+        ],
+        [PARSE_QUALITATIVE, PARSE_NO_REFERENCE, PARSE_BAD_REFERENCE, PARSE_BAD_VALUE, PARSE_BAD_VALUE],
+        default=PARSE_OK,
+    )
+
+    return pd.DataFrame({
+        "value_num": value_num,
+        "low": low,
+        "high": high,
+        "status": status,
+        "parse_status": parse_status,
+    }, index=value_text.index)
+
+
+def classify_results(results):
+    """Classify a list of LabResult records, falling back to the model's flag where undecidable."""
+    import pandas as pd
+
+    frame = pd.DataFrame({
+        "parameter": [result.parameter for result in results],
+        "value_text": [result.value_text for result in results],
+        "unit": [result.unit for result in results],
+        "reference_range": [result.reference_range for result in results],
+        "flag": [result.flag for result in results],
+    })
+    classified = classify(
+        frame["value_text"],
+        frame["reference_range"],
+        reference_low=[result.reference_low for result in results],
+        reference_high=[result.reference_high for result in results],
+    )
+    frame = frame.join(classified)
+    frame["status"] = frame["status"].where(frame["status"] != "UNKNOWN", frame["flag"])
+    return frame
@@ -0,0 +1,179 @@
+"""Process-wide rate limiting of model and search calls with a fair FIFO queue."""
+
+import contextvars
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Gemini bills a fixed number of input tokens per image
+IMAGE_TOKENS = 258
+# Output budget reserved up front for each call, corrected once the real usage is known
+DEFAULT_OUTPUT_TOKENS = 1024
+
+# Callback(position, waited_seconds) invoked while the current thread waits in a queue
+queue_callback = contextvars.ContextVar("queue_callback", default=None)
+
+
+@contextmanager
+def report_queue_position(callback):
+    """Report this thread's queue position to callback while waiting for a limiter."""
+    token = queue_callback.set(callback)
+    try:
+        yield
+    finally:
+        queue_callback.reset(token)
+
+
+def estimate_tokens(message, images=None):
+    """Roughly estimate the tokens a model call will use (about four characters per token)."""
+    return len(message or "") // 4 + IMAGE_TOKENS * len(images or []) + DEFAULT_OUTPUT_TOKENS
+
+
+class TokenBucket:
+    """Token bucket that refills `per_minute` tokens every minute, up to `capacity`."""
+
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` tokens are available; requests above capacity wait for a full bucket."""
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+
+class FairRateLimiter:
+    """Requests-per-minute and tokens-per-minute limiter shared by every caller in the process.
+
+    Callers are served strictly in arrival order, so a burst from one session cannot
+    starve another, and each waiting caller can be told its position in the queue.
+    """
+
+    def __init__(self, rpm=None, tpm=None, name="model", poll_interval=0.5):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.poll_interval = poll_interval
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._queue = deque()
+        self._condition = threading.Condition()
+
+    def _wait_time(self, tokens):
+        now = time.monotonic()
+        wait = 0.0
+        if self.requests is not None:
+            self.requests.refill(now)
+            wait = max(wait, self.requests.wait_time(1))
+        if self.tokens is not None:
+            self.tokens.refill(now)
+            wait = max(wait, self.tokens.wait_time(tokens))
+        return wait
+
+    def acquire(self, tokens=0, on_wait=None):
+        """Block until it is this caller's turn and the budget allows the call; returns seconds waited.
+
+        on_wait(position, waited_seconds) is called about every poll_interval while queued,
+        where position 1 means next in line, and once with position 0 when a queued caller
+        gets its slot. It defaults to the queue_callback of this context.
+        """
+        if self.requests is None and self.tokens is None:
+            return 0.0
+        on_wait = on_wait or queue_callback.get()
+        ticket = object()
+        started = time.monotonic()
+        queued = False
+        with self._condition:
+            self._queue.append(ticket)
+            try:
+                while True:
+                    if self._queue[0] is ticket:
+                        wait = self._wait_time(tokens)
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = self.poll_interval
+                    if on_wait is not None:
+                        queued = True
+                        position = self._queue.index(ticket) + 1
+                        self._condition.release()
+                        try:
+                            on_wait(position, time.monotonic() - started)
+                        finally:
+                            self._condition.acquire()
+                    self._condition.wait(min(wait, self.poll_interval))
+                if self.requests is not None:
+                    self.requests.tokens -= 1
+                if self.tokens is not None:
+                    self.tokens.tokens -= tokens
+            finally:
+                self._queue.remove(ticket)
+                self._condition.notify_all()
+
+            waited = time.monotonic() - started
+            self.acquired += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        if queued:
+            on_wait(0, waited)
+        return waited
+
+    def settle(self, estimated, actual):
+        """Correct the token budget once a call's real usage is known."""
+        if self.tokens is None or not actual:
+            return
+        with self._condition:
+            self.tokens.tokens -= actual - estimated
+            self._condition.notify_all()
+
+    def stats(self):
+        """Return queue depth, wait times and remaining budget."""
+        with self._condition:
+            return {
+                "name": self.name,
+                "queue_depth": len(self._queue),
+                "acquired": self.acquired,
+                "average_wait_seconds": self.total_wait / self.acquired if self.acquired else 0.0,
+                "max_wait_seconds": self.max_wait,
+                "requests_available": self.requests.tokens if self.requests else None,
+                "tokens_available": self.tokens.tokens if self.tokens else None,
+            }
+
+
+class RateLimitedAgent:
+    """Agent wrapper that waits for a limiter slot before every run and reports real token usage."""
+
+    def __init__(self, agent, limiter):
+        self.agent = agent
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        return getattr(self.agent, name)
+
+    def run(self, message=None, *args, stream=False, images=None, **kwargs):
+        estimated = estimate_tokens(message, images)
+        self.limiter.acquire(estimated)
+        response = self.agent.run(message, *args, stream=stream, images=images, **kwargs)
+        if not stream:
+            self._settle(estimated)
+            return response
+        return self._stream(response, estimated)
+
+    def _stream(self, chunks, estimated):
+        yield from chunks
+        self._settle(estimated)
+
+    def _settle(self, estimated):
+        """Replace the estimate with the usage phidata recorded for the run."""
+        run_response = getattr(self.agent, "run_response", None)
+        metrics = getattr(run_response, "metrics", None) or {}
+        actual = sum(metrics.get("input_tokens", [])) + sum(metrics.get("output_tokens", []))
+        self.limiter.settle(estimated, actual)
@@ -0,0 +1,186 @@
+"""Bundled knowledge base of common lab parameters and their reference ranges.
+
+Lets the pipeline look up normal ranges and flag results locally instead of
+asking the model to search the web for stable medical facts.
+"""
+
+import difflib
+import json
+import os
+import re
+from functools import lru_cache
+
+from lab_results import LabResult
+
+REFERENCE_RANGES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reference_ranges.json")
+
+# Fuzzy matching only kicks in for names this long, so "HDL" never matches "LDL"
+FUZZY_MIN_LENGTH = 5
+FUZZY_CUTOFF = 0.88
+
+# Age assumed when the profile does not give one
+ADULT_AGE = 30
+
+AGE_PATTERN = re.compile(r"age\s*:\s*(\d+)", re.IGNORECASE)
+SEX_PATTERN = re.compile(r"(?:gender|sex)\s*:\s*(\w+)", re.IGNORECASE)
+PARENTHESES_PATTERN = re.compile(r"\(([^)]*)\)")
+NON_ALPHANUMERIC_PATTERN = re.compile(r"[^a-z0-9+]+")
+
+
+def normalize_name(name):
+    """Normalize a parameter name for the alias index: lowercase alphanumerics separated by single spaces."""
+    return NON_ALPHANUMERIC_PATTERN.sub(" ", name.lower().replace("haem", "hem")).strip()
+
+
+def normalize_unit(unit):
+    """Normalize a unit so that spelling variants such as mcg/dl and µg/dL compare equal."""
+    unit = (unit or "").strip().lower().replace(" ", "").replace("μ", "µ").replace("mcg", "µg")
+    return re.sub(r"^u(?=[gmil])", "µ", unit)
+
+
+def parse_profile(user_profile):
+    """Read (age, sex) from the profile text built by the app; either may be None."""
+    age_match = AGE_PATTERN.search(user_profile or "")
+    sex_match = SEX_PATTERN.search(user_profile or "")
+    age = int(age_match.group(1)) if age_match else None
+    sex = sex_match.group(1).lower() if sex_match else None
+    return age, sex if sex in ("male", "female") else None
+
+
+class ReferenceRangeIndex:
+    """Alias index over the reference range knowledge base.
+
+    Exact lookups are a single dict access on the normalized name; unknown names
+    fall back to a fuzzy match against every alias, memoized per name.
+    """
+
+    def __init__(self, parameters):
+        self.parameters = parameters
+        self._aliases = {}
+        for entry in parameters:
+            names = [entry["name"], *entry.get("aliases", [])]
+            for name in names:
+                self._aliases.setdefault(normalize_name(name), entry)
+        self._fuzzy_keys = [key for key in self._aliases if len(key) >= FUZZY_MIN_LENGTH]
+        self.find = lru_cache(maxsize=1024)(self._find)
+
+    def __len__(self):
+        return len(self.parameters)
+
+    def _find(self, name):
+        """Return the knowledge base entry for a parameter name, or None."""
+        key = normalize_name(name)
+        entry = self._aliases.get(key)
+        if entry is not None:
+            return entry
+
+        # Reports often write "Glucose (Fasting)" or "Hemoglobin (Hb)"
+        for part in PARENTHESES_PATTERN.findall(name):
+            entry = self._aliases.get(normalize_name(part))
+            if entry is not None:
+                return entry
+        stripped = normalize_name(PARENTHESES_PATTERN.sub(" ", name))
+        entry = self._aliases.get(stripped)
+        if entry is not None or len(stripped) < FUZZY_MIN_LENGTH:
+            return entry
+
+        matches = difflib.get_close_matches(stripped, self._fuzzy_keys, n=1, cutoff=FUZZY_CUTOFF)
+        return self._aliases[matches[0]] if matches else None
+
+    def lookup(self, name, age=None, sex=None, unit=None):
+        """Return the reference range for a parameter as a dict, or None if it is unknown.
+
+        Picks the range for the given age (an adult when unknown) and sex. When the sex
+        is unknown and the range depends on it, the widest range across sexes is used.
+        Limits are converted to the given unit when the knowledge base knows it,
+        otherwise None is returned.
+        """
+        entry = self.find(name)
+        if entry is None:
+            return None
+
+        factor = 1.0
+        if unit and normalize_unit(unit) != normalize_unit(entry["unit"]):
+            factors = {normalize_unit(alt): value for alt, value in entry.get("alt_units", {}).items()}
+            if normalize_unit(unit) not in factors:
+                return None
+            factor = factors[normalize_unit(unit)]
+
+        age = ADULT_AGE if age is None else age
+        candidates = [
+            candidate for candidate in entry["ranges"]
+            if candidate.get("age_min", 0) <= age < candidate.get("age_max", 200)
+        ]
+        if sex is not None:
+            candidates = [candidate for candidate in candidates if candidate.get("sex") in (None, sex)][:1]
+        elif candidates and candidates[0].get("sex"):
+            # Without a sex, use the widest of the first range given for each sex
+            first_by_sex = {}
+            for candidate in candidates:
+                first_by_sex.setdefault(candidate.get("sex"), candidate)
+            candidates = list(first_by_sex.values())
+        else:
+            candidates = candidates[:1]
+        if not candidates:
+            return None
+
+        lows = [candidate.get("low") for candidate in candidates]
+        highs = [candidate.get("high") for candidate in candidates]
+        low = None if None in lows else min(lows) * factor
+        high = None if None in highs else max(highs) * factor
+        return {
+            "parameter": entry["name"],
+            "low": round(low, 3) if low is not None else None,
+            "high": round(high, 3) if high is not None else None,
+            "unit": unit or entry["unit"],
+            "text": format_range(low, high),
+        }
+
+
+def format_range(low, high):
+    """Format range limits the way lab reports print them."""
+    if low is not None and high is not None:
+        return f"{low:.3g}-{high:.3g}"
+    if high is not None:
+        return f"<{high:.3g}"
+    if low is not None:
+        return f">{low:.3g}"
+    return ""
+
+
+@lru_cache(maxsize=None)
+def get_reference_ranges(path=REFERENCE_RANGES_PATH):
+    """Load and index the bundled knowledge base once per process."""
+    with open(path, encoding="utf-8") as f:
+        return ReferenceRangeIndex(json.load(f)["parameters"])
+
+
+def fill_reference_ranges(results, user_profile=None, index=None):
+    """Return the results with missing reference ranges filled from the knowledge base.
+
+    Ranges printed on the report always win; filled ranges are marked as standard
+    ranges so the UI can tell them apart.
+    """
+    if index is None:
+        index = get_reference_ranges()
+    age, sex = parse_profile(user_profile)
+    filled = []
+    for result in results:
+        if result.reference_range or result.reference_low is not None or result.reference_high is not None:
+            filled.append(result)
+            continue
+        reference = index.lookup(result.parameter, age=age, sex=sex, unit=result.unit)
+        if reference is None:
+            filled.append(result)
+            continue
+        filled.append(LabResult(
+            parameter=result.parameter,
+            value=result.value,
+            value_text=result.value_text,
+            unit=result.unit,
+            reference_low=reference["low"],
+            reference_high=reference["high"],
+            reference_range=f"{reference['text']} (standard range)",
+            flag=result.flag,
+        ))
+    return filled
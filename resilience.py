@@ -0,0 +1,421 @@
+"""Deadlines, retries, hedged requests and circuit breaking around upstream model calls."""
+
+import contextvars
+import logging
+import queue
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from rate_limiter import queue_callback, report_queue_position
+
+logger = logging.getLogger(__name__)
+
+# Exception class names (anywhere in the MRO or cause chain) that mean "try again later"
+RETRYABLE_ERROR_NAMES = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+    "DeadlineExceeded", "GatewayTimeout", "BadGateway", "Aborted",
+    "ConnectionError", "ConnectTimeout", "ReadTimeout", "RemoteDisconnected", "TimeoutError",
+}
+RETRYABLE_MESSAGE_PATTERN = re.compile(
+    r"\b(?:429|500|502|503|504)\b|resource.?exhausted|unavailable|overloaded|timed? ?out|deadline",
+    re.IGNORECASE,
+)
+
+# Hedging needs enough samples for a meaningful p95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_PERCENTILE = 95
+# Abandoned calls keep a worker thread busy until the upstream answers; past this many
+# per upstream, timed-out calls are not retried and slow calls are not hedged
+MAX_ABANDONED_CALLS = 8
+
+
+class CallTimeoutError(TimeoutError):
+    """An upstream call produced nothing within its attempt timeout."""
+
+
+class CircuitOpenError(RuntimeError):
+    """The circuit breaker is open, so the call was not attempted."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} is unavailable after repeated failures; retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+def is_retryable(error):
+    """Return True for rate limits, overloads, timeouts and connection errors."""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(error).__mro__):
+            return True
+        if RETRYABLE_MESSAGE_PATTERN.search(str(error)):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def backoff_delay(attempt, base=1.0, cap=10.0):
+    """Exponential backoff with full jitter for the given (1-based) attempt."""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """Opens after consecutive retryable failures and lets a single probe through after reset_timeout."""
+
+    def __init__(self, name="upstream", failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.times_opened = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self.state == "open" and time.monotonic() - self._opened_at < self.reset_timeout
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go ahead now; return True if the call is the probe."""
+        with self._lock:
+            if self.state == "closed":
+                return False
+            retry_after = self._opened_at + self.reset_timeout - time.monotonic()
+            if self.state == "open" and retry_after <= 0:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.rejected += 1
+            raise CircuitOpenError(self.name, max(retry_after, 1.0))
+
+    def release_probe(self):
+        """Let another probe through after one ended without an outcome."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self._probe_in_flight = False
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.times_opened += 1
+                    logger.warning("Circuit for %s opened after %d failures", self.name, self.consecutive_failures)
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+            }
+
+
+class LatencyTracker:
+    """Rolling window of successful call latencies."""
+
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, percent, min_samples=1):
+        """Return the given latency percentile, or None with fewer than min_samples samples."""
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < max(min_samples, 1):
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+    def stats(self):
+        with self._lock:
+            count = len(self._samples)
+        return {
+            "samples": count,
+            "p50_seconds": self.percentile(50),
+            "p95_seconds": self.percentile(95),
+            "p99_seconds": self.percentile(99),
+        }
+
+
+class UpstreamHealth:
+    """Circuit breaker, latency window and call counters shared by every call to one upstream."""
+
+    def __init__(self, name="upstream", failure_threshold=5, reset_timeout=30.0, max_abandoned=MAX_ABANDONED_CALLS):
+        self.name = name
+        self.breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self.latency = LatencyTracker()
+        self.counters = {"calls": 0, "attempts": 0, "retries": 0, "timeouts": 0, "failures": 0, "hedges": 0}
+        self.max_abandoned = max_abandoned
+        self.abandoned = 0
+        self._lock = threading.Lock()
+
+    def count(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+
+    def can_abandon(self):
+        """Return True while fewer than max_abandoned abandoned calls are still running."""
+        with self._lock:
+            return self.abandoned < self.max_abandoned
+
+    def abandon(self, call):
+        """Count a running call nobody is waiting for any more, until it finishes."""
+        with self._lock:
+            if not call["finished"] and not call["abandoned"]:
+                call["abandoned"] = True
+                self.abandoned += 1
+
+    def finish(self, call):
+        with self._lock:
+            call["finished"] = True
+            if call["abandoned"]:
+                self.abandoned -= 1
+
+    def stats(self):
+        """Return call counters with the breaker state and latency percentiles."""
+        with self._lock:
+            counters = dict(self.counters)
+            abandoned = self.abandoned
+        calls = counters["calls"]
+        return {
+            "name": self.name,
+            **counters,
+            "abandoned_in_flight": abandoned,
+            "failure_rate": counters["failures"] / counters["attempts"] if counters["attempts"] else 0.0,
+            "breaker": self.breaker.stats(),
+            "latency": self.latency.stats(),
+            "retries_per_call": counters["retries"] / calls if calls else 0.0,
+        }
+
+
+@lru_cache(maxsize=None)
+def get_call_executor():
+    """Thread pool that runs upstream calls so callers can stop waiting on them."""
+    return ThreadPoolExecutor(max_workers=32, thread_name_prefix="upstream-calls")
+
+
+class ResilientAgent:
+    """Agent wrapper that bounds, retries, hedges and circuit-breaks every run.
+
+    Each attempt runs on a worker thread and is abandoned if it produces nothing for
+    attempt_timeout seconds, measured from when a worker picks it up (time spent waiting
+    for a worker or in a rate limiter queue does not count; only the overall deadline
+    bounds it). Retryable errors are retried with jittered exponential backoff until
+    max_attempts or the overall deadline; a stream is only retried before its first
+    chunk. Once enough latencies are known, a non-streaming call that runs past the p95
+    is hedged with a second request on a fresh agent from create_agent, and the first
+    answer wins. While an abandoned call is still running on the wrapped agent, later
+    attempts also get a fresh agent from create_agent. Abandoned calls that have not
+    started yet are cancelled; once the upstream has max_abandoned of them still running,
+    timeouts are no longer retried and calls are no longer hedged.
+    """
+
+    def __init__(self, agent, create_agent=None, health=None, executor=None, deadline=120.0,
+                 attempt_timeout=60.0, max_attempts=3, backoff_base=1.0, backoff_max=10.0, hedge=True):
+        self.agent = agent
+        self.create_agent = create_agent
+        self.health = health or UpstreamHealth()
+        self.executor = executor or get_call_executor()
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        # Cleared while a call on self.agent is running, including one that was abandoned
+        self._agent_idle = threading.Event()
+        self._agent_idle.set()
+        self._answered_by = agent
+
+    def __getattr__(self, name):
+        return getattr(self.agent, name)
+
+    @property
+    def run_response(self):
+        """The last run of whichever agent answered, for reading its metrics."""
+        return getattr(self._answered_by, "run_response", None)
+
+    def run(self, message=None, *args, stream=False, **kwargs):
+        events = self._run(message, args, kwargs, stream)
+        if stream:
+            return events
+        try:
+            while True:
+                next(events)
+        except StopIteration as stop:
+            return stop.value
+
+    def _run(self, message, args, kwargs, stream):
+        deadline = time.monotonic() + self.deadline
+        on_wait = queue_callback.get()
+        health = self.health
+        health.count("calls")
+        for attempt in range(1, self.max_attempts + 1):
+            probe = health.breaker.before_call()
+            health.count("attempts")
+            received = False
+            settled = False
+            try:
+                for kind, item in self._attempt(message, args, kwargs, stream, on_wait, deadline):
+                    if kind == "chunk":
+                        received = True
+                        yield item
+                    else:
+                        result, started = item
+            except Exception as e:
+                settled = True
+                retryable = is_retryable(e)
+                if retryable:
+                    health.count("failures")
+                    health.breaker.record_failure()
+                else:
+                    # The upstream answered; the request itself was bad
+                    health.breaker.record_success()
+                delay = backoff_delay(attempt, self.backoff_base, self.backoff_max)
+                if received or not retryable or attempt == self.max_attempts or time.monotonic() + delay > deadline:
+                    raise
+                if isinstance(e, CallTimeoutError) and not health.can_abandon():
+                    # Too many timed-out calls are still holding worker threads
+                    raise
+                health.count("retries")
+                logger.warning("Retrying upstream call in %.1fs after attempt %d failed: %s", delay, attempt, e)
+                time.sleep(delay)
+                continue
+            else:
+                settled = True
+                health.breaker.record_success()
+                health.latency.record(time.monotonic() - started)
+                return result
+            finally:
+                if probe and not settled:
+                    # The caller stopped reading the stream before the probe finished
+                    health.breaker.release_probe()
+
+    def _attempt(self, message, args, kwargs, stream, on_wait, deadline):
+        """Run one attempt (plus an optional hedge) and yield ("chunk", chunk) and finally ("done", (result, started))."""
+        events = queue.Queue()
+        agent = self.agent
+        if not self._agent_idle.is_set() and self.create_agent is not None:
+            # An abandoned attempt is still running on self.agent, and agents are not thread-safe
+            agent = self.create_agent()
+        agents = [agent]
+        calls = [self._start(agent, events, 0, message, args, kwargs, stream)]
+        failed = 0
+        # Set once a worker picks the call up, so executor queueing does not count as upstream latency
+        started = last_activity = None
+        hedge_after = None
+        if self.hedge and not stream and self.create_agent is not None:
+            hedge_after = self.health.latency.percentile(HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES)
+
+        try:
+            while True:
+                now = time.monotonic()
+                if started is None:
+                    timeout = deadline - now
+                else:
+                    timeout = last_activity + self.attempt_timeout - now
+                    if hedge_after is not None:
+                        timeout = min(timeout, started + hedge_after - now)
+                try:
+                    tag, kind, item = events.get(timeout=max(timeout, 0))
+                except queue.Empty:
+                    if started is None:
+                        self.health.count("timeouts")
+                        raise CallTimeoutError("no worker was free to call the model before the deadline")
+                    if hedge_after is not None and time.monotonic() < last_activity + self.attempt_timeout:
+                        hedge_after = None
+                        if self.health.can_abandon():
+                            self.health.count("hedges")
+                            agents.append(self.create_agent())
+                            calls.append(self._start(agents[-1], events, len(calls), message, args, kwargs, stream))
+                        continue
+                    self.health.count("timeouts")
+                    raise CallTimeoutError(f"no response from the model within {self.attempt_timeout:g}s")
+
+                if kind == "started":
+                    if started is None:
+                        started = last_activity = time.monotonic()
+                    continue
+                if kind == "queued":
+                    # Waiting for a rate limiter slot is not upstream latency
+                    started = last_activity = time.monotonic()
+                    if on_wait is not None:
+                        on_wait(*item)
+                    continue
+                if kind == "error":
+                    failed += 1
+                    if failed == len(calls):
+                        raise item
+                    continue
+                last_activity = time.monotonic()
+                self._answered_by = agents[tag]
+                if kind == "chunk":
+                    yield kind, item
+                else:
+                    yield kind, (item, started)
+                    return
+        finally:
+            for future, call in calls:
+                self._abandon(future, call)
+
+    def _abandon(self, future, call):
+        """Cancel a call that has not started yet, or count it as abandoned until it finishes."""
+        if future.cancel():
+            if call["shared"]:
+                self._agent_idle.set()
+        else:
+            self.health.abandon(call)
+
+    def _start(self, agent, events, tag, message, args, kwargs, stream):
+        """Run agent.run on the call executor, reporting its start, chunks, the result or the error to events.
+
+        Returns the future and the call's state for _abandon.
+        """
+        state = {"shared": agent is self.agent, "finished": False, "abandoned": False}
+        if state["shared"]:
+            self._agent_idle.clear()
+
+        def report_queue(position, waited):
+            events.put((tag, "queued", (position, waited)))
+
+        def call():
+            events.put((tag, "started", None))
+            with report_queue_position(report_queue):
+                try:
+                    if stream:
+                        for chunk in agent.run(message, *args, stream=True, **kwargs):
+                            events.put((tag, "chunk", chunk))
+                        events.put((tag, "done", None))
+                    else:
+                        events.put((tag, "done", agent.run(message, *args, **kwargs)))
+                except Exception as e:
+                    events.put((tag, "error", e))
+                finally:
+                    self.health.finish(state)
+                    if state["shared"]:
+                        self._agent_idle.set()
+
+        return self.executor.submit(contextvars.copy_context().run, call), state
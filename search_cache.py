@@ -0,0 +1,110 @@
+"""Process-wide cache for the web searches the agents run through Tavily."""
+
+import hashlib
+import re
+import threading
+import time
+from concurrent.futures import Future
+from functools import lru_cache
+
+from bounded_cache import BoundedCache
+
+SEARCH_CACHE_TTL_SECONDS = 24 * 3600
+SEARCH_CACHE_MAX_ENTRIES = 2000
+SEARCH_CACHE_MAX_BYTES = 20 * 1024 * 1024
+
+TRAILING_PUNCTUATION_PATTERN = re.compile(r"[\s?.!,;:]+$")
+
+
+def normalize_query(query):
+    """Normalize a search query so trivially different spellings share a cache entry."""
+    query = " ".join((query or "").casefold().split())
+    return TRAILING_PUNCTUATION_PATTERN.sub("", query)
+
+
+class SearchCache:
+    """Two-level TTL cache for search results with in-flight deduplication.
+
+    Results are kept in memory and, when a disk cache (an AnalysisCache) is given,
+    also persisted across restarts. Concurrent identical searches share one request.
+    """
+
+    def __init__(self, disk_cache=None, ttl_seconds=SEARCH_CACHE_TTL_SECONDS,
+                 max_entries=SEARCH_CACHE_MAX_ENTRIES, max_bytes=SEARCH_CACHE_MAX_BYTES):
+        self.memory = BoundedCache(max_entries=max_entries, max_bytes=max_bytes, ttl_seconds=ttl_seconds)
+        self.disk_cache = disk_cache
+        self.disk_hits = 0
+        self.deduplicated = 0
+        self.searches = 0
+        self.search_seconds = 0.0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def make_key(self, query, *options):
+        """Build the cache key for a normalized query and the options that shape its result."""
+        text = "\x00".join([normalize_query(query), *(str(option) for option in options)])
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_or_search(self, key, search):
+        """Return the cached result for a key, or run search() once and cache its result."""
+        result = self.memory.get(key)
+        if result is not None:
+            return result
+        if self.disk_cache is not None:
+            entry = self.disk_cache.get(key)
+            if entry is not None:
+                self.disk_hits += 1
+                self.memory.put(key, entry["result"])
+                return entry["result"]
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = future
+            else:
+                self.deduplicated += 1
+        if not owner:
+            return future.result()
+
+        started = time.perf_counter()
+        try:
+            result = search()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            self.memory.put(key, result)
+            if self.disk_cache is not None:
+                self.disk_cache.put_payload(key, {"result": result})
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+                self.searches += 1
+                self.search_seconds += time.perf_counter() - started
+        return result
+
+    def stats(self):
+        """Return hit/miss counters across both levels and the time spent in real searches."""
+        memory = self.memory.stats()
+        hits = memory["hits"] + self.disk_hits + self.deduplicated
+        lookups = hits + self.searches
+        return {
+            "hits": hits,
+            "memory_hits": memory["hits"],
+            "disk_hits": self.disk_hits,
+            "deduplicated": self.deduplicated,
+            "searches": self.searches,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "average_search_seconds": self.search_seconds / self.searches if self.searches else 0.0,
+            "entries": memory["entries"],
+            "bytes": memory["bytes"],
+        }
+
+
+@lru_cache(maxsize=None)
+def get_search_cache():
+    """Return the in-memory search cache shared by every agent in this process."""
+    return SearchCache()
@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lab_results import normalize_numbers, validate_result  # noqa: E402
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("250,000", 250000.0),
+    ("1,200", 1200.0),
+    ("1,234,567.5", 1234567.5),
+    ("4,5", 4.5),
+    ("0,125", 0.125),
+    ("12,3456", 12.3456),
+    ("< 5,0", 5.0),
+    ("7.25", 7.25),
+])
+def test_value_commas(text, expected):
+    assert validate_result({"parameter": "Test", "value": text}).value == expected
+
+
+def test_reference_limits_use_the_same_rule():
+    result = validate_result({"parameter": "Platelets", "value": "250,000",
+                              "reference_low": "150,000", "reference_high": "450,000"})
+    assert (result.value, result.reference_low, result.reference_high) == (250000.0, 150000.0, 450000.0)
+
+
+def test_normalize_numbers_rewrites_ranges():
+    assert normalize_numbers("150,000-450,000") == "150000-450000"
+    assert normalize_numbers("3,5-5,0") == "3.5-5.0"
@@ -0,0 +1,155 @@
+import json
+import os
+import random
+import sys
+from io import BytesIO
+
+import pytest
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import lab_pipeline  # noqa: E402
+from analysis_cache import AnalysisCache  # noqa: E402
+from lab_results import RESULTS_MARKER  # noqa: E402
+from near_duplicates import (  # noqa: E402
+    MAX_DISTANCE,
+    BKTree,
+    NearDuplicateIndex,
+    hamming_distance,
+    perceptual_hash,
+    same_results,
+)
+
+PARAMETERS = [
+    ("Hemoglobin", "g/dL", "13.5-17.5"),
+    ("White Blood Cells", "x10^9/L", "4.0-11.0"),
+    ("Platelets", "x10^9/L", "150-450"),
+    ("Glucose (fasting)", "mg/dL", "70-99"),
+    ("Total Cholesterol", "mg/dL", "<200"),
+    ("Creatinine", "mg/dL", "0.7-1.3"),
+    ("ALT", "U/L", "7-56"),
+    ("TSH", "mIU/L", "0.4-4.0"),
+]
+
+
+def report_values(seed):
+    rng = random.Random(seed)
+    return [round(rng.uniform(1, 250), 1) for _ in PARAMETERS]
+
+
+def report_image(values):
+    """Draw a report on a fixed lab form, so different reports share a layout."""
+    image = Image.new("RGB", (600, 850), "white")
+    draw = ImageDraw.Draw(image)
+    draw.text((50, 50), "City Diagnostics Laboratory", fill="black")
+    draw.line((50, 100, 550, 100), fill="black", width=2)
+    for index, ((parameter, unit, reference_range), value) in enumerate(zip(PARAMETERS, values)):
+        y = 130 + index * 30
+        draw.text((50, y), parameter, fill="black")
+        draw.text((250, y), f"{value} {unit}", fill="black")
+        draw.text((420, y), reference_range, fill="black")
+    output = BytesIO()
+    image.save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+
+def analysis_reply(values):
+    results = [
+        {"parameter": parameter, "value": value, "unit": unit, "reference_range": reference_range, "flag": "UNKNOWN"}
+        for (parameter, unit, reference_range), value in zip(PARAMETERS, values)
+    ]
+    return f"## Lab Report Analysis\n\n{RESULTS_MARKER}\n```json\n{json.dumps(results)}\n```"
+
+
+def rephotograph(data):
+    """Crop, slightly rotate and re-encode a report image, like a second photo of the same page."""
+    image = Image.open(BytesIO(data)).convert("RGB")
+    width, height = image.size
+    image = image.crop((20, 15, width - 12, height - 25)).rotate(1.5, expand=True, fillcolor="white")
+    output = BytesIO()
+    image.save(output, format="JPEG", quality=60)
+    return output.getvalue()
+
+
+@pytest.fixture
+def earlier_upload(tmp_path):
+    """An analyzed upload: its analysis and recommendations are cached and its hash is indexed."""
+    values = report_values(1)
+    image = report_image(values)
+    cache = AnalysisCache(str(tmp_path / "analyses.sqlite3"))
+    cache.put("report-1", analysis_reply(values), "Recommendations for report 1")
+    index = NearDuplicateIndex()
+    index.add(perceptual_hash(image), "report-1")
+    return values, image, cache, index
+
+
+def candidates(index, image):
+    return [entry["cache_key"] for entry in index.find(perceptual_hash(image))]
+
+
+@pytest.mark.parametrize("other_seed", [2, 3, 999])
+def test_same_layout_report_is_not_reused(earlier_upload, other_seed):
+    _, _, cache, index = earlier_upload
+    values = report_values(other_seed)
+    # A different report on the same form is found as a candidate...
+    assert candidates(index, report_image(values)) == ["report-1"]
+    # ...and rejected because its analysis reads different results
+    assert lab_pipeline.find_reusable_recommendations(cache, analysis_reply(values), ["report-1"]) is None
+
+
+def test_rephotographed_report_is_reused(earlier_upload):
+    values, image, cache, index = earlier_upload
+    copy = rephotograph(image)
+    assert candidates(index, copy) == ["report-1"]
+    reused = lab_pipeline.find_reusable_recommendations(cache, analysis_reply(values), candidates(index, copy))
+    assert reused == "Recommendations for report 1"
+
+
+def test_reuse_check_does_not_count_as_cache_lookups(earlier_upload):
+    values, _, cache, _ = earlier_upload
+    lab_pipeline.find_reusable_recommendations(cache, analysis_reply(values), ["report-1", "missing"])
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (0, 0)
+
+
+def test_empty_results_never_match():
+    assert not same_results([], [])
+
+
+def test_bk_tree_finds_the_same_hashes_as_a_linear_scan():
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(63) for _ in range(2000)]
+    tree = BKTree()
+    for index, value in enumerate(hashes):
+        tree.add(value, index)
+    for query in hashes[:50] + [rng.getrandbits(63) for _ in range(50)]:
+        expected = sorted(
+            (hamming_distance(query, value), index)
+            for index, value in enumerate(hashes)
+            if hamming_distance(query, value) <= MAX_DISTANCE
+        )
+        assert sorted(tree.search(query, MAX_DISTANCE)) == expected
+
+
+def test_index_filters_by_scope_and_version_and_persists(tmp_path):
+    path = str(tmp_path / "hashes.sqlite3")
+    index = NearDuplicateIndex(path)
+    index.add(0b1011, "a", scope="session-1", profile="p", version="v1")
+    index.add(0b1010, "b", scope="session-2", profile="p", version="v1")
+
+    reopened = NearDuplicateIndex(path)
+    assert [entry["cache_key"] for entry in reopened.find(0b1011, scope="session-1", version="v1")] == ["a"]
+    assert [entry["cache_key"] for entry in reopened.find(0b1011, version="v1")] == ["a", "b"]
+    assert reopened.find(0b1011, version="v2") == []
+
+
+def test_one_upload_is_recorded_in_every_scope(tmp_path):
+    path = str(tmp_path / "hashes.sqlite3")
+    index = NearDuplicateIndex(path)
+    index.add(0b1011, "a", scope="session-1", version="v1")
+    index.add(0b1011, "a", scope="session-2", version="v1")
+
+    reopened = NearDuplicateIndex(path)
+    for scope in ("session-1", "session-2"):
+        assert [entry["scope"] for entry in reopened.find(0b1011, scope=scope)] == [scope]
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lab_results import validate_result  # noqa: E402
+from range_classifier import classify, classify_results  # noqa: E402
+
+
+@pytest.mark.parametrize("value, reference_range, expected", [
+    ("250,000", "150,000-450,000", "NORMAL"),
+    ("1,200", "200-1,000", "HIGH"),
+    ("4,5", "3,5-5,0", "NORMAL"),
+    ("5,5", "3,5-5,0", "HIGH"),
+    ("0,125", "< 0,5", "NORMAL"),
+])
+def test_commas_in_values_and_ranges(value, reference_range, expected):
+    assert classify([value], [reference_range]).iloc[0]["status"] == expected
+
+
+def test_text_and_numeric_limits_agree():
+    # The limits from the model's JSON and the values parsed here must use the same rule
+    result = validate_result({"parameter": "Platelets", "value": "250,000", "reference_low": "150,000",
+                              "reference_high": "450,000", "reference_range": "150,000-450,000"})
+    row = classify_results([result]).iloc[0]
+    assert (row["value_num"], row["low"], row["high"], row["status"]) == (250000, 150000, 450000, "NORMAL")
+
+
+def test_decimal_comma_value_against_numeric_limits():
+    result = validate_result({"parameter": "Potassium", "value": "4,5", "reference_low": "3,5",
+                              "reference_high": "5,0"})
+    row = classify_results([result]).iloc[0]
+    assert (row["value_num"], row["low"], row["high"], row["status"]) == (4.5, 3.5, 5.0, "NORMAL")
@@ -0,0 +1,88 @@
+"""Token accounting for model calls, per call and per pipeline stage."""
+
+import logging
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+
+def usage_from_metrics(metrics):
+    """Sum the per-message metrics phidata records for a run into one usage dict."""
+    metrics = metrics or {}
+    first_token = [value for value in metrics.get("time_to_first_token", []) if value is not None]
+    return {
+        "input_tokens": int(sum(metrics.get("input_tokens", []))),
+        "output_tokens": int(sum(metrics.get("output_tokens", []))),
+        "model_calls": len(metrics.get("input_tokens", [])),
+        "time_to_first_token": first_token[0] if first_token else None,
+    }
+
+
+def run_metrics(agent, response=None):
+    """Return the metrics of an agent's last run, preferring those on the response itself."""
+    metrics = getattr(response, "metrics", None)
+    if metrics:
+        return metrics
+    return getattr(getattr(agent, "run_response", None), "metrics", None)
+
+
+def add_call(stages, call):
+    """Add one call record to per-stage totals."""
+    stage = stages.setdefault(call["stage"], {"calls": 0, "input_tokens": 0, "output_tokens": 0, "seconds": 0.0})
+    stage["calls"] += 1
+    stage["input_tokens"] += call["input_tokens"]
+    stage["output_tokens"] += call["output_tokens"]
+    stage["seconds"] += call["seconds"]
+
+
+def summarize_usage(calls=(), stages=None):
+    """Total a list of call records (or ready per-stage totals), overall and by stage."""
+    stages = {} if stages is None else stages
+    for call in calls:
+        add_call(stages, call)
+    return {
+        "calls": sum(stage["calls"] for stage in stages.values()),
+        "input_tokens": sum(stage["input_tokens"] for stage in stages.values()),
+        "output_tokens": sum(stage["output_tokens"] for stage in stages.values()),
+        "stages": stages,
+    }
+
+
+class TokenLedger:
+    """Process-wide record of what every model call cost, with totals per stage."""
+
+    def __init__(self, max_calls=500):
+        self._calls = deque(maxlen=max_calls)
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage, usage, seconds):
+        """Record one call and return its record."""
+        call = {"stage": stage, **usage, "seconds": round(seconds, 3), "at": time.time()}
+        logger.info(
+            "Model call %s: %d input + %d output tokens in %.1fs",
+            stage, call["input_tokens"], call["output_tokens"], seconds,
+        )
+        with self._lock:
+            self._calls.append(call)
+            add_call(self._stages, call)
+        return call
+
+    def recent_calls(self):
+        with self._lock:
+            return list(self._calls)
+
+    def stats(self):
+        """Return totals overall and by stage since the process started."""
+        with self._lock:
+            stages = {name: dict(stage) for name, stage in self._stages.items()}
+        return summarize_usage(stages=stages)
+
+
+@lru_cache(maxsize=None)
+def get_token_ledger():
+    """Return the token ledger shared by every caller in this process."""
+    return TokenLedger()
@@ -0,0 +1,245 @@
+"""Lightweight tracing: timed spans per pipeline stage, latency histograms and local exporters.
+
+Spans share a trace id (the correlation id of one request or analysis job) through
+a context variable, so nested stages and worker threads started with a copied
+context can be tied back to the request that caused them. Finished spans feed
+per-stage histograms, exported in the Prometheus text format, and can also be written
+to a JSON Lines file in the OpenTelemetry span layout.
+"""
+
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+
+from resilience import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+METRIC_PREFIX = "labanalyzer"
+
+# Histogram bucket upper bounds in seconds, from image decoding to slow model calls
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+current_trace_id = contextvars.ContextVar("current_trace_id", default=None)
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+@contextmanager
+def start_trace(trace_id=None):
+    """Run the enclosed code under a trace (correlation) id, a new one unless given."""
+    token = current_trace_id.set(trace_id or new_trace_id())
+    span_token = current_span.set(None)
+    try:
+        yield current_trace_id.get()
+    finally:
+        current_span.reset(span_token)
+        current_trace_id.reset(token)
+
+
+class StageHistogram:
+    """Cumulative duration buckets (for Prometheus) plus a rolling window for percentiles."""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.errors = 0
+        self.sum = 0.0
+        self.window = LatencyTracker()
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, error=False):
+        with self._lock:
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    self.counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+            if error:
+                self.errors += 1
+        self.window.record(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {"buckets": list(self.counts), "count": self.count, "sum": self.sum, "errors": self.errors}
+
+
+class JsonlSpanExporter:
+    """Appends finished spans to a JSON Lines file using OpenTelemetry span field names."""
+
+    def __init__(self, path, service_name="labanalyzer"):
+        self.path = path
+        self.service_name = service_name
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        record = {
+            "traceId": span["trace_id"],
+            "spanId": span["span_id"],
+            "parentSpanId": span["parent_id"] or "",
+            "name": span["name"],
+            "startTimeUnixNano": int(span["start"] * 1e9),
+            "endTimeUnixNano": int(span["end"] * 1e9),
+            "status": {"code": "STATUS_CODE_ERROR" if span["error"] else "STATUS_CODE_OK", "message": span["error"] or ""},
+            "attributes": [
+                {"key": key, "value": {"stringValue": str(value)}} for key, value in span["attributes"].items()
+            ],
+            "resource": {"service.name": self.service_name},
+        }
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+
+class Tracer:
+    """Records spans into per-stage histograms and hands them to an optional exporter."""
+
+    def __init__(self, exporter=None):
+        self.exporter = exporter
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, stage):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = StageHistogram()
+            return histogram
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Time the enclosed code as a span named after its stage; the yielded dict takes extra attributes."""
+        parent = current_span.get()
+        trace_id = current_trace_id.get() or (parent or {}).get("trace_id") or new_trace_id()
+        span = {
+            "name": name,
+            "trace_id": trace_id,
+            "span_id": uuid.uuid4().hex[:16],
+            "parent_id": parent["span_id"] if parent else None,
+            "attributes": attributes,
+            "error": None,
+        }
+        token = current_span.set(span)
+        span["start"] = time.time()
+        started = time.perf_counter()
+        try:
+            yield span["attributes"]
+        except Exception as e:
+            span["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            seconds = time.perf_counter() - started
+            span["end"] = span["start"] + seconds
+            current_span.reset(token)
+            self.histogram(name).observe(seconds, error=span["error"] is not None)
+            if self.exporter is not None:
+                try:
+                    self.exporter.export(span)
+                except Exception as e:
+                    logger.warning("Could not export span %s: %s", name, e)
+
+    def stats(self):
+        """Return count, errors and p50/p95/p99 latency per stage."""
+        with self._lock:
+            histograms = dict(self._histograms)
+        stats = {}
+        for stage, histogram in sorted(histograms.items()):
+            snapshot = histogram.snapshot()
+            stats[stage] = {
+                "count": snapshot["count"],
+                "errors": snapshot["errors"],
+                "average_seconds": snapshot["sum"] / snapshot["count"] if snapshot["count"] else 0.0,
+                "p50_seconds": histogram.window.percentile(50),
+                "p95_seconds": histogram.window.percentile(95),
+                "p99_seconds": histogram.window.percentile(99),
+            }
+        return stats
+
+    def render_prometheus(self):
+        """Return every stage histogram in the Prometheus text exposition format."""
+        name = f"{METRIC_PREFIX}_stage_duration_seconds"
+        errors_name = f"{METRIC_PREFIX}_stage_errors_total"
+        with self._lock:
+            histograms = dict(self._histograms)
+        lines = [
+            f"# HELP {name} Time spent in each pipeline stage.",
+            f"# TYPE {name} histogram",
+        ]
+        snapshots = {stage: histogram.snapshot() for stage, histogram in sorted(histograms.items())}
+        for stage, snapshot in snapshots.items():
+            label = stage.replace("\\", "\\\\").replace('"', '\\"')
+            for bound, count in zip(DURATION_BUCKETS, snapshot["buckets"]):
+                lines.append(f'{name}_bucket{{stage="{label}",le="{bound}"}} {count}')
+            lines.append(f'{name}_bucket{{stage="{label}",le="+Inf"}} {snapshot["count"]}')
+            lines.append(f'{name}_sum{{stage="{label}"}} {snapshot["sum"]:.6f}')
+            lines.append(f'{name}_count{{stage="{label}"}} {snapshot["count"]}')
+        lines += [f"# HELP {errors_name} Spans that ended with an exception.", f"# TYPE {errors_name} counter"]
+        for stage, snapshot in snapshots.items():
+            label = stage.replace("\\", "\\\\").replace('"', '\\"')
+            lines.append(f'{errors_name}{{stage="{label}"}} {snapshot["errors"]}')
+        return "\n".join(lines) + "\n"
+
+
+@lru_cache(maxsize=None)
+def get_tracer():
+    """Return the tracer shared by the process; spans are written to $TRACE_EXPORT_PATH when it is set."""
+    path = os.environ.get("TRACE_EXPORT_PATH")
+    return Tracer(JsonlSpanExporter(path) if path else None)
+
+
+def span(name, **attributes):
+    """Time the enclosed code as a span on the process tracer."""
+    return get_tracer().span(name, **attributes)
+
+
+def traced(name):
+    """Decorator that runs every call of the function in a span."""
+
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    return decorate
+
+
+def start_metrics_server(port, tracer=None, host="127.0.0.1"):
+    """Serve the Prometheus text format at http://host:port/metrics from a daemon thread."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    tracer = tracer or get_tracer()
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = tracer.render_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server